@@ -9,6 +9,7 @@ class HomeOSAPI {
         this.currentUser = null;
         this.language = localStorage.getItem('homeos_language') || 'ru';
         this.translations = {};
+        this.batchQueue = [];
         this.tg = window.Telegram?.WebApp;
         
         // Initialize Telegram WebApp if available
@@ -24,13 +25,7 @@ class HomeOSAPI {
      */
     async loadTranslations() {
         try {
-            const response = await fetch(`${this.baseURL}/api/translations/${this.language}`, {
-                credentials: 'include'
-            });
-            
-            if (response.ok) {
-                this.translations = await response.json();
-            }
+            this.translations = await this.batchedRequest(`/api/translations/${this.language}`);
         } catch (error) {
             console.error('Failed to load translations:', error);
         }
@@ -99,11 +94,7 @@ class HomeOSAPI {
      */
     async checkAuth() {
         try {
-            const response = await fetch(`${this.baseURL}/api/auth/check`, {
-                credentials: 'include'
-            });
-
-            const data = await response.json();
+            const data = await this.batchedRequest('/api/auth/check');
 
             if (data.authenticated) {
                 this.currentUser = data.user;
@@ -171,14 +162,68 @@ class HomeOSAPI {
         }
     }
 
+    /**
+     * Same as request(), but calls made in the same tick are sent
+     * together as one POST /api/batch round trip
+     */
+    batchedRequest(endpoint, options = {}) {
+        return new Promise((resolve, reject) => {
+            this.batchQueue.push({ endpoint, options, resolve, reject });
+            if (this.batchQueue.length === 1) {
+                setTimeout(() => this.flushBatch(), 0);
+            }
+        });
+    }
+
+    async flushBatch() {
+        const calls = this.batchQueue.splice(0);
+        if (calls.length === 1) {
+            const { endpoint, options, resolve, reject } = calls[0];
+            return this.request(endpoint, options).then(resolve, reject);
+        }
+
+        for (let start = 0; start < calls.length; start += HomeOSAPI.BATCH_MAX) {
+            const chunk = calls.slice(start, start + HomeOSAPI.BATCH_MAX);
+            let responses;
+            try {
+                const data = await this.request('/api/batch', {
+                    method: 'POST',
+                    body: JSON.stringify({
+                        requests: chunk.map(({ endpoint, options }) => ({
+                            method: options.method || 'GET',
+                            path: endpoint,
+                            body: options.body ? JSON.parse(options.body) : undefined
+                        }))
+                    })
+                });
+                responses = data.responses;
+            } catch (error) {
+                chunk.forEach(call => call.reject(error));
+                continue;
+            }
+
+            chunk.forEach((call, i) => {
+                const { status, body } = responses[i];
+                if (status === 401) {
+                    // Let request() re-authenticate and retry this one on its own
+                    this.request(call.endpoint, call.options).then(call.resolve, call.reject);
+                } else if (status >= 400) {
+                    call.reject(new Error(body?.error || 'Request failed'));
+                } else {
+                    call.resolve(body);
+                }
+            });
+        }
+    }
+
     // ==================== BANK API ====================
 
     async getBankAccount() {
-        return await this.request('/api/bank/my-account');
+        return await this.batchedRequest('/api/bank/my-account');
     }
 
     async getBankUsers() {
-        return await this.request('/api/bank/users');
+        return await this.batchedRequest('/api/bank/users');
     }
 
     async makeBankTransfer(to, amount, comment = '') {
@@ -189,17 +234,17 @@ class HomeOSAPI {
     }
 
     async getBankHistory() {
-        return await this.request('/api/bank/history');
+        return await this.batchedRequest('/api/bank/history');
     }
 
     // ==================== SHOP API ====================
 
     async getShopProducts() {
-        return await this.request('/api/shop/products');
+        return await this.batchedRequest('/api/shop/products');
     }
 
     async getMyStore() {
-        return await this.request('/api/shop/my-store');
+        return await this.batchedRequest('/api/shop/my-store');
     }
 
     async purchaseProducts(cart) {
@@ -225,13 +270,13 @@ class HomeOSAPI {
     }
 
     async getShifts() {
-        return await this.request('/api/mywork/shifts');
+        return await this.batchedRequest('/api/mywork/shifts');
     }
 
     // ==================== MYINFO API ====================
 
     async getMyInfoRecords() {
-        return await this.request('/api/myinfo/records');
+        return await this.batchedRequest('/api/myinfo/records');
     }
 
     async saveMyInfoRecords(records) {
@@ -241,6 +286,45 @@ class HomeOSAPI {
         });
     }
 
+    // ==================== SYNC API ====================
+
+    /**
+     * Records changed since a cursor from the previous call.
+     * {reset: true, cursor} means: reload the collections in full, then
+     * keep calling with that cursor.
+     */
+    async getChanges(since = null, collections = []) {
+        const params = new URLSearchParams();
+        if (since) {
+            params.set('since', since);
+        }
+        if (collections.length) {
+            params.set('collections', collections.join(','));
+        }
+        return await this.request(`/api/changes?${params}`);
+    }
+
+    /**
+     * Subscribe to server events instead of polling.
+     * handlers: {balance, transfer, notification, shift, reset} -> fn(data).
+     * The browser reconnects by itself and resumes where it stopped;
+     * call close() on the result to unsubscribe.
+     */
+    subscribe(handlers = {}) {
+        const lastEventId = sessionStorage.getItem('homeos_last_event_id');
+        const query = lastEventId ? `?last_event_id=${encodeURIComponent(lastEventId)}` : '';
+        const source = new EventSource(`${this.baseURL}/api/events${query}`, { withCredentials: true });
+
+        for (const [event, handler] of Object.entries(handlers)) {
+            source.addEventListener(event, (e) => {
+                sessionStorage.setItem('homeos_last_event_id', e.lastEventId);
+                handler(JSON.parse(e.data));
+            });
+        }
+
+        return source;
+    }
+
     // ==================== UTILITY METHODS ====================
 
     /**
@@ -279,25 +363,27 @@ class HomeOSAPI {
     }
 }
 
+HomeOSAPI.BATCH_MAX = 20;  // Same limit as the server's /api/batch
+
 // Global API instance
 const api = new HomeOSAPI();
 
 // Auto-initialize
 (async function() {
     try {
-        await api.loadTranslations();
-        
         // Try to authenticate with Telegram
         if (api.tg && api.tg.initData) {
+            const translations = api.loadTranslations();
             try {
                 await api.authenticateWithTelegram();
                 console.log('✅ Authenticated with Telegram');
             } catch (error) {
                 console.log('ℹ️ Telegram auth not available, will require manual login');
             }
+            await translations;
         } else {
-            // Check if session exists
-            await api.checkAuth();
+            // Check if session exists; goes out in one batch with the translations
+            await Promise.all([api.loadTranslations(), api.checkAuth()]);
         }
     } catch (error) {
         console.error('API initialization error:', error);
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the shop backend repositories (see shop.py)
+Writes the generated repositories package into a temp dir and measures lookups
+
+Usage: python bench_shop_repo.py [10000 100000 1000000]
+       python bench_shop_repo.py --contention [1 2 4 8 16]
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import importlib
+
+import shop
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_THREADS = [1, 2, 4, 8, 16]
+CONTENTION_SECONDS = 2.0
+
+def load_repositories(root):
+    """Write the repositories package from shop.py into root and import it"""
+    pkg = os.path.join(root, 'repositories')
+    shop.w(os.path.join(pkg, '__init__.py'), '\n')
+    for name, module in [('repo_base', shop.repo_base), ('sqlite_repo', shop.repo_sqlite),
+                         ('users_repo', shop.users_repo), ('orders_repo', shop.orders_repo),
+                         ('products_repo', shop.products_repo), ('transactions_repo', shop.transactions_repo)]:
+        shop.w(os.path.join(pkg, f'{name}.py'), module)
+    sys.path.insert(0, root)
+    importlib.invalidate_caches()
+    return (importlib.import_module('repositories.users_repo'),
+            importlib.import_module('repositories.orders_repo'))
+
+def make_dataset(data_dir, n):
+    """users.json and orders.json with n records each"""
+    users = [{'id': f'u{i}', 'name': f'User {i}', 'telegram_id': str(10_000_000 + i),
+              'role': 'user', 'balance': 100.0} for i in range(n)]
+    orders = [{'id': f'o{i}', 'buyer_id': f'u{i}', 'store_id': f'store-{i % 50}', 'items': [],
+               'total': 10.0, 'status': 'paid', 'idempotency_key': f'k{i}'} for i in range(n)]
+    for name, items in [('users.json', users), ('orders.json', orders)]:
+        with open(os.path.join(data_dir, name), 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False, indent=2)
+
+def legacy_find(path, field, value):
+    """What every lookup cost before the cache: parse the file, scan it"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for item in json.load(f):
+            if item.get(field) == value:
+                return item
+    return None
+
+def timed(fn, keys):
+    start = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter() - start) / len(keys)
+
+def fmt(seconds):
+    if seconds >= 1:
+        return f'{seconds:8.2f} s '
+    if seconds >= 1e-3:
+        return f'{seconds * 1e3:8.2f} ms'
+    return f'{seconds * 1e6:8.2f} us'
+
+def bench_size(modules, root, n):
+    users_mod, orders_mod = modules
+    data_dir = os.path.join(root, f'data_{n}')
+    os.makedirs(data_dir, exist_ok=True)
+    make_dataset(data_dir, n)
+    users = users_mod.UsersRepo(data_dir)
+    orders = orders_mod.OrdersRepo(data_dir)
+
+    # The legacy path parses the whole file per call, so a few calls are enough
+    legacy_keys = [n // 2, n - 1, 0]
+    hot_keys = [(i * 7919) % n for i in range(2000)]
+
+    rows = []
+    for label, path, field, mk, fn in [
+        ('get(id)', users.file_path, 'id', lambda i: f'u{i}', users.get),
+        ('find_by_telegram', users.file_path, 'telegram_id', lambda i: str(10_000_000 + i), users.find_by_telegram),
+        ('orders.find_by_key', orders.file_path, 'idempotency_key', lambda i: f'k{i}', orders.find_by_key),
+    ]:
+        before = timed(lambda i: legacy_find(path, field, mk(i)), legacy_keys)
+        start = time.perf_counter()
+        fn(mk(0))  # first call parses the file and builds the index
+        first = time.perf_counter() - start
+        after = timed(lambda i: fn(mk(i)), hot_keys)
+        rows.append((label, before, first, after))
+    return rows
+
+def run_contention(data_dir, threads, shared_lock):
+    """Reader threads on products.json while one writer appends to transactions.json"""
+    base = importlib.import_module('repositories.repo_base')
+    products_mod = importlib.import_module('repositories.products_repo')
+    tx_mod = importlib.import_module('repositories.transactions_repo')
+
+    original = base._rwlock_for
+    if shared_lock:
+        # Same lock for every file: what the old module-level _lock amounted to
+        one = base._RWLock()
+        base._rwlock_for = lambda path: one
+    try:
+        products = products_mod.ProductsRepo(data_dir)
+        tx = tx_mod.TransactionsRepo(data_dir)
+    finally:
+        base._rwlock_for = original
+
+    stop = threading.Event()
+    reads = [0] * threads
+    writes = [0]
+
+    def reader(slot):
+        i = 0
+        while not stop.is_set():
+            products.get(f'p{i % 1000}')
+            i += 1
+        reads[slot] = i
+
+    def writer():
+        while not stop.is_set():
+            tx.create({'amount': 1.0, 'memo': 'bench', 'idempotency_key': str(writes[0])})
+            writes[0] += 1
+
+    workers = [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+    workers.append(threading.Thread(target=writer))
+    for t in workers:
+        t.start()
+    time.sleep(CONTENTION_SECONDS)
+    stop.set()
+    for t in workers:
+        t.join()
+    return sum(reads) / CONTENTION_SECONDS, writes[0] / CONTENTION_SECONDS
+
+def contention(root, thread_counts):
+    print(f"{'threads':>7}  {'locking':<10}{'reads/s':>12}{'writes/s':>10}")
+    for threads in thread_counts:
+        for label, shared in [('global', True), ('per-file', False)]:
+            data_dir = os.path.join(root, f'contention_{threads}_{label}')
+            os.makedirs(data_dir, exist_ok=True)
+            with open(os.path.join(data_dir, 'products.json'), 'w', encoding='utf-8') as f:
+                json.dump([{'id': f'p{i}', 'store_id': 's1', 'title': f'P {i}', 'price': 10.0, 'stock': 5}
+                           for i in range(1000)], f)
+            with open(os.path.join(data_dir, 'transactions.json'), 'w', encoding='utf-8') as f:
+                json.dump([{'id': f't{i}', 'amount': 1.0, 'memo': 'seed', 'idempotency_key': f's{i}'}
+                           for i in range(5000)], f)
+            r, w = run_contention(data_dir, threads, shared)
+            print(f'{threads:>7}  {label:<10}{r:>12.0f}{w:>10.1f}')
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--contention':
+        with tempfile.TemporaryDirectory() as root:
+            load_repositories(root)
+            contention(root, [int(a) for a in args[1:]] or DEFAULT_THREADS)
+        return 0
+    sizes = [int(a) for a in args] or DEFAULT_SIZES
+    with tempfile.TemporaryDirectory() as root:
+        modules = load_repositories(root)
+        print(f"{'records':>9}  {'lookup':<20}{'before':>12}{'cold':>12}{'after':>12}{'speedup':>10}")
+        for n in sizes:
+            for label, before, first, after in bench_size(modules, root, n):
+                print(f'{n:>9}  {label:<20}{fmt(before):>12}{fmt(first):>12}{fmt(after):>12}{before / after:>9.0f}x')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Record-level change feed shared by server_v2.py and server_simple.py
+Each server passes its own feed_records, which knows its data file layout
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+
+class ChangeFeed:
+    """Record-level changes to the data files, numbered in one sequence
+
+    Every data file the server reads or writes is passed to observe() and
+    compared with the last copy of it seen here, record by record (see the
+    server's feed_records), and each record that appeared, changed or
+    disappeared becomes a change with the next seq. A file seen for the
+    first time only sets the baseline.
+
+    The feed lives in memory: cursors are '<epoch>.<seq>', and a cursor from
+    another process or older than the last `size` changes (the compaction
+    horizon) is answered with reset, meaning: load full snapshots and carry
+    on from the returned cursor.
+    """
+
+    def __init__(self, feed_records, size=10000):
+        self.epoch = f'{int(time.time()):x}{os.urandom(2).hex()}'
+        self._feed_records = feed_records  # (file_path, content) -> (collection, {id: (record, owner)}) or None
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._changes = collections.deque(maxlen=size)
+        self._files = {}  # file_path -> {'version', 'records': {id: (digest, owner)}}
+
+    def cursor(self):
+        with self._lock:
+            return f'{self.epoch}.{self._seq}'
+
+    def observe(self, file_path, content, version=None):
+        """Record what changed in file_path; version None means the content is new, so always compare"""
+        if version is not None:
+            with self._lock:
+                known = self._files.get(file_path)
+                if known is not None and known['version'] == version:
+                    return  # the copy already compared, skip serializing it again
+        fed = self._feed_records(file_path, content)
+        if fed is None:
+            return
+        collection, records = fed
+        texts = {record_id: (json.dumps(record, ensure_ascii=False, sort_keys=True), owner)
+                 for record_id, (record, owner) in records.items()}
+        seen = {record_id: (hashlib.sha1(text.encode('utf-8')).digest(), owner) for record_id, (text, owner) in texts.items()}
+        with self._lock:
+            known = self._files.get(file_path)
+            self._files[file_path] = {'version': version, 'records': seen}
+            if known is None or (version is not None and known['version'] == version):
+                return
+            old = known['records']
+            for record_id, (text, owner) in texts.items():
+                if old.get(record_id) != seen[record_id]:
+                    self._append(collection, record_id, owner, 'put', text)
+            for record_id in old.keys() - seen.keys():
+                self._append(collection, record_id, old[record_id][1], 'delete')
+
+    def since(self, cursor, names, owners, limit):
+        """(changes after cursor, next cursor, more) or None if the cursor is past the horizon"""
+        epoch, _, seq = (cursor or '').partition('.')
+        with self._lock:
+            if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+                return None
+            seq = int(seq)
+            if self._changes and self._changes[0]['seq'] > seq + 1:
+                return None
+            start = max(0, seq - self._changes[0]['seq'] + 1) if self._changes else 0
+            changes, last = [], seq
+            for change in itertools.islice(self._changes, start, None):
+                if len(changes) == limit:
+                    return changes, f'{self.epoch}.{last}', True
+                last = change['seq']
+                if change['collection'] in names and change['owner'] in owners:
+                    changes.append(_public_change(change))
+            return changes, f'{self.epoch}.{self._seq}', False
+
+    def _append(self, collection, record_id, owner, op, text=None):
+        self._seq += 1
+        self._changes.append({'seq': self._seq, 'collection': collection, 'id': record_id, 'op': op,
+                              'owner': owner, 'text': text})
+
+def _public_change(change):
+    public = {key: change[key] for key in ('seq', 'collection', 'id', 'op')}
+    if change['text'] is not None:
+        public['data'] = json.loads(change['text'])
+    return public
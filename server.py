@@ -4,25 +4,39 @@ HomeOS Backend Server with Telegram Bot API Storage
 Хранение данных через Telegram Bot API для многопользовательской системы
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 from flask_cors import CORS
+import base64
+import copy
+import hashlib
 import json
 import os
+import time
+import zlib
 from datetime import datetime
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
 import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import threading
 from functools import wraps
 
 app = Flask(__name__)
-CORS(app)  # Разрешить запросы из браузера
+CORS(app, expose_headers=['X-Collection-Version'])  # Разрешить запросы из браузера
 
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 STORAGE_CHAT_ID = os.getenv('STORAGE_CHAT_ID', 'YOUR_CHAT_ID')  # Приватный канал для хранения
+TELEGRAM_INDEX_PATH = os.getenv('TELEGRAM_INDEX_PATH', 'telegram_index.json')  # Локальное зеркало индекса и значений
+TELEGRAM_MIRROR_TTL = float(os.getenv('TELEGRAM_MIRROR_TTL', '60'))  # Секунд зеркало считается свежим; 0 - сверяться с каналом при каждом обращении
+ASYNC_MODE = os.getenv('ASYNC_MODE', 'loop')  # 'loop': один event loop на процесс, 'per-request': asyncio.run на каждый запрос
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '8'))  # HTTP соединений к Bot API
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+# Инициализация бота: один клиент с пулом соединений, живёт в общем event loop
+bot = Bot(token=BOT_TOKEN, request=HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
 
 # Префиксы для хранения разных типов данных
 STORAGE_KEYS = {
@@ -41,30 +55,623 @@ STORAGE_KEYS = {
     'mywork_tasks': 'MYWORK_TASKS_V2',
     'mywork_running': 'MYWORK_RUNNING_V1'
 }
+DICT_COLLECTIONS = {'bank_notes', 'myinfo_records', 'mywork_shifts', 'mywork_tasks', 'mywork_running'}  # Остальные - списки
+INDEX_KEY = 'INDEX'  # Закреплённое сообщение: ключ -> message_id
+MESSAGE_LIMIT = 4096  # Максимум символов в текстовом сообщении Telegram
+DOCUMENT_THRESHOLD = int(os.getenv('TELEGRAM_DOCUMENT_THRESHOLD', str(16 * 1024)))  # Байт после сжатия, дальше - одним документом
+
+class LoopThread:
+    """Один долгоживущий event loop в отдельном потоке
+
+    Потоки Flask отдают ему корутины и ждут результат, поэтому Bot и его пул
+    соединений всегда работают в одном loop, а не создаются заново на каждый
+    запрос. Корутина выполняется в копии контекста вызывающего потока, так
+    что request и jsonify в ней работают как обычно.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Поток запускается при первом запросе, а не при импорте (reloader в debug режиме)
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='telegram-loop', daemon=True).start()
+                self.loop = loop
+        return self.loop
+
+    def run(self, coro):
+        loop = self._start()
+        context = contextvars.copy_context()
+        done = concurrent.futures.Future()
+
+        def finish(task):
+            if task.cancelled():
+                done.cancel()
+            elif task.exception() is not None:
+                done.set_exception(task.exception())
+            else:
+                done.set_result(task.result())
+
+        def start():
+            loop.create_task(coro, context=context).add_done_callback(finish)
+
+        loop.call_soon_threadsafe(start)
+        return done.result()
+
+loop_thread = LoopThread()
 
 def async_route(f):
     """Декоратор для async функций в Flask"""
     @wraps(f)
     def wrapper(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
+        if ASYNC_MODE == 'per-request':
+            return asyncio.run(f(*args, **kwargs))
+        return loop_thread.run(f(*args, **kwargs))
     return wrapper
 
+# ==================== CODEC ====================
+# Значение: компактный JSON -> zlib -> base85, с контрольной суммой sha256.
+# Небольшое значение лежит в нумерованных текстовых сообщениях
+#   #KEY                                   #KEY
+#   Z1 <checksum> <total> v<version>       Z1 <n>
+#   <часть base85>                         <часть base85>
+# а после DOCUMENT_THRESHOLD байт - одним документом с подписью
+# "#KEY\nZ1 <checksum> doc v<version>". Контрольная сумма и версия есть только
+# в первой части, поэтому при дописывании в конец остальные части не меняются.
+# Сообщения без заголовка Z1 - старый формат, там просто JSON (версия 0).
+# Так же читаются части без версии, где в каждой было "Z1 <checksum> <n>/<total>".
+# Сжимается всё значение одним потоком zlib, поэтому одно изменение сдвигает
+# сжатые байты во всех следующих частях: не редактируются только части до
+# первого изменения, и то лишь пока zlib выдаёт для них те же блоки.
+
+CODEC = 'Z1'
+
+def encode_payload(data):
+    """(компактный JSON текст, сжатые байты, контрольная сумма)"""
+    text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    raw = zlib.compress(text.encode('utf-8'), 9)
+    return text, raw, hashlib.sha256(raw).hexdigest()[:16]
+
+def chunk_texts(key, raw, checksum, version):
+    """Тексты сообщений для сжатого значения"""
+    encoded = base64.b85encode(raw).decode('ascii')
+    size = MESSAGE_LIMIT - len(f'#{key}\n{CODEC} {checksum} 9999 v{version}\n')
+    parts = [encoded[i:i + size] for i in range(0, len(encoded), size)] or ['']
+    texts = [f'#{key}\n{CODEC} {checksum} {len(parts)} v{version}\n{parts[0]}']
+    return texts + [f'#{key}\n{CODEC} {n}\n{part}' for n, part in enumerate(parts[1:], 2)]
+
+def _verify(raw, checksum):
+    if hashlib.sha256(raw).hexdigest()[:16] != checksum:
+        raise ValueError('Checksum mismatch')
+    return zlib.decompress(raw).decode('utf-8')
+
+def decode_chunks(key, texts):
+    """(JSON текст, версия) из сообщений-частей (или одного сообщения старого формата)"""
+    prefix = f'#{key}\n'
+    bodies = [t[len(prefix):] for t in texts if t and t.startswith(prefix)]
+    if len(bodies) != len(texts):
+        raise ValueError(f'Foreign message in {key}')
+    if not bodies[0].startswith(f'{CODEC} '):
+        return bodies[0], 0  # старый формат: JSON как есть
+    header, _, part = bodies[0].partition('\n')
+    fields = header.split(' ')
+    if len(fields) == 3:
+        return _decode_unversioned_chunks(key, bodies), 0
+    _, checksum, total, version = fields
+    if int(total) != len(bodies):
+        raise ValueError(f'Expected {total} chunks of {key}, got {len(bodies)}')
+    parts = [part]
+    for n, body in enumerate(bodies[1:], 2):
+        header, _, part = body.partition('\n')
+        if header != f'{CODEC} {n}':
+            raise ValueError(f'Chunks of {key} are out of order')
+        parts.append(part)
+    return _verify(base64.b85decode(''.join(parts)), checksum), int(version[1:])
+
+def _decode_unversioned_chunks(key, bodies):
+    """Части до появления версий: "Z1 <checksum> <n>/<total>" в каждой"""
+    parts, checksum = [], None
+    for n, body in enumerate(bodies, 1):
+        header, _, part = body.partition('\n')
+        _, chunk_checksum, position = header.split(' ')
+        if position != f'{n}/{len(bodies)}' or checksum not in (None, chunk_checksum):
+            raise ValueError(f'Chunks of {key} are out of order')
+        checksum = chunk_checksum
+        parts.append(part)
+    return _verify(base64.b85decode(''.join(parts)), checksum)
+
+def decode_document(key, caption, raw):
+    """(JSON текст, версия) из документа"""
+    if not caption or not caption.startswith(f'#{key}\n{CODEC} '):
+        raise ValueError(f'Foreign document in {key}')
+    fields = caption.split('\n')[1].split(' ')
+    version = int(fields[3][1:]) if len(fields) > 3 else 0
+    return _verify(bytes(raw), fields[1]), version
+
+# ==================== JSON PATCH ====================
+# Операции RFC 6902: add, remove, replace, move, copy, test. Путь - JSON Pointer
+# ("/0/balance", "/user~1name"), "-" в конце пути к списку - дописать в конец.
+
+class PatchError(ValueError):
+    """Операцию нельзя применить к текущему значению"""
+
+def _pointer(path):
+    if path == '':
+        return []
+    if not isinstance(path, str) or not path.startswith('/'):
+        raise PatchError(f'Invalid path {path!r}')
+    return [token.replace('~1', '/').replace('~0', '~') for token in path[1:].split('/')]
+
+def _list_index(container, token, path, append=False):
+    if append and token == '-':
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchError(f'Invalid list index in {path}')
+    index = int(token)
+    if index > len(container) or (index == len(container) and not append):
+        raise PatchError(f'Index out of range in {path}')
+    return index
+
+def _resolve(doc, tokens, path):
+    for token in tokens:
+        if isinstance(doc, list):
+            doc = doc[_list_index(doc, token, path)]
+        elif isinstance(doc, dict) and token in doc:
+            doc = doc[token]
+        else:
+            raise PatchError(f'Path not found: {path}')
+    return doc
+
+def _add(doc, tokens, value, path):
+    if not tokens:
+        return value
+    parent = _resolve(doc, tokens[:-1], path)
+    if isinstance(parent, list):
+        parent.insert(_list_index(parent, tokens[-1], path, append=True), value)
+    elif isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    else:
+        raise PatchError(f'Path not found: {path}')
+    return doc
+
+def _remove(doc, tokens, path):
+    if not tokens:
+        raise PatchError('Cannot remove the whole value')
+    parent = _resolve(doc, tokens[:-1], path)
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, tokens[-1], path))
+    if isinstance(parent, dict) and tokens[-1] in parent:
+        return parent.pop(tokens[-1])
+    raise PatchError(f'Path not found: {path}')
+
+def apply_patch(data, ops):
+    """Новое значение после операций ops; data не меняется"""
+    if not isinstance(ops, list):
+        raise PatchError('Patch must be a list of operations')
+    doc = copy.deepcopy(data)
+    for op in ops:
+        if not isinstance(op, dict) or 'path' not in op:
+            raise PatchError(f'Invalid operation {op!r}')
+        name, path = op.get('op'), op['path']
+        tokens = _pointer(path)
+        if name in ('add', 'replace', 'test') and 'value' not in op:
+            raise PatchError(f'{name} at {path} needs a value')
+        if name == 'add':
+            doc = _add(doc, tokens, copy.deepcopy(op['value']), path)
+        elif name == 'remove':
+            _remove(doc, tokens, path)
+        elif name == 'replace':
+            if tokens:
+                _remove(doc, tokens, path)
+            doc = _add(doc, tokens, copy.deepcopy(op['value']), path)
+        elif name in ('move', 'copy'):
+            source = _pointer(op.get('from'))
+            if name == 'move' and tokens[:len(source)] == source and tokens != source:
+                raise PatchError(f'Cannot move {op["from"]} into itself')
+            if name == 'move':
+                value = _remove(doc, source, op['from'])
+            else:
+                value = copy.deepcopy(_resolve(doc, source, op['from']))
+            doc = _add(doc, tokens, value, path)
+        elif name == 'test':
+            if _resolve(doc, tokens, path) != op['value']:
+                raise PatchError(f'Test failed at {path}')
+        else:
+            raise PatchError(f'Unknown operation {name!r}')
+    return doc
+
+class VersionConflict(Exception):
+    """Коллекцию изменили после того, как клиент её прочитал"""
+
+    def __init__(self, version):
+        super().__init__(f'Current version is {version}')
+        self.version = version
+
+class TelegramStore:
+    """Хранилище ключ -> JSON в сообщениях канала
+
+    Каждый ключ живёт в своих сообщениях бота (см. CODEC). Значение из одного
+    сообщения при записи редактируется на месте; у значения из нескольких
+    частей изменившиеся части отправляются заново (см. _write). Закреплённое сообщение
+    #INDEX хранит ключ -> [message_id частей] или {'doc': message_id}. Локальное зеркало (файл) хранит индекс и последнее
+    значение каждого ключа, поэтому чтение обычно не ходит в Telegram.
+    Значение из зеркала старше ttl секунд перечитывается из канала вместе с
+    индексом: так видны записи другого экземпляра и правки руками. В пределах
+    ttl два экземпляра могут затереть записи друг друга - если их несколько,
+    ставьте ttl=0. При холодном старте индекс берётся из закреплённого
+    сообщения, а значения подтягиваются по message_id.
+
+    Зеркало - снимок плюс журнал (mirror_path + '.log'): запись дописывает в
+    журнал одну строку про свой ключ, снимок переписывается целиком только
+    раз в JOURNAL_LIMIT строк.
+    """
+
+    JOURNAL_LIMIT = 200  # Строк журнала до переписывания снимка
+
+    def __init__(self, bot, chat_id, mirror_path, ttl=TELEGRAM_MIRROR_TTL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.mirror_path = mirror_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._mirror_lock = threading.Lock()  # Порядок строк журнала и переписывание снимка
+        self._index = {}    # key -> [message_id, ...] | {'doc': message_id}
+        self._values = {}   # key -> JSON текст последнего значения
+        self._versions = {}  # key -> номер версии, растёт с каждой записью
+        self._checked = {}  # key -> time.time() последней сверки с каналом
+        self._chunks = {}   # key -> тексты частей, записанные этим процессом
+        self._key_locks = {}  # key -> threading.Lock, общий для всех event loop процесса
+        self._index_message_id = None
+        self._journal_size = 0
+        self._load_mirror()
+
+    # ---- локальное зеркало ----
+
+    @property
+    def _journal_path(self):
+        return f'{self.mirror_path}.log'
+
+    def _load_mirror(self):
+        try:
+            with open(self.mirror_path, 'r', encoding='utf-8') as f:
+                mirror = json.load(f)
+        except (OSError, ValueError):
+            mirror = {}
+        self._index_message_id = mirror.get('index_message_id')
+        self._index = mirror.get('index', {})
+        self._values = mirror.get('values', {})
+        self._versions = mirror.get('versions', {})
+        self._checked = mirror.get('checked', {})
+        self._replay_journal()
+
+    def _replay_journal(self):
+        """Применить журнал поверх снимка; оборванную последнюю строку отрезать"""
+        try:
+            with open(self._journal_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+        good = 0
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break
+            try:
+                self._apply_record(json.loads(line))
+            except ValueError:
+                break
+            good += len(line)
+            self._journal_size += 1
+        if good < len(data):
+            with open(self._journal_path, 'r+b') as f:
+                f.truncate(good)
+
+    def _apply_record(self, record):
+        if 'key' in record:
+            key = record['key']
+            self._values[key] = record['value']
+            self._versions[key] = record['version']
+            self._checked[key] = record['checked']
+            if record['entry']:
+                self._index[key] = record['entry']
+        else:
+            self._index = record['index']
+        self._index_message_id = record['index_message_id']
+
+    def _key_record(self, key):
+        with self._lock:
+            return {'key': key, 'entry': self._index.get(key), 'value': self._values[key],
+                    'version': self._versions[key], 'checked': self._checked[key],
+                    'index_message_id': self._index_message_id}
+
+    def _index_record(self):
+        with self._lock:
+            return {'index': dict(self._index), 'index_message_id': self._index_message_id}
+
+    def _append_mirror(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._mirror_lock:
+            with open(self._journal_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self._journal_size += 1
+            if self._journal_size >= self.JOURNAL_LIMIT:
+                self._save_mirror()
+
+    def _save_mirror(self):
+        """Переписать снимок и очистить журнал (под _mirror_lock)"""
+        with self._lock:
+            mirror = {'index_message_id': self._index_message_id, 'index': dict(self._index),
+                      'values': dict(self._values), 'versions': dict(self._versions),
+                      'checked': dict(self._checked)}
+        tmp = f'{self.mirror_path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(mirror, f, ensure_ascii=False)
+        os.replace(tmp, self.mirror_path)
+        # Упадём здесь - журнал применится к новому снимку ещё раз, это безвредно
+        open(self._journal_path, 'w').close()
+        self._journal_size = 0
+
+    # ---- индекс ----
+
+    def _index_text(self):
+        with self._lock:
+            return f"#{INDEX_KEY}\n{json.dumps(self._index, separators=(',', ':'))}"
+
+    async def _ensure_index(self, refresh=False):
+        """Найти закреплённый индекс или создать его
+
+        refresh: перечитать закреплённый индекс, даже если он уже известен -
+        другой экземпляр мог перенести ключ в новые сообщения.
+        """
+        if self._index_message_id and not refresh:
+            return
+        chat = await self.bot.get_chat(self.chat_id)
+        pinned = chat.pinned_message
+        if pinned and pinned.text and pinned.text.startswith(f'#{INDEX_KEY}\n'):
+            index = json.loads(pinned.text[len(INDEX_KEY) + 2:])
+            with self._lock:
+                changed = (pinned.message_id != self._index_message_id
+                           or any(self._index.get(key) != entry for key, entry in index.items()))
+                self._index.update(index)
+                self._index_message_id = pinned.message_id
+        else:
+            await self._send_index()
+            changed = True
+        if changed:
+            self._append_mirror(self._index_record())
+
+    async def _send_index(self):
+        message = await self.bot.send_message(chat_id=self.chat_id, text=self._index_text())
+        await self.bot.pin_chat_message(chat_id=self.chat_id, message_id=message.message_id, disable_notification=True)
+        self._index_message_id = message.message_id
+
+    async def _write_index(self):
+        try:
+            await self.bot.edit_message_text(self._index_text(), chat_id=self.chat_id, message_id=self._index_message_id)
+        except BadRequest as e:
+            if not _not_modified(e):
+                await self._send_index()  # индекс удалили из канала
+
+    # ---- значения ----
+
+    async def _read_message(self, message_id):
+        """Сообщение по id: пересылаем его в тот же чат и сразу удаляем копию"""
+        copy = await self.bot.forward_message(chat_id=self.chat_id, from_chat_id=self.chat_id, message_id=message_id)
+        await self.bot.delete_message(chat_id=self.chat_id, message_id=copy.message_id)
+        return copy
+
+    async def _fetch(self, key, entry):
+        if isinstance(entry, dict):
+            message = await self._read_message(entry['doc'])
+            file = await self.bot.get_file(message.document.file_id)
+            return decode_document(key, message.caption, await file.download_as_bytearray())
+        return decode_chunks(key, [(await self._read_message(message_id)).text for message_id in _entry_ids(entry)])
+
+    async def _scan_updates(self, key):
+        """Старый способ: ключ, записанный до индекса, ищем в последних обновлениях"""
+        prefix = f'#{key}\n'
+        updates = await self.bot.get_updates(limit=100)
+        for update in reversed(updates):
+            post = update.channel_post
+            if post and post.text and post.text.startswith(prefix):
+                return decode_chunks(key, [post.text])[0], post.message_id
+        return None, None
+
+    async def get(self, key):
+        return (await self.get_versioned(key))[0]
+
+    async def get_versioned(self, key):
+        """(данные, версия); у ключа, которого ещё нет, версия 0
+
+        Значение из зеркала старше ttl сверяется с сообщениями по индексу.
+        """
+        with self._lock:
+            known = self._values.get(key)
+            known_version = self._versions.get(key, 0)
+            fresh = time.time() - self._checked.get(key, 0) < self.ttl
+        if known is not None and fresh:
+            return json.loads(known), known_version
+        await self._ensure_index(refresh=known is not None)
+        with self._lock:
+            entry = self._index.get(key)
+        text, version = known, known_version
+        if entry:
+            try:
+                text, version = await self._fetch(key, entry)
+            except (BadRequest, ValueError):
+                if known is None:
+                    raise
+                # сообщение удалили из канала или части не сходятся: остаётся
+                # локальная копия, запись создаст сообщения заново
+                with self._lock:
+                    self._chunks.pop(key, None)
+        elif known is None:
+            text, message_id = await self._scan_updates(key)
+            if message_id:
+                with self._lock:
+                    self._index[key] = [message_id]
+                await self._write_index()
+        if text is None:
+            return None, 0
+        with self._lock:
+            changed = (text, version) != (known, known_version)
+            if changed:
+                self._chunks.pop(key, None)  # части в канале уже не те, что писали мы
+            self._values[key] = text
+            self._versions[key] = version
+            self._checked[key] = time.time()
+        if changed:
+            self._append_mirror(self._key_record(key))
+        return json.loads(text), version
+
+    async def set(self, key, data, expected_version=None):
+        """Записать значение; возвращает новую версию. VersionConflict, если expected_version устарела"""
+        async with self._key_lock(key):
+            _, version = await self.get_versioned(key)
+            if expected_version is not None and expected_version != version:
+                raise VersionConflict(version)
+            return await self._write(key, data, version + 1)
+
+    async def patch(self, key, expected_version, ops, default=None):
+        """Применить JSON Patch к текущему значению (или default, если ключа нет); возвращает новую версию"""
+        async with self._key_lock(key):
+            data, version = await self.get_versioned(key)
+            if expected_version != version:
+                raise VersionConflict(version)
+            return await self._write(key, apply_patch(default if data is None else data, ops), version + 1)
+
+    @contextlib.asynccontextmanager
+    async def _key_lock(self, key):
+        """Запись ключа по одной на процесс
+
+        asyncio.Lock привязан к своему loop, а в режиме per-request у каждого
+        запроса свой loop - поэтому threading.Lock. Ждём его в пуле потоков,
+        чтобы не блокировать общий loop в режиме 'loop'.
+        """
+        with self._lock:
+            lock = self._key_locks.setdefault(key, threading.Lock())
+        if not lock.acquire(blocking=False):
+            acquiring = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+            try:
+                await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                acquiring.add_done_callback(lambda _: lock.release())  # нас отменили, а поток всё равно дождётся замка
+                raise
+        try:
+            yield
+        finally:
+            lock.release()
+
+    async def _write(self, key, data, version):
+        """Новые сообщения отправляются рядом со старыми, индекс переключается
+        на них одной правкой и только потом старые удаляются: оборванная
+        запись оставляет в канале прежнее значение целиком.
+        """
+        text, raw, checksum = encode_payload(data)
+        await self._ensure_index()
+        with self._lock:
+            entry = self._index.get(key)
+        previous = self._chunks.pop(key, [])  # вернём, только если запись дойдёт до конца
+        if len(raw) > DOCUMENT_THRESHOLD:
+            texts = None
+            new_entry = await self._write_document(key, raw, checksum, version)
+        else:
+            texts = chunk_texts(key, raw, checksum, version)
+            new_entry = await self._write_chunks(texts, entry, previous)
+        sent = [m for m in _entry_ids(new_entry) if m not in _entry_ids(entry)]
+        if new_entry != entry:
+            with self._lock:
+                self._index[key] = new_entry
+            try:
+                await self._write_index()
+            except Exception:
+                with self._lock:
+                    self._index[key] = entry
+                await self._discard(sent)
+                raise
+            await self._delete([m for m in _entry_ids(entry) if m not in _entry_ids(new_entry)])
+        if texts is not None:
+            self._chunks[key] = texts
+        with self._lock:
+            self._values[key] = text
+            self._versions[key] = version
+            self._checked[key] = time.time()
+        self._append_mirror(self._key_record(key))
+        return version
+
+    async def _write_chunks(self, texts, entry, previous):
+        """Новая запись индекса для частей texts; старые сообщения удаляет _write
+
+        Значение из одного сообщения, которое и было одним, правится на месте -
+        одна правка не бывает оборванной. Иначе изменившиеся части уходят
+        новыми сообщениями, а части, совпавшие с previous (тексты прошлой
+        записи этого процесса), остаются как были.
+        """
+        old = [] if isinstance(entry, dict) else _entry_ids(entry)
+        if len(texts) == 1 and len(old) == 1:
+            if previous[:1] == texts:
+                return old
+            try:
+                await self.bot.edit_message_text(texts[0], chat_id=self.chat_id, message_id=old[0])
+                return old
+            except BadRequest as e:
+                if _not_modified(e):
+                    return old
+                # сообщение удалили, пишем заново
+        ids = []
+        try:
+            for n, text in enumerate(texts):
+                if n < len(old) and n < len(previous) and previous[n] == text:
+                    ids.append(old[n])
+                else:
+                    ids.append((await self.bot.send_message(chat_id=self.chat_id, text=text)).message_id)
+        except Exception:
+            await self._discard([m for m in ids if m not in old])
+            raise
+        return ids
+
+    async def _write_document(self, key, raw, checksum, version):
+        """Документ нельзя отредактировать текстом, поэтому всегда отправляем новый"""
+        message = await self.bot.send_document(
+            chat_id=self.chat_id, document=raw, filename=f'{key}.json.z',
+            caption=f'#{key}\n{CODEC} {checksum} doc v{version}', disable_notification=True
+        )
+        return {'doc': message.message_id}
+
+    async def _discard(self, message_ids):
+        """Убрать сообщения оборванной записи; не вышло - останутся сиротами вне индекса"""
+        try:
+            await self._delete(message_ids)
+        except TelegramError as e:
+            print(f"Error discarding Telegram messages {message_ids}: {e}")
+
+    async def _delete(self, message_ids):
+        for message_id in message_ids:
+            try:
+                await self.bot.delete_message(chat_id=self.chat_id, message_id=message_id)
+            except BadRequest:
+                pass  # уже удалено
+
+def _entry_ids(entry):
+    """Все message_id записи индекса (в зеркале до сжатия там было одно число)"""
+    if isinstance(entry, dict):
+        return [entry['doc']]
+    if isinstance(entry, list):
+        return entry
+    return [entry] if entry else []
+
+def _not_modified(error):
+    return 'message is not modified' in str(error).lower()
+
+store = TelegramStore(bot, STORAGE_CHAT_ID, TELEGRAM_INDEX_PATH)
+
 async def telegram_get(key):
-    """Получить данные из Telegram"""
+    """Получить данные из Telegram; версия уходит в заголовок X-Collection-Version"""
     try:
-        # Ищем сообщение с нужным ключом в закрепленных
-        message_text = f"#{key}\n"
-        
-        # Получаем последние сообщения из канала
-        updates = await bot.get_updates(limit=100)
-        
-        for update in reversed(updates):
-            if update.channel_post and update.channel_post.text:
-                if update.channel_post.text.startswith(message_text):
-                    data_json = update.channel_post.text[len(message_text):]
-                    return json.loads(data_json)
-        
-        return None
+        data, g.collection_version = await store.get_versioned(key)
+        return data
     except Exception as e:
         print(f"Error reading from Telegram: {e}")
         return None
@@ -72,19 +679,48 @@ async def telegram_get(key):
 async def telegram_set(key, data):
     """Сохранить данные в Telegram"""
     try:
-        message_text = f"#{key}\n{json.dumps(data, ensure_ascii=False, indent=2)}"
-        
-        # Отправляем новое сообщение
-        await bot.send_message(
-            chat_id=STORAGE_CHAT_ID,
-            text=message_text
-        )
-        
+        await store.set(key, data)
         return True
-    except TelegramError as e:
+    except (TelegramError, ValueError) as e:  # ValueError: части в канале не сходятся, а зеркала нет
         print(f"Error writing to Telegram: {e}")
         return False
 
+@app.after_request
+def add_collection_version(response):
+    version = g.pop('collection_version', None)
+    if version is not None:
+        response.headers['X-Collection-Version'] = str(version)
+    return response
+
+# ==================== PATCH API ====================
+
+@app.route('/api/<section>/<name>', methods=['PATCH'])
+@async_route
+async def patch_collection(section, name):
+    """Изменить коллекцию JSON Patch'ем: {"version": N, "ops": [...]}
+
+    N - версия из X-Collection-Version последнего GET (или ответа PATCH).
+    Если коллекцию с тех пор изменили, ответ 409 с текущей версией.
+    """
+    collection = f'{section}_{name}'
+    if collection not in STORAGE_KEYS:
+        return jsonify({'success': False, 'error': 'Unknown collection'}), 404
+    body = request.get_json(silent=True)
+    version = body.get('version') if isinstance(body, dict) else None
+    if not isinstance(version, int) or isinstance(version, bool):
+        return jsonify({'success': False, 'error': 'version is required'}), 400
+    default = {} if collection in DICT_COLLECTIONS else []
+    try:
+        version = await store.patch(STORAGE_KEYS[collection], version, body.get('ops'), default)
+    except VersionConflict as e:
+        return jsonify({'success': False, 'error': 'Version conflict', 'version': e.version}), 409
+    except PatchError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except TelegramError as e:
+        print(f"Error writing to Telegram: {e}")
+        return jsonify({'success': False})
+    return jsonify({'success': True, 'version': version})
+
 # ==================== BANK API ====================
 
 @app.route('/api/bank/users', methods=['GET'])
@@ -312,7 +948,8 @@ def health_check():
         'status': 'ok',
         'timestamp': datetime.now().isoformat(),
         'bot_configured': BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE',
-        'storage_configured': STORAGE_CHAT_ID != 'YOUR_CHAT_ID'
+        'storage_configured': STORAGE_CHAT_ID != 'YOUR_CHAT_ID',
+        'async_mode': ASYNC_MODE
     })
 
 @app.route('/api/init', methods=['POST'])
@@ -11,9 +11,15 @@ import json
 import os
 import hashlib
 import hmac
+import bisect
+import itertools
+import shutil
+import threading
+import time
 from datetime import datetime
 from urllib.parse import unquote
 from functools import wraps
+from change_feed import ChangeFeed
 
 # Fix Windows encoding
 if os.name == 'nt':
@@ -29,6 +35,10 @@ CORS(app, supports_credentials=True, origins=['*'])
 # Configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 DATA_DIR = 'server_data'  # Local data directory
+HISTORY_SEGMENT_SIZE = int(os.getenv('HISTORY_SEGMENT_SIZE', '10000'))  # Bank history entries per segment file
+HISTORY_PAGE_MAX = 500  # Largest /api/bank/history page
+CHANGE_FEED_SIZE = int(os.getenv('CHANGE_FEED_SIZE', '10000'))  # Record changes kept for /api/changes
+CHANGES_PAGE_MAX = 1000  # Largest /api/changes page
 
 # Create data directory if it doesn't exist
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -57,7 +67,10 @@ def get_data(filename):
     try:
         if os.path.exists(filepath):
             with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                data = json.load(f)
+                change_feed.observe(filename, data, os.fstat(f.fileno()).st_mtime_ns)
+                return data
+        change_feed.observe(filename, None)
         return None
     except Exception as e:
         print(f"Error reading {filename}: {e}")
@@ -69,11 +82,232 @@ def save_data(filename, data):
     try:
         with open(filepath, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        change_feed.observe(filename, data)
         return True
     except Exception as e:
         print(f"Error writing {filename}: {e}")
         return False
 
+# ==================== CHANGE FEED ====================
+
+# Collections in the feed. Shared ones go to every user; private ones
+# (owner set) only to their owner, the same way their GET endpoints filter.
+FEED_COLLECTIONS = ('bank_users', 'shop_products', 'mywork_shifts', 'myinfo_records')
+
+def feed_records(filename, content):
+    """(collection, {record id: (record, owner)}) for a data file in the feed, else None"""
+    if filename == 'bank_users.json':
+        return 'bank_users', {u.get('telegram_id') or u.get('username'): (u, None) for u in content or []}
+    if filename == 'shop_products.json':
+        return 'shop_products', {p['id']: (p, None) for p in content or [] if 'id' in p}
+    if filename in ('mywork_shifts.json', 'myinfo_records.json'):
+        # Keyed and owned by username
+        return filename[:-len('.json')], {username: (data, username) for username, data in (content or {}).items()}
+    return None
+
+change_feed = ChangeFeed(feed_records, CHANGE_FEED_SIZE)
+
+# ==================== HISTORY LOG ====================
+
+class HistoryLog:
+    """Append-only JSONL log split into numbered segment files
+
+    append() writes one line to the active segment, and a new segment starts
+    every segment_size entries. reverse() reads segments backwards from the
+    end of the file, so the latest entries cost the same however long the
+    history is. A legacy newest-first JSON list is imported on first use.
+
+    An entry's position is [segment, byte offset]. Positions only grow, so
+    they double as pagination cursors. The log keeps an in-memory index from
+    username to the positions of that user's entries. It is built with one
+    pass at startup and kept current by append().
+    """
+
+    BLOCK = 64 * 1024
+
+    def __init__(self, directory, segment_size=10000, legacy=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._index = {}  # username -> [{'pos', 'time', 'dir'}], oldest first
+        os.makedirs(directory, exist_ok=True)
+        if legacy and os.path.exists(legacy) and not self._list_segments():
+            self._import(legacy)
+        self._segments = self._list_segments()
+        self._count = 0
+        for number in self._segments:
+            self._count = 0
+            for position, entry in self._scan(number):
+                self._add_to_index(position, entry)
+                self._count += 1
+
+    def _path(self, number, directory=None):
+        return os.path.join(directory or self.directory, f'{number:06d}.jsonl')
+
+    def _list_segments(self):
+        return sorted(int(name[:-6]) for name in os.listdir(self.directory) if name.endswith('.jsonl'))
+
+    def _import(self, legacy):
+        """Turn the legacy newest-first list into segments
+
+        They are written to a scratch directory that replaces the (empty) log
+        directory at the end, so a crash mid-import leaves no partial log
+        behind and the next start imports the whole file again.
+        """
+        with open(legacy, 'r', encoding='utf-8') as f:
+            entries = (json.load(f) or [])[::-1]
+        scratch = self.directory + '.import'
+        shutil.rmtree(scratch, ignore_errors=True)
+        os.makedirs(scratch)
+        for start in range(0, len(entries), self.segment_size):
+            with open(self._path(start // self.segment_size + 1, scratch), 'wb') as f:
+                for entry in entries[start:start + self.segment_size]:
+                    f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+        os.rmdir(self.directory)
+        os.replace(scratch, self.directory)
+        os.replace(legacy, legacy + '.imported')
+        print(f"[*] Imported {len(entries)} history entries from {legacy}")
+
+    def _write(self, entry):
+        if not self._segments or self._count >= self.segment_size:
+            self._segments.append(self._segments[-1] + 1 if self._segments else 1)
+            self._count = 0
+        with open(self._path(self._segments[-1]), 'ab') as f:
+            position = [self._segments[-1], f.tell()]
+            f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._count += 1
+        self._add_to_index(position, entry)
+        return position
+
+    def _add_to_index(self, position, entry):
+        sender, recipient = entry.get('from'), entry.get('to')
+        for username, direction in ((sender, 'out'), (recipient, 'in')):
+            if username is None:
+                continue
+            if sender == recipient:
+                direction = 'self'
+            items = self._index.setdefault(username, [])
+            if not items or items[-1]['pos'] != position:
+                items.append({'pos': position, 'time': entry.get('time', ''), 'dir': direction})
+
+    def _scan(self, number):
+        """(position, entry) pairs of a segment, oldest first
+
+        A line without its newline is what a crash mid-append leaves behind;
+        it and anything after it is cut off the file once the scan gets there,
+        so the next append starts on a line of its own.
+        """
+        path = self._path(number)
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('unterminated entry')
+                    entry = json.loads(line) if line.strip() else None
+                except ValueError:
+                    break
+                if entry is not None:
+                    yield [number, offset], entry
+                offset += len(line)
+        if offset < os.path.getsize(path):
+            print(f"[!] Dropping a torn entry at the end of {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def append(self, entry):
+        with self._lock:
+            return self._write(entry)
+
+    def reverse(self, before=None):
+        """(position, entry) pairs newest first; before: only entries older than this position"""
+        with self._lock:
+            segments = list(self._segments)
+            end = os.path.getsize(self._path(segments[-1])) if segments else 0
+        for number in reversed(segments):
+            if before and number > before[0]:
+                continue
+            path = self._path(number)
+            limit = end if number == segments[-1] else os.path.getsize(path)
+            if before and number == before[0]:
+                limit = min(limit, before[1])
+            for offset, line in self._reverse_lines(path, limit):
+                yield [number, offset], json.loads(line)
+
+    def latest(self, limit, match=None):
+        entries = (e for _, e in self.reverse() if match is None or match(e))
+        return list(itertools.islice(entries, limit))
+
+    def page(self, username, before=None, limit=100, from_date=None, to_date=None, direction=None):
+        """(position, entry) pairs of one user's history, newest first, via the index"""
+        with self._lock:
+            items = self._index.get(username, [])
+            end = len(items)
+            if before:
+                end = bisect.bisect_left(items, tuple(before), key=lambda i: tuple(i['pos']))
+            if to_date:
+                end = min(end, bisect.bisect_right(items, to_date, key=lambda i: i['time'][:len(to_date)]))
+            picked = []
+            for item in reversed(items[:end]):
+                if from_date and item['time'] < from_date:
+                    break  # the log is in time order, everything further is older
+                if direction and item['dir'] not in (direction, 'self'):
+                    continue
+                picked.append(item['pos'])
+                if len(picked) == limit:
+                    break
+        return list(zip(picked, self.read(picked)))
+
+    def read(self, positions):
+        """Entries at positions"""
+        entries, files = [], {}
+        try:
+            for number, offset in positions:
+                if number not in files:
+                    files[number] = open(self._path(number), 'rb')
+                files[number].seek(offset)
+                entries.append(json.loads(files[number].readline()))
+        finally:
+            for f in files.values():
+                f.close()
+        return entries
+
+    def clear(self):
+        with self._lock:
+            for number in self._segments:
+                os.remove(self._path(number))
+            self._segments = []
+            self._count = 0
+            self._index = {}
+
+    def _reverse_lines(self, path, end):
+        """(offset, line) pairs of the complete lines before `end`, last first, read in blocks from the end"""
+        with open(path, 'rb') as f:
+            tail = b''  # start of a line cut by the previous block
+            while end > 0:
+                start = max(0, end - self.BLOCK)
+                f.seek(start)
+                lines = (f.read(end - start) + tail).split(b'\n')
+                tail = lines.pop(0) if start > 0 else b''
+                offset = start + len(tail) + 1 if start > 0 else 0
+                starts = []
+                for line in lines:
+                    starts.append(offset)
+                    offset += len(line) + 1
+                for line_start, line in zip(reversed(starts), reversed(lines)):
+                    if line:
+                        yield line_start, line.decode('utf-8')
+                end = start
+
+history = HistoryLog(os.path.join(DATA_DIR, 'bank_history'), HISTORY_SEGMENT_SIZE,
+                     legacy=os.path.join(DATA_DIR, 'bank_history.json'))
+
 # ==================== AUTHENTICATION ====================
 
 def verify_telegram_auth(init_data_raw):
@@ -236,26 +470,39 @@ def bank_transfer():
     to_user['balance'] += amount
     save_data('bank_users.json', users)
     
-    history = get_data('bank_history.json') or []
-    history.insert(0, {
+    history.append({
         'time': datetime.now().isoformat(),
         'from': from_user['username'],
         'to': to_user['username'],
         'amount': amount,
         'comment': comment
     })
-    save_data('bank_history.json', history)
     
     return jsonify({'success': True, 'balance': from_user['balance']})
 
 @app.route('/api/bank/history', methods=['GET'])
 @require_auth
 def get_bank_history():
-    """Get history"""
-    history = get_data('bank_history.json') or []
-    my_username = session['username']
-    my_history = [h for h in history if h['from'] == my_username or h['to'] == my_username]
-    return jsonify(my_history[:100])
+    """Get history, newest first
+
+    Query: limit (default 100), before=<cursor of the last entry seen>,
+    from_date / to_date (ISO dates, inclusive), direction=in|out.
+    """
+    try:
+        before = request.args.get('before')
+        if before:
+            segment, _, offset = before.partition('.')
+            before = [int(segment), int(offset)]
+        limit = int(request.args.get('limit', 100))
+        direction = request.args.get('direction')
+        if not 1 <= limit <= HISTORY_PAGE_MAX or direction not in (None, 'in', 'out'):
+            raise ValueError
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
+    
+    page = history.page(session['username'], before, limit,
+                        request.args.get('from_date'), request.args.get('to_date'), direction)
+    return jsonify([dict(entry, cursor=f'{position[0]}.{position[1]}') for position, entry in page])
 
 # ==================== SHOP API ====================
 
@@ -382,6 +629,40 @@ def save_myinfo_records():
     save_data('myinfo_records.json', records)
     return jsonify({'success': True})
 
+# ==================== CHANGES API ====================
+
+@app.route('/api/changes', methods=['GET'])
+@require_auth
+def get_changes():
+    """Records created, updated or deleted since a cursor
+
+    Query: since=<cursor from the previous response>, collections=a,b
+    (default: all of FEED_COLLECTIONS), limit (default and max 1000).
+    Returns {'changes': [{seq, collection, id, op: put|delete, data}],
+    'cursor', 'more'}. Without since, or with a cursor past the compaction
+    horizon, returns {'reset': True, 'cursor'}: reload the collections with
+    their GET endpoints and continue from that cursor.
+    """
+    names = request.args.get('collections')
+    names = names.split(',') if names else list(FEED_COLLECTIONS)
+    try:
+        limit = int(request.args.get('limit', CHANGES_PAGE_MAX))
+        if any(name not in FEED_COLLECTIONS for name in names) or not 1 <= limit <= CHANGES_PAGE_MAX:
+            raise ValueError
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
+    
+    # Sets the baseline for files not read since startup
+    for name in names:
+        get_data(f'{name}.json')
+    
+    owners = {None, session['user_id'], session['username']}
+    page = change_feed.since(request.args.get('since'), set(names), owners, limit)
+    if page is None:
+        return jsonify({'reset': True, 'cursor': change_feed.cursor()})
+    changes, cursor, more = page
+    return jsonify({'changes': changes, 'cursor': cursor, 'more': more})
+
 # ==================== HEALTH & INIT ====================
 
 @app.route('/api/health', methods=['GET'])
@@ -401,7 +682,7 @@ def initialize_storage():
     try:
         save_data('users.json', [])
         save_data('bank_users.json', [])
-        save_data('bank_history.json', [])
+        history.clear()
         save_data('shop_products.json', [
             {'id': 1, 'title': 'Смартфон Premium', 'description': 'Флагманский смартфон', 'price': 2500, 'stock': 5, 'category': 'electronics', 'icon': '📱', 'soldCount': 0},
             {'id': 2, 'title': 'Ноутбук Pro', 'description': 'Мощный ноутбук', 'price': 5000, 'stock': 3, 'category': 'electronics', 'icon': '💻', 'soldCount': 0},
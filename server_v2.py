@@ -4,17 +4,31 @@ HomeOS Multi-User Backend Server with GitHub Storage
 Stores all data in GitHub repository for true multi-user support
 """
 
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, g, has_app_context, request, jsonify, session, stream_with_context
 from flask_cors import CORS
 import json
 import os
+import sys
 import base64
+import copy
 import hashlib
 import hmac
+import bisect
+import collections
+import itertools
+import posixpath
+import queue
+import atexit
+import random
+import threading
+import time
 from datetime import datetime
-from urllib.parse import unquote
+from urllib.parse import unquote, urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.test import EnvironBuilder
 from functools import wraps
+from change_feed import ChangeFeed
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'change-this-secret-key-in-production')
@@ -26,6 +40,21 @@ GITHUB_TOKEN = os.getenv('GITHUB_TOKEN', 'YOUR_GITHUB_TOKEN_HERE')
 GITHUB_REPO = os.getenv('GITHUB_REPO', 'username/repo')  # Format: "username/repository"
 GITHUB_BRANCH = os.getenv('GITHUB_BRANCH', 'main')
 DATA_PATH = 'data'  # Path in repository where data will be stored
+GITHUB_CACHE_TTL = float(os.getenv('GITHUB_CACHE_TTL', '2'))  # Seconds a read is served from memory before revalidating
+GITHUB_MAX_CONCURRENCY = int(os.getenv('GITHUB_MAX_CONCURRENCY', '8'))  # Parallel GitHub requests per process
+GITHUB_MAX_RETRIES = int(os.getenv('GITHUB_MAX_RETRIES', '4'))
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '0') == '1'  # Journal writes locally and push to GitHub in the background
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', 'write_behind.journal')
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '2'))  # Seconds between background pushes
+STORAGE_LAYOUT = os.getenv('STORAGE_LAYOUT', 'flat')  # 'flat' (one file per dataset) or 'sharded' (per-user files)
+HISTORY_SEGMENT_SIZE = int(os.getenv('HISTORY_SEGMENT_SIZE', '500'))  # Bank history entries per segment file
+HISTORY_PAGE_MAX = 500  # Largest /api/bank/history page
+CHANGE_FEED_SIZE = int(os.getenv('CHANGE_FEED_SIZE', '10000'))  # Record changes kept for /api/changes
+CHANGES_PAGE_MAX = 1000  # Largest /api/changes page
+EVENT_BUFFER_SIZE = int(os.getenv('EVENT_BUFFER_SIZE', '1000'))  # Recent events kept for Last-Event-ID resume
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))  # Seconds between keep-alive comments on /api/events
+EVENTS_MAX_STREAMS = int(os.getenv('EVENTS_MAX_STREAMS', '32'))  # Open /api/events streams; keep below the worker's thread count
+BATCH_MAX = 20  # Sub-requests per /api/batch
 
 # GitHub API Base URL
 GITHUB_API = 'https://api.github.com'
@@ -64,44 +93,258 @@ TRANSLATIONS = {
 
 # ==================== GITHUB STORAGE ====================
 
-def github_get_file(file_path):
-    """Get file content from GitHub"""
+class GitHubClient:
+    """Pooled, rate-limit-aware client for the GitHub REST API
+
+    One keep-alive Session shared by all request threads, at most
+    max_concurrency requests in flight, retries with exponential backoff and
+    jitter on 5xx, on 409 for writes (except a Contents API sha mismatch,
+    which no retry can fix) and on secondary rate limits, and pacing that
+    spreads the remaining quota over the time left until it resets instead
+    of running into 403s.
+    """
+
+    def __init__(self, token, max_concurrency=8, max_retries=4, backoff=0.5,
+                 low_quota=200, max_wait=60, timeout=(5, 30)):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'token {token}',
+            'Accept': 'application/vnd.github.v3+json'
+        })
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.low_quota = low_quota  # start pacing below this many remaining requests
+        self.max_wait = max_wait    # longest single pause before giving up on a request
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._remaining = None
+        self._reset_at = 0.0        # epoch seconds, from X-RateLimit-Reset
+        self._blocked_until = 0.0   # epoch seconds, from Retry-After / exhausted quota
+        self._next_slot = 0.0       # epoch seconds, last start handed out by _pace
+        self._stats = {}
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        label = self._label(method, url)
+        attempt = 0
+        while True:
+            self._pace()
+            started = time.perf_counter()
+            try:
+                with self._slots:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(label, time.perf_counter() - started, error=True)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self._record_retry(label)
+                time.sleep(self._backoff_delay(attempt))
+                continue
+
+            self._record(label, time.perf_counter() - started, error=response.status_code >= 400)
+            self._update_quota(response)
+            delay = self._retry_delay(method, response, attempt)
+            if delay is None or attempt >= self.max_retries:
+                return response
+            attempt += 1
+            self._record_retry(label)
+            time.sleep(delay)
+
+    def stats(self):
+        """Per-endpoint call counts and latencies, plus the last seen quota"""
+        with self._lock:
+            calls = {}
+            for label, s in self._stats.items():
+                calls[label] = {
+                    'calls': s['calls'],
+                    'errors': s['errors'],
+                    'retries': s['retries'],
+                    'avg_ms': round(s['total'] / s['calls'] * 1000, 1) if s['calls'] else 0,
+                    'max_ms': round(s['max'] * 1000, 1)
+                }
+            return {'rate_limit_remaining': self._remaining, 'calls': calls}
+
+    # ---- internals ----
+
+    @staticmethod
+    def _label(method, url):
+        # "GET contents", "POST git/trees": endpoint kind without repo or file path
+        parts = urlparse(url).path.strip('/').split('/')
+        if len(parts) >= 4 and parts[0] == 'repos':
+            rest = parts[3:]
+            kind = '/'.join(rest[:2]) if rest[0] == 'git' else rest[0]
+        else:
+            kind = '/'.join(parts[:1])
+        return f"{method} {kind}"
+
+    def _record(self, label, elapsed, error=False):
+        with self._lock:
+            s = self._stats.setdefault(label, {'calls': 0, 'errors': 0, 'retries': 0, 'total': 0.0, 'max': 0.0})
+            s['calls'] += 1
+            s['errors'] += int(error)
+            s['total'] += elapsed
+            s['max'] = max(s['max'], elapsed)
+
+    def _record_retry(self, label):
+        with self._lock:
+            self._stats[label]['retries'] += 1
+
+    def _backoff_delay(self, attempt):
+        return self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def _update_quota(self, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        with self._lock:
+            if remaining is not None:
+                self._remaining = int(remaining)
+            if reset is not None:
+                self._reset_at = float(reset)
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and response.status_code in (403, 429):
+                self._blocked_until = max(self._blocked_until, time.time() + float(retry_after))
+            elif response.status_code in (403, 429) and self._remaining == 0:
+                self._blocked_until = max(self._blocked_until, self._reset_at)
+
+    def _retry_delay(self, method, response, attempt):
+        """Seconds to wait before retrying, or None if the response is final"""
+        status = response.status_code
+        if status >= 500:
+            return self._backoff_delay(attempt + 1)
+        if status == 409 and method != 'GET':
+            # "<path> does not match <sha>": the file moved on, the caller has to re-read
+            if 'does not match' in response.text:
+                return None
+            return self._backoff_delay(attempt + 1)
+        if status in (403, 429):
+            limited = (response.headers.get('Retry-After') or response.headers.get('X-RateLimit-Remaining') == '0'
+                       or 'rate limit' in response.text.lower())
+            if not limited:
+                return None
+            with self._lock:
+                wait = self._blocked_until - time.time()
+            if wait > self.max_wait:
+                return None
+            # Secondary limits without Retry-After: GitHub asks for at least a minute,
+            # but back off exponentially first in case it was a short burst
+            return max(wait, self._backoff_delay(attempt + 1))
+        return None
+
+    def _pace(self):
+        with self._lock:
+            now = time.time()
+            wait = self._blocked_until - now
+            if wait <= 0 and self._remaining is not None and self._remaining < self.low_quota and self._reset_at > now:
+                # Spread what's left of the quota evenly over the time until reset.
+                # Each caller reserves the slot after the last one handed out, so
+                # concurrent threads are spaced out instead of waking together.
+                interval = (self._reset_at - now) / max(self._remaining, 1)
+                self._next_slot = max(now, self._next_slot) + interval
+                wait = self._next_slot - now
+                self._remaining = max(self._remaining - 1, 0)
+        if wait > 0:
+            time.sleep(min(wait, self.max_wait))
+
+github_client = GitHubClient(GITHUB_TOKEN, max_concurrency=GITHUB_MAX_CONCURRENCY, max_retries=GITHUB_MAX_RETRIES)
+
+# Process-wide read cache: file_path -> {'text', 'sha', 'etag', 'checked'}.
+# Entries younger than GITHUB_CACHE_TTL are served without a request; older
+# ones are revalidated with If-None-Match, and a 304 doesn't count against
+# the GitHub rate limit.
+_file_cache = {}
+_file_cache_lock = threading.Lock()
+
+def _cache_store(file_path, text, sha, etag=None):
+    with _file_cache_lock:
+        _file_cache[file_path] = {'text': text, 'sha': sha, 'etag': etag, 'checked': time.monotonic()}
+
+def _git_blob_sha(text):
+    """SHA git assigns to a blob with this content, same as the Contents API reports"""
+    data = text.encode('utf-8')
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+def _cache_forget(*file_paths):
+    with _file_cache_lock:
+        for file_path in file_paths:
+            _file_cache.pop(file_path, None)
+
+class GitHubReadError(Exception):
+    """A read from GitHub failed, as opposed to the file not existing"""
+
+def github_get_file(file_path, strict=False):
+    """Get file content from GitHub
+
+    (data, sha), or (None, None) if the file doesn't exist. A failed read
+    gives (None, None) too unless strict, which raises GitHubReadError so
+    the caller can tell it from a missing file.
+    """
     try:
+        with _file_cache_lock:
+            cached = _file_cache.get(file_path)
+            cached = dict(cached) if cached else None
+        if cached and time.monotonic() - cached['checked'] < GITHUB_CACHE_TTL:
+            return json.loads(cached['text']), cached['sha']
+        
         url = f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/{DATA_PATH}/{file_path}"
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
         params = {'ref': GITHUB_BRANCH}
         
-        response = requests.get(url, headers=headers, params=params)
+        response = github_client.get(url, headers=headers, params=params)
+        
+        if response.status_code == 304:
+            _cache_store(file_path, cached['text'], cached['sha'], cached['etag'])
+            return json.loads(cached['text']), cached['sha']
         
         if response.status_code == 404:
+            _cache_forget(file_path)
             return None, None
         
         if response.status_code != 200:
             print(f"Error getting file from GitHub: {response.status_code} - {response.text}")
+            if strict:
+                raise GitHubReadError(f"{file_path}: HTTP {response.status_code}")
             return None, None
         
         data = response.json()
         content = base64.b64decode(data['content']).decode('utf-8')
         sha = data['sha']
+        _cache_store(file_path, content, sha, response.headers.get('ETag'))
         
         return json.loads(content), sha
+    except GitHubReadError:
+        raise
     except Exception as e:
         print(f"Error reading from GitHub: {e}")
+        if strict:
+            raise GitHubReadError(f"{file_path}: {e}") from e
         return None, None
 
 def github_put_file(file_path, content, sha=None):
     """Create or update file in GitHub"""
     try:
         url = f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/{DATA_PATH}/{file_path}"
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
         
-        content_encoded = base64.b64encode(json.dumps(content, ensure_ascii=False, indent=2).encode('utf-8')).decode('utf-8')
+        text = json.dumps(content, ensure_ascii=False, indent=2)
+        content_encoded = base64.b64encode(text.encode('utf-8')).decode('utf-8')
         
         payload = {
             'message': f'Update {file_path}',
@@ -112,17 +355,828 @@ def github_put_file(file_path, content, sha=None):
         if sha:
             payload['sha'] = sha
         
-        response = requests.put(url, headers=headers, json=payload)
+        response = github_client.put(url, json=payload)
         
         if response.status_code not in [200, 201]:
             print(f"Error writing to GitHub: {response.status_code} - {response.text}")
+            _cache_forget(file_path)
             return False
         
+        _cache_store(file_path, text, response.json()['content']['sha'])
         return True
     except Exception as e:
         print(f"Error writing to GitHub: {e}")
         return False
 
+def _github_file_shas(commit_sha, file_paths):
+    """Blob SHA of each file at the given commit (None if missing), one listing per directory"""
+    shas = {}
+    by_dir = {}
+    for file_path in file_paths:
+        full_path = f"{DATA_PATH}/{file_path}"
+        by_dir.setdefault(posixpath.dirname(full_path), []).append((file_path, posixpath.basename(full_path)))
+
+    for directory, entries in by_dir.items():
+        url = f"{GITHUB_API}/repos/{GITHUB_REPO}/contents/{directory}"
+        response = github_client.get(url, params={'ref': commit_sha})
+        if response.status_code == 404:
+            listing = {}
+        elif response.status_code == 200:
+            listing = {item['name']: item['sha'] for item in response.json()}
+        else:
+            raise RuntimeError(f"Listing {directory} failed: {response.status_code} - {response.text}")
+        for file_path, name in entries:
+            shas[file_path] = listing.get(name)
+    return shas
+
+def github_commit_files(files, message, expected_shas=None, retries=3):
+    """Write several files as one commit via the Git Data API
+
+    files: {file_path: content}. expected_shas: {file_path: sha or None} as
+    returned by github_get_file; the commit is refused if any of those files
+    changed since. Contents go inline in the new tree, so the commit costs the
+    same handful of calls however many files it touches, and the branch either
+    gets all of the changes or none of them.
+    """
+    repo_url = f"{GITHUB_API}/repos/{GITHUB_REPO}"
+
+    try:
+        for attempt in range(retries):
+            response = github_client.get(f"{repo_url}/git/ref/heads/{GITHUB_BRANCH}")
+            if response.status_code in [404, 409]:
+                # Empty repository or missing branch: the Git Data API needs a
+                # parent commit, so fall back to one Contents API write per file
+                return all(github_put_file(path, content) for path, content in files.items())
+            if response.status_code != 200:
+                print(f"Error reading ref from GitHub: {response.status_code} - {response.text}")
+                return False
+            head_sha = response.json()['object']['sha']
+
+            if expected_shas:
+                current = _github_file_shas(head_sha, list(expected_shas))
+                stale = [path for path, sha in expected_shas.items() if current.get(path) != sha]
+                if stale:
+                    print(f"GitHub commit refused, files changed concurrently: {', '.join(stale)}")
+                    _cache_forget(*stale)
+                    return False
+
+            response = github_client.get(f"{repo_url}/git/commits/{head_sha}")
+            if response.status_code != 200:
+                print(f"Error reading commit from GitHub: {response.status_code} - {response.text}")
+                return False
+            base_tree = response.json()['tree']['sha']
+
+            texts = {file_path: json.dumps(content, ensure_ascii=False, indent=2) for file_path, content in files.items()}
+            tree = [{
+                'path': f"{DATA_PATH}/{file_path}",
+                'mode': '100644',
+                'type': 'blob',
+                'content': text
+            } for file_path, text in texts.items()]
+            response = github_client.post(f"{repo_url}/git/trees", json={'base_tree': base_tree, 'tree': tree})
+            if response.status_code != 201:
+                print(f"Error creating tree on GitHub: {response.status_code} - {response.text}")
+                return False
+            tree_sha = response.json()['sha']
+
+            response = github_client.post(f"{repo_url}/git/commits",
+                                          json={'message': message, 'tree': tree_sha, 'parents': [head_sha]})
+            if response.status_code != 201:
+                print(f"Error creating commit on GitHub: {response.status_code} - {response.text}")
+                return False
+            commit_sha = response.json()['sha']
+
+            # Fast-forward only: if the branch moved meanwhile, start over on the new head
+            response = github_client.patch(f"{repo_url}/git/refs/heads/{GITHUB_BRANCH}",
+                                           json={'sha': commit_sha, 'force': False})
+            if response.status_code == 200:
+                for file_path, text in texts.items():
+                    _cache_store(file_path, text, _git_blob_sha(text))
+                return True
+            if response.status_code != 422:
+                print(f"Error updating ref on GitHub: {response.status_code} - {response.text}")
+                return False
+
+        print(f"GitHub commit gave up after {retries} attempts: branch keeps moving")
+        return False
+    except Exception as e:
+        print(f"Error committing to GitHub: {e}")
+        return False
+
+# ==================== WRITE-BEHIND ====================
+
+class WriteBehindStore:
+    """Local journal in front of GitHub, so requests don't wait on the API
+
+    Every change is appended to an fsync'd journal and applied to in-memory
+    state before the request returns; a background thread coalesces pending
+    changes per file and pushes them to GitHub as one commit every interval.
+    On startup the journal is replayed and anything not yet pushed goes out
+    with the next flush.
+
+    State lives in this process only, so run a single worker
+    (e.g. gunicorn --workers 1 --threads 8) with WRITE_BEHIND=1.
+
+    Each file remembers the SHA it had on GitHub when it was loaded or last
+    pushed, and a flush expects exactly those SHAs. If anything else wrote
+    one of the files on GitHub meanwhile, the flush is refused rather than
+    overwriting it: the changes stay pending in the journal, and the refusal
+    is logged on every attempt until someone resolves the conflict.
+    """
+
+    def __init__(self, journal_path, interval=2.0):
+        self.journal_path = journal_path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._state = {}    # file_path -> {'text': json text or None, 'version': str}
+        self._pending = {}  # file_path -> seq of the latest change not yet pushed
+        self._seq = 0
+        self._journal = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._replay()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='write-behind-flusher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def get(self, file_path):
+        """(data, version) like github_get_file; version is what commit() expects back"""
+        with self._lock:
+            entry = self._state.get(file_path)
+        if entry is None:
+            entry = self._load(file_path)
+        if entry['text'] is None:
+            return None, entry['version']
+        return json.loads(entry['text']), entry['version']
+
+    def commit(self, files, message, expected_shas=None):
+        """Journal the change and apply it; False if an expected version is stale"""
+        for file_path in set(files) | set(expected_shas or {}):
+            if file_path not in self._state:
+                self._load(file_path)  # also learns the SHA the flush will expect on GitHub
+        with self._lock:
+            for file_path, version in (expected_shas or {}).items():
+                if self._state[file_path]['version'] != version:
+                    return False
+            self._seq += 1
+            record = {'seq': self._seq, 'message': message, 'files': files, 'bases': self._bases(files)}
+            self._journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._apply(record)
+            return True
+
+    def pending(self):
+        with self._lock:
+            return sorted(self._pending)
+
+    def flush(self):
+        """Push every pending file to GitHub in one commit; True if nothing is left"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return True
+                upto = self._seq
+                files = {path: self._state[path]['text'] for path in self._pending}
+                expected = self._bases(files)
+            contents = {path: json.loads(text) if text is not None else None for path, text in files.items()}
+            if not github_commit_files(contents, f"Write-behind flush ({len(contents)} files)", expected):
+                return False
+            with self._lock:
+                for path, content in contents.items():
+                    # What github_commit_files wrote, so the next flush expects it
+                    self._state[path]['base'] = _git_blob_sha(json.dumps(content, ensure_ascii=False, indent=2))
+                for path in list(self._pending):
+                    if self._pending[path] <= upto:
+                        del self._pending[path]
+                self._compact()
+                return not self._pending
+
+    # ---- internals ----
+
+    def _load(self, file_path):
+        # First touch of a file: GitHub is authoritative until we change it.
+        # A failed read raises GitHubReadError and caches nothing; taking it
+        # for a missing file would let the next commit and flush overwrite it.
+        data, sha = github_get_file(file_path, strict=True)
+        text = json.dumps(data, ensure_ascii=False) if data is not None else None
+        with self._lock:
+            return self._state.setdefault(file_path, {'text': text, 'version': sha, 'base': sha})
+
+    def _bases(self, files):
+        # {file_path: SHA on GitHub} for the files whose SHA is known; a
+        # journal written before SHAs were recorded leaves some unknown
+        return {path: self._state[path]['base'] for path in files
+                if path in self._state and 'base' in self._state[path]}
+
+    def _apply(self, record):
+        bases = record.get('bases', {})
+        for file_path, content in record['files'].items():
+            text = json.dumps(content, ensure_ascii=False) if content is not None else None
+            entry = {'text': text, 'version': f"wb-{record['seq']}"}
+            previous = self._state.get(file_path)
+            if previous is not None and 'base' in previous:
+                entry['base'] = previous['base']  # GitHub hasn't changed since
+            elif file_path in bases:
+                entry['base'] = bases[file_path]  # replaying the journal
+            self._state[file_path] = entry
+            self._pending[file_path] = record['seq']
+        self._seq = max(self._seq, record['seq'])
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        good = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('unterminated record')
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break  # torn final write from a crash; nothing after it was acknowledged
+                self._apply(record)
+                good += len(line)
+        if good < os.path.getsize(self.journal_path):
+            # Cut the torn tail off, or the next append would be glued onto it
+            # and lost on the following replay
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good)
+                f.flush()
+                os.fsync(f.fileno())
+        if self._pending:
+            print(f"Write-behind: replayed {len(self._pending)} pending files from {self.journal_path}")
+
+    def _compact(self):
+        # Rewrite the journal as one record holding what is still unpushed
+        tmp = self.journal_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            if self._pending:
+                files = {path: json.loads(self._state[path]['text']) if self._state[path]['text'] is not None else None
+                         for path in self._pending}
+                f.write(json.dumps({'seq': self._seq, 'message': 'compacted', 'files': files,
+                                    'bases': self._bases(files)}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self._journal:
+            self._journal.close()
+        os.replace(tmp, self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Write-behind flush failed: {e}")
+
+_write_behind = None
+_write_behind_lock = threading.Lock()
+
+def _write_behind_store():
+    # Started on first use rather than at import, so the debug reloader's
+    # parent process never runs a second flusher
+    global _write_behind
+    if not WRITE_BEHIND:
+        return None
+    with _write_behind_lock:
+        if _write_behind is None:
+            _write_behind = WriteBehindStore(JOURNAL_PATH, FLUSH_INTERVAL).start()
+            atexit.register(_write_behind.stop)
+        return _write_behind
+
+def storage_get(file_path):
+    """Read a data file: (content, version) from the write-behind state or GitHub
+
+    Within one /api/batch a file is read once and its sub-requests get copies.
+    """
+    reads = _batch_reads()
+    if reads is not None and file_path in reads:
+        content, version = reads[file_path]
+        return copy.deepcopy(content), version
+    store = _write_behind_store()
+    content, version = store.get(file_path) if store else github_get_file(file_path)
+    change_feed.observe(file_path, content, version)
+    if reads is not None:
+        reads[file_path] = (copy.deepcopy(content), version)
+    return content, version
+
+def _batch_reads():
+    return g.get('batch_reads') if has_app_context() else None
+
+def storage_commit(files, message, expected_shas=None):
+    """Write one or more data files, refusing if an expected version is stale"""
+    reads = _batch_reads()
+    if reads is not None:
+        for file_path in files:
+            reads.pop(file_path, None)  # later sub-requests read what was written, or the winner of a conflict
+    store = _write_behind_store()
+    if store:
+        saved = store.commit(files, message, expected_shas)
+    elif len(files) == 1:
+        # A single file is one Contents API call, which checks the SHA itself
+        (file_path, content), = files.items()
+        saved = github_put_file(file_path, content, (expected_shas or {}).get(file_path))
+    else:
+        saved = github_commit_files(files, message, expected_shas)
+    if saved:
+        for file_path, content in files.items():
+            change_feed.observe(file_path, content)
+    return saved
+
+# ==================== SHARDED LAYOUT ====================
+# STORAGE_LAYOUT=sharded keeps each user's data in its own files, so a request
+# reads and writes only the caller's shard instead of everyone's data:
+#   users/index.json          [{telegram_id, username, isAdmin, deleted}], changes on registration only
+#   users/<id>/account.json   bank account with balance
+#   users/<id>/history/       bank history segments (see SegmentedHistory)
+#   users/<id>/mywork.json    {'running': start time or None, 'shifts': [...]}
+#   users/<id>/myinfo.json    info records
+# Shop data stays in the shared shop_*.json files.
+# Convert an existing repository with: python server_v2.py migrate-sharded
+
+SHARDED = STORAGE_LAYOUT == 'sharded'
+USER_INDEX = 'users/index.json'
+
+def user_file(telegram_id, name):
+    """Path of one of a user's shard files"""
+    return f'users/{telegram_id}/{name}'
+
+def _index_entry(account):
+    return {key: account.get(key) for key in ('telegram_id', 'username', 'isAdmin', 'deleted')}
+
+def _new_account():
+    return {
+        'telegram_id': session['user_id'],
+        'username': session['username'],
+        'balance': 1000,  # Starting balance
+        'isAdmin': False,
+        'online': True,
+        'deleted': False
+    }
+
+def build_sharded_layout(bank_users, bank_history, shifts, running, records, users=None):
+    """Split the flat datasets into shard files
+
+    Returns ({file_path: content}, [usernames with data but no known telegram_id]).
+    """
+    ids = {u['username']: u['telegram_id'] for u in (users or []) if u.get('username')}
+    ids.update({u['username']: u['telegram_id'] for u in bank_users or [] if u.get('username')})
+    files = {USER_INDEX: [_index_entry(u) for u in bank_users or []]}
+    for account in bank_users or []:
+        files[user_file(account['telegram_id'], 'account.json')] = account
+    skipped = set()
+
+    def shard(username, name, default):
+        if username not in ids:
+            skipped.add(username)
+            return None
+        return files.setdefault(user_file(ids[username], name), default)
+
+    histories = {}
+    for entry in reversed(bank_history or []):  # stored newest first, logs append oldest first
+        for username in {entry.get('from'), entry.get('to')} - {None}:
+            if username in ids:
+                histories.setdefault(ids[username], []).append(entry)
+            else:
+                skipped.add(username)
+    for telegram_id, entries in histories.items():
+        files.update(SegmentedHistory(user_file(telegram_id, 'history')).layout(entries))
+    for username, items in (shifts or {}).items():
+        mywork = shard(username, 'mywork.json', {'running': None, 'shifts': []})
+        if mywork is not None:
+            mywork['shifts'] = items
+    for username, started in (running or {}).items():
+        mywork = shard(username, 'mywork.json', {'running': None, 'shifts': []})
+        if mywork is not None:
+            mywork['running'] = started
+    for username, data in (records or {}).items():
+        shard(username, 'myinfo.json', data)
+    return files, sorted(skipped)
+
+def migrate_to_sharded():
+    """Write the sharded layout from the flat files in one commit; the flat files are left as they are"""
+    flat = {name: github_get_file(name)[0] for name in (
+        'bank_users.json', 'bank_history.json', 'mywork_shifts.json',
+        'mywork_running.json', 'myinfo_records.json')}
+    files, skipped = build_sharded_layout(
+        flat['bank_users.json'], flat['bank_history.json'], flat['mywork_shifts.json'],
+        flat['mywork_running.json'], flat['myinfo_records.json'], user_directory.users())
+    users = len(files[USER_INDEX])
+    print(f"Migrating {users} users into {len(files)} files")
+    if skipped:
+        print(f"⚠️  No telegram_id for {', '.join(skipped)}; their data stays only in the flat files")
+    if not github_commit_files(files, f"Migrate to sharded layout ({users} users)"):
+        print("❌ Migration commit failed")
+        return False
+    print("✅ Done. Set STORAGE_LAYOUT=sharded and restart")
+    return True
+
+# ==================== HISTORY LOG ====================
+
+class SegmentedHistory:
+    """Append-only history kept as numbered segment files in the repository
+
+    Entries are appended, oldest first, to <prefix>/<n>.json and a new segment
+    starts every HISTORY_SEGMENT_SIZE entries, so a write re-uploads one
+    bounded file however long the history gets. <prefix>/head.json names the
+    active segment and the first one still in use. Reading the latest entries
+    walks segments backwards from the head and stops as soon as the caller
+    has enough.
+
+    An entry's position is [segment, offset]; positions only grow, which makes
+    them usable as pagination cursors. legacy: an older newest-first list
+    file, read as segment 0.
+    """
+
+    def __init__(self, prefix, legacy=None, segment_size=None):
+        self.prefix = prefix
+        self.legacy = legacy
+        self.segment_size = segment_size or HISTORY_SEGMENT_SIZE
+        self.head_path = f'{prefix}/head.json'
+
+    def segment_path(self, number):
+        return f'{self.prefix}/{number:06d}.json'
+
+    def head(self):
+        """(head, version); a log that doesn't exist yet has a head with version None"""
+        head, sha = storage_get(self.head_path)
+        if head is None:
+            legacy = storage_get(self.legacy)[0] if self.legacy else None
+            # 'indexed': every entry is in the per-user indexes (see HistoryIndex)
+            head = {'segment': 1, 'first': 1, 'indexed': not legacy}
+        return head, sha
+
+    def segment(self, number):
+        """Entries of one segment, oldest first"""
+        if number == 0:
+            legacy, _ = storage_get(self.legacy) if self.legacy else (None, None)
+            return list(reversed(legacy or []))
+        segment, _ = storage_get(self.segment_path(number))
+        return segment or []
+
+    def append(self, entry):
+        """(files, expected versions, position) for appending entry; commit with storage_commit"""
+        head, head_sha = self.head()
+        number = head['segment']
+        segment, segment_sha = storage_get(self.segment_path(number))
+        files, expected = {}, {self.head_path: head_sha}
+        if segment and len(segment) >= self.segment_size:
+            number += 1
+            segment, segment_sha = [], None
+        if head_sha is None or head['segment'] != number:
+            files[self.head_path] = dict(head, segment=number)
+        segment = segment or []
+        files[self.segment_path(number)] = segment + [entry]
+        expected[self.segment_path(number)] = segment_sha
+        return files, expected, [number, len(segment)]
+
+    def reverse(self, before=None):
+        """(position, entry) pairs newest first, loading one segment at a time
+
+        before: only entries older than this position
+        """
+        head, _ = self.head()
+        lowest = 0 if self.legacy and head['first'] == 1 else head['first']
+        top = head['segment'] if before is None else min(head['segment'], before[0])
+        for number in range(top, lowest - 1, -1):
+            segment = self.segment(number)
+            end = len(segment) if before is None or number != before[0] else min(before[1], len(segment))
+            for offset in range(end - 1, -1, -1):
+                yield [number, offset], segment[offset]
+
+    def read(self, positions):
+        """Entries at positions, loading each segment once"""
+        segments = {}
+        for number, _ in positions:
+            if number not in segments:
+                segments[number] = self.segment(number)
+        return [segments[number][offset] for number, offset in positions]
+
+    def latest(self, limit, match=None):
+        entries = (e for _, e in self.reverse() if match is None or match(e))
+        return list(itertools.islice(entries, limit))
+
+    def layout(self, entries):
+        """Files holding entries (oldest first) as a fresh log, for migrations"""
+        files = {}
+        for start in range(0, len(entries), self.segment_size):
+            files[self.segment_path(start // self.segment_size + 1)] = entries[start:start + self.segment_size]
+        if files:
+            files[self.head_path] = {'segment': len(files), 'first': 1, 'indexed': True}
+        return files
+
+    def reset(self):
+        """Files that start an empty log after the current segments, which are kept but no longer read"""
+        head, _ = storage_get(self.head_path)
+        number = (head['segment'] if head else 0) + 1
+        return {self.head_path: {'segment': number, 'first': number, 'indexed': True}, self.segment_path(number): []}
+
+class HistoryIndex:
+    """Per-user list of positions in a SegmentedHistory
+
+    <prefix>/index/<first>/<telegram_id>.json holds {'pos', 'time', 'dir'} for
+    every entry the user took part in, oldest first, so a history page costs
+    one index read plus the segments of the entries it returns. Indexes are
+    kept per generation (the log's first segment), so a reset log starts empty.
+    """
+
+    def __init__(self, log):
+        self.log = log
+
+    def path(self, head, telegram_id):
+        return f"{self.log.prefix}/index/{head['first']}/{telegram_id}.json"
+
+    def get(self, telegram_id):
+        """The user's index, or None while the log isn't fully indexed"""
+        head, _ = self.log.head()
+        if not head.get('indexed'):
+            return None
+        index, _ = storage_get(self.path(head, telegram_id))
+        return index or []
+
+    def add(self, position, entry, parties):
+        """(files, expected) adding entry to each party's index; parties: {telegram_id: direction}"""
+        head, _ = self.log.head()
+        files, expected = {}, {}
+        if not head.get('indexed'):
+            return files, expected
+        for telegram_id, direction in parties.items():
+            path = self.path(head, telegram_id)
+            index, expected[path] = storage_get(path)
+            files[path] = (index or []) + [{'pos': position, 'time': entry['time'], 'dir': direction}]
+        return files, expected
+
+    def rebuild(self, ids):
+        """Files indexing the whole log; ids: {username: telegram_id}"""
+        head, _ = self.log.head()
+        indexes = {}
+        for position, entry in self.log.reverse():
+            for telegram_id, direction in _parties(entry, ids).items():
+                indexes.setdefault(telegram_id, []).append({'pos': position, 'time': entry['time'], 'dir': direction})
+        files = {self.path(head, telegram_id): items[::-1] for telegram_id, items in indexes.items()}
+        files[self.log.head_path] = dict(head, indexed=True)
+        return files
+
+def _parties(entry, ids):
+    """{telegram_id: 'out' | 'in' | 'self'} for the known users in a transfer entry"""
+    parties = {}
+    if entry.get('to') in ids:
+        parties[ids[entry['to']]] = 'in'
+    if entry.get('from') in ids:
+        telegram_id = ids[entry['from']]
+        parties[telegram_id] = 'self' if parties.get(telegram_id) == 'in' else 'out'
+    return parties
+
+def bank_history(telegram_id=None):
+    """The shared bank history, or one user's history in the sharded layout"""
+    if telegram_id is None:
+        return SegmentedHistory('bank_history', legacy='bank_history.json')
+    return SegmentedHistory(user_file(telegram_id, 'history'), legacy=user_file(telegram_id, 'history.json'))
+
+def reindex_history():
+    """Build the per-user indexes for the shared bank history in one commit"""
+    users, _ = github_get_file('bank_users.json')
+    ids = {u['username']: u['telegram_id'] for u in users or []}
+    files = HistoryIndex(bank_history()).rebuild(ids)
+    print(f"Indexing bank history for {len(files) - 1} users")
+    if not github_commit_files(files, 'Index bank history'):
+        print("❌ Index commit failed")
+        return False
+    print("✅ Done")
+    return True
+
+# ==================== USER DIRECTORY ====================
+
+class UserDirectory:
+    """Registered users by telegram_id, loaded once and kept in memory
+
+    Registrations are appended to the 'registrations' log (see
+    SegmentedHistory) instead of rewriting the whole user list, so a known
+    user's login costs no storage request at all. A miss reads only the
+    segments not seen yet before giving up, which picks up users registered
+    by another worker. A users.json from before the log is read as segment 0.
+    """
+
+    def __init__(self):
+        self.log = SegmentedHistory('registrations', legacy='users.json')
+        self._lock = threading.Lock()     # guards the fields below
+        self._io_lock = threading.Lock()  # one refresh or registration at a time
+        self._users = {}
+        self._first = None  # first segment of the log generation loaded so far
+        self._next = None   # lowest segment that may still have unseen entries
+
+    def get(self, telegram_id):
+        """The registered user, or None"""
+        with self._lock:
+            user = self._users.get(telegram_id)
+        if user is None:
+            with self._io_lock:
+                self._refresh()
+            with self._lock:
+                user = self._users.get(telegram_id)
+        return user
+
+    def users(self):
+        """Every registered user, after catching up with the log"""
+        with self._io_lock:
+            self._refresh()
+        with self._lock:
+            return list(self._users.values())
+
+    def register(self, user, retries=3):
+        """The stored user with user's telegram_id, appending user if there is none yet
+
+        Returns None if the log kept changing under us.
+        """
+        with self._io_lock:
+            for _ in range(retries):
+                self._refresh()
+                with self._lock:
+                    existing = self._users.get(user['telegram_id'])
+                if existing:
+                    return existing
+                files, expected, _ = self.log.append(user)
+                if storage_commit(files, f"Register {user['username']}", expected):
+                    with self._lock:
+                        self._users[user['telegram_id']] = user
+                    return user
+            return None
+
+    def reset(self):
+        """Forget everything loaded, e.g. after the log was reset"""
+        with self._lock:
+            self._users, self._first, self._next = {}, None, None
+
+    def _refresh(self):
+        # Caller holds _io_lock
+        head, _ = self.log.head()
+        with self._lock:
+            if head['first'] != self._first:
+                self._users, self._first = {}, head['first']
+                self._next = 0 if head['first'] == 1 else head['first']
+            start = self._next
+        loaded = {}
+        for number in range(start, head['segment'] + 1):
+            for user in self.log.segment(number):
+                loaded.setdefault(user['telegram_id'], user)
+        with self._lock:
+            for telegram_id, user in loaded.items():
+                self._users.setdefault(telegram_id, user)
+            self._next = head['segment']  # the active segment can still grow
+
+user_directory = UserDirectory()
+
+# ==================== CHANGE FEED ====================
+
+# Collections in the feed. Shared ones go to every user; private ones
+# (owner set) only to their owner, the same way their GET endpoints filter.
+FEED_COLLECTIONS = ('bank_users', 'shop_products', 'mywork_shifts', 'myinfo_records')
+
+def feed_records(file_path, content):
+    """(collection, {record id: (record, owner)}) for a data file in the feed, else None"""
+    if file_path in ('bank_users.json', USER_INDEX):
+        return 'bank_users', {u.get('telegram_id') or u.get('username'): (u, None) for u in content or []}
+    if file_path == 'shop_products.json':
+        return 'shop_products', {p['id']: (p, None) for p in content or [] if 'id' in p}
+    if file_path in ('mywork_shifts.json', 'myinfo_records.json'):
+        # Flat layout: keyed and owned by username
+        return file_path[:-len('.json')], {username: (data, username) for username, data in (content or {}).items()}
+    parts = file_path.split('/')
+    if len(parts) == 3 and parts[0] == 'users' and parts[2] in ('mywork.json', 'myinfo.json'):
+        # Sharded layout: one record per file, keyed and owned by telegram_id
+        telegram_id = int(parts[1]) if parts[1].isdigit() else parts[1]
+        if content is None:
+            return _shard_collection(parts[2]), {}
+        data = content['shifts'] if parts[2] == 'mywork.json' else content
+        return _shard_collection(parts[2]), {telegram_id: (data, telegram_id)}
+    return None
+
+def _shard_collection(name):
+    return 'mywork_shifts' if name == 'mywork.json' else 'myinfo_records'
+
+def feed_sources(collection):
+    """Files to read so the feed is current for the caller's view of a collection"""
+    if collection == 'bank_users':
+        return [USER_INDEX if SHARDED else 'bank_users.json']
+    if collection == 'shop_products':
+        return ['shop_products.json']
+    if SHARDED:
+        return [user_file(session['user_id'], 'mywork.json' if collection == 'mywork_shifts' else 'myinfo.json')]
+    return [f'{collection}.json']
+
+change_feed = ChangeFeed(feed_records, CHANGE_FEED_SIZE)
+
+# ==================== EVENTS ====================
+
+class EventBus:
+    """In-process pub/sub behind the /api/events Server-Sent Events stream
+
+    publish() numbers an event, keeps it in a bounded buffer and puts it on
+    the queue of every open stream of its recipients, so an idle stream costs
+    nothing until one of its users is affected. Event ids are '<epoch>.<seq>';
+    a stream reconnecting with Last-Event-ID gets the buffered events it
+    missed, or a 'reset' event if they are gone (restart, another process,
+    or older than the buffer) and the client should reload its state.
+
+    Streams are per process, like the write-behind journal: run a single
+    worker. Each open stream holds one of its threads for as long as the tab
+    is open, so use a threaded worker (gunicorn --threads, see Dockerfile) or
+    gevent; /api/events turns clients away past EVENTS_MAX_STREAMS so the
+    other endpoints keep threads to run on.
+    """
+
+    def __init__(self, size=1000):
+        self.epoch = f'{int(time.time()):x}{os.urandom(2).hex()}'
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._buffer = collections.deque(maxlen=size)  # (seq, telegram_id, message)
+        self._streams = {}  # telegram_id -> set of queues
+
+    def publish(self, telegram_ids, event, data):
+        """Send event to every open stream of the given users"""
+        with self._lock:
+            self._seq += 1
+            event_id = f'{self.epoch}.{self._seq}'
+            message = f'id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+            for telegram_id in set(telegram_ids):
+                self._buffer.append((self._seq, telegram_id, message))
+                for stream in self._streams.get(telegram_id, ()):
+                    stream.put(message)
+
+    def stream(self, telegram_id, last_event_id=None, heartbeat=15.0, limit=None):
+        """SSE messages for one user: missed events first, then live ones, with a comment every heartbeat seconds
+
+        The stream is open once this returns (close() it when done), or None
+        if limit streams are open already; the check and the registration
+        are one step, so concurrent connects can't overshoot the limit.
+        """
+        messages = self._messages(telegram_id, last_event_id, heartbeat, limit)
+        return messages if next(messages) else None
+
+    def _messages(self, telegram_id, last_event_id, heartbeat, limit):
+        # Yields first whether the stream got registered, then the messages
+        inbox = queue.SimpleQueue()
+        with self._lock:
+            if limit is not None and self._count() >= limit:
+                yield False
+                return
+            missed = self._missed(telegram_id, last_event_id)
+            reset_id = f'{self.epoch}.{self._seq}'
+            self._streams.setdefault(telegram_id, set()).add(inbox)
+        try:
+            yield True
+            yield f'retry: {int(heartbeat * 1000)}\n\n'
+            if missed is None:
+                yield f'id: {reset_id}\nevent: reset\ndata: {{}}\n\n'
+            for message in missed or ():
+                yield message
+            while True:
+                try:
+                    yield inbox.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+        finally:
+            with self._lock:
+                streams = self._streams.get(telegram_id)
+                streams.discard(inbox)
+                if not streams:
+                    del self._streams[telegram_id]
+
+    def subscribers(self):
+        with self._lock:
+            return self._count()
+
+    def _count(self):
+        return sum(len(streams) for streams in self._streams.values())
+
+    def _missed(self, telegram_id, last_event_id):
+        # [] when there is nothing to resume, None when the gap can't be filled
+        if not last_event_id:
+            return []
+        epoch, _, seq = last_event_id.partition('.')
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        seq = int(seq)
+        if len(self._buffer) == self._buffer.maxlen and self._buffer[0][0] > seq:
+            return None  # some of the events after seq may have been dropped
+        return [message for event_seq, recipient, message in self._buffer if event_seq > seq and recipient == telegram_id]
+
+event_bus = EventBus(EVENT_BUFFER_SIZE)
+
 # ==================== AUTHENTICATION ====================
 
 def verify_telegram_auth(init_data_raw):
@@ -198,32 +1252,30 @@ def auth_telegram():
         if not user_data:
             return jsonify({'success': False, 'error': 'Invalid authentication'}), 401
         
-        # Store user session
-        session['user_id'] = user_data['id']
-        session['username'] = user_data.get('username') or user_data.get('first_name') or f"user_{user_data['id']}"
-        session['first_name'] = user_data.get('first_name', '')
-        session['last_name'] = user_data.get('last_name', '')
+        username = user_data.get('username') or user_data.get('first_name') or f"user_{user_data['id']}"
+        first_name = user_data.get('first_name', '')
+        last_name = user_data.get('last_name', '')
         
         # Get or create user in database
-        users, sha = github_get_file('users.json')
-        if users is None:
-            users = []
-        
-        # Find or create user
-        user = next((u for u in users if u['telegram_id'] == user_data['id']), None)
-        
-        if not user:
-            # Create new user
-            user = {
+        if not user_directory.get(user_data['id']):
+            # Create new user; no session until it is stored
+            registered = user_directory.register({
                 'telegram_id': user_data['id'],
-                'username': session['username'],
-                'first_name': session['first_name'],
-                'last_name': session['last_name'],
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
                 'created_at': datetime.now().isoformat(),
                 'language': 'ru'
-            }
-            users.append(user)
-            github_put_file('users.json', users, sha)
+            })
+            if registered is None:
+                # Other registrations kept landing first; the client should retry
+                return jsonify({'success': False, 'error': 'Registration is busy, try again'}), 503, {'Retry-After': '1'}
+        
+        # Store user session
+        session['user_id'] = user_data['id']
+        session['username'] = username
+        session['first_name'] = first_name
+        session['last_name'] = last_name
         
         return jsonify({
             'success': True,
@@ -272,33 +1324,40 @@ def get_translations(lang):
 @require_auth
 def get_bank_users():
     """Get all bank users"""
-    users, _ = github_get_file('bank_users.json')
+    users, _ = storage_get(USER_INDEX if SHARDED else 'bank_users.json')
     return jsonify(users or [])
 
 @app.route('/api/bank/my-account', methods=['GET'])
 @require_auth
 def get_my_bank_account():
     """Get current user's bank account"""
-    users, _ = github_get_file('bank_users.json')
+    if SHARDED:
+        path = user_file(session['user_id'], 'account.json')
+        account, sha = storage_get(path)
+        if account:
+            return jsonify(account)
+        index, i_sha = storage_get(USER_INDEX)
+        account = _new_account()
+        saved = storage_commit(
+            {path: account, USER_INDEX: (index or []) + [_index_entry(account)]},
+            f"Open account for {session['username']}",
+            expected_shas={path: sha, USER_INDEX: i_sha}
+        )
+        if not saved:
+            return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
+        return jsonify(account)
+    
+    users, sha = storage_get('bank_users.json')
     if not users:
         return jsonify({'success': False, 'error': 'No users found'}), 404
     
     user = next((u for u in users if u.get('telegram_id') == session['user_id']), None)
     if not user:
         # Create account for user
-        users_data, sha = github_get_file('users.json')
-        user_data = next((u for u in users_data if u['telegram_id'] == session['user_id']), None)
-        
-        new_account = {
-            'telegram_id': session['user_id'],
-            'username': session['username'],
-            'balance': 1000,  # Starting balance
-            'isAdmin': False,
-            'online': True,
-            'deleted': False
-        }
+        new_account = _new_account()
         users.append(new_account)
-        github_put_file('bank_users.json', users)
+        if not storage_commit({'bank_users.json': users}, f"Open account for {session['username']}", {'bank_users.json': sha}):
+            return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
         return jsonify(new_account)
     
     return jsonify(user)
@@ -315,7 +1374,10 @@ def bank_transfer():
     if amount <= 0:
         return jsonify({'success': False, 'error': 'Invalid amount'}), 400
     
-    users, sha = github_get_file('bank_users.json')
+    if SHARDED:
+        return _sharded_transfer(to_username, amount, comment)
+    
+    users, sha = storage_get('bank_users.json')
     if not users:
         return jsonify({'success': False, 'error': 'No users found'}), 404
     
@@ -331,52 +1393,162 @@ def bank_transfer():
     # Update balances
     from_user['balance'] -= amount
     to_user['balance'] += amount
-    github_put_file('bank_users.json', users, sha)
     
-    # Add to history
-    history, h_sha = github_get_file('bank_history.json')
-    if history is None:
-        history = []
+    # Append to history and to both users' history indexes
+    history = bank_history()
+    entry = _transfer_entry(from_user, to_user, amount, comment)
+    files, expected, position = history.append(entry)
+    parties = _parties(entry, {u['username']: u['telegram_id'] for u in (from_user, to_user)})
+    index_files, index_expected = HistoryIndex(history).add(position, entry, parties)
+    files.update(index_files)
+    expected.update(index_expected)
+    files['bank_users.json'] = users
+    expected['bank_users.json'] = sha
+    
+    # Balances and history land in one commit, or not at all
+    saved = storage_commit(files, f"Transfer {from_user['username']} -> {to_user['username']}", expected_shas=expected)
+    if not saved:
+        return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
     
-    history.insert(0, {
+    _publish_transfer(entry, from_user, to_user)
+    return jsonify({'success': True, 'balance': from_user['balance']})
+
+def _transfer_entry(from_user, to_user, amount, comment):
+    return {
         'time': datetime.now().isoformat(),
         'from': from_user['username'],
         'to': to_user['username'],
         'amount': amount,
         'comment': comment,
         'type': 'transfer'
-    })
-    github_put_file('bank_history.json', history, h_sha)
+    }
+
+def _publish_transfer(entry, from_user, to_user):
+    event_bus.publish([from_user['telegram_id']], 'balance', {'balance': from_user['balance']})
+    if to_user['telegram_id'] != from_user['telegram_id']:
+        event_bus.publish([to_user['telegram_id']], 'balance', {'balance': to_user['balance']})
+    event_bus.publish([to_user['telegram_id']], 'transfer', entry)
+
+def _sharded_transfer(to_username, amount, comment):
+    """Transfer touching only the two accounts and their history shards"""
+    index, _ = storage_get(USER_INDEX)
+    recipient = next((u for u in index or [] if u['username'] == to_username and not u.get('deleted')), None)
+    if not recipient:
+        return jsonify({'success': False, 'error': 'User not found'}), 404
+    
+    parties = [session['user_id']]
+    if recipient['telegram_id'] != session['user_id']:
+        parties.append(recipient['telegram_id'])
+    files, expected = {}, {}
+    for telegram_id in parties:
+        path = user_file(telegram_id, 'account.json')
+        files[path], expected[path] = storage_get(path)
+    
+    from_user = files[user_file(session['user_id'], 'account.json')]
+    to_user = files[user_file(recipient['telegram_id'], 'account.json')]
+    if not from_user or not to_user:
+        return jsonify({'success': False, 'error': 'User not found'}), 404
+    
+    if from_user['balance'] < amount:
+        return jsonify({'success': False, 'error': 'Insufficient funds'}), 400
+    
+    from_user['balance'] -= amount
+    to_user['balance'] += amount
+    
+    entry = _transfer_entry(from_user, to_user, amount, comment)
+    for telegram_id in parties:
+        history_files, history_expected, _ = bank_history(telegram_id).append(entry)
+        files.update(history_files)
+        expected.update(history_expected)
+    
+    saved = storage_commit(files, f"Transfer {from_user['username']} -> {to_user['username']}", expected_shas=expected)
+    if not saved:
+        return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
     
+    _publish_transfer(entry, from_user, to_user)
     return jsonify({'success': True, 'balance': from_user['balance']})
 
+def _history_query(args):
+    """Validated /api/bank/history parameters; raises ValueError"""
+    before = args.get('before')
+    if before:
+        segment, _, offset = before.partition('.')
+        before = [int(segment), int(offset)]
+    limit = int(args.get('limit', 100))
+    if not 1 <= limit <= HISTORY_PAGE_MAX:
+        raise ValueError(f'limit must be between 1 and {HISTORY_PAGE_MAX}')
+    direction = args.get('direction')
+    if direction not in (None, 'in', 'out'):
+        raise ValueError('direction must be in or out')
+    return before, limit, args.get('from_date'), args.get('to_date'), direction
+
+def _history_page(candidates, limit, from_date, to_date, direction):
+    """First `limit` of candidates (newest first (position, time, dir, item)) passing the filters"""
+    page = []
+    for position, time, entry_dir, item in candidates:
+        if from_date and time < from_date:
+            break  # history is in time order, everything further is older
+        if to_date and time[:len(to_date)] > to_date:
+            continue
+        if direction and entry_dir not in (direction, 'self'):
+            continue
+        page.append((position, item))
+        if len(page) == limit:
+            break
+    return page
+
 @app.route('/api/bank/history', methods=['GET'])
 @require_auth
 def get_bank_history():
-    """Get bank transaction history"""
-    history, _ = github_get_file('bank_history.json')
-    if not history:
-        return jsonify([])
+    """Get bank transaction history, newest first
+
+    Query: limit (default 100), before=<cursor of the last entry seen>,
+    from_date / to_date (ISO dates, inclusive), direction=in|out.
+    Every entry carries its 'cursor'.
+    """
+    try:
+        before, limit, from_date, to_date, direction = _history_query(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     
-    # Filter to show only current user's transactions
     my_username = session['username']
-    my_history = [h for h in history if h['from'] == my_username or h['to'] == my_username]
+    history = bank_history(session['user_id']) if SHARDED else bank_history()
+    index = None if SHARDED else HistoryIndex(history).get(session['user_id'])
+    
+    if index is not None:
+        # Positions and times only grow, so both bounds are a bisect into the index
+        end = len(index)
+        if before:
+            end = bisect.bisect_left(index, tuple(before), key=lambda i: tuple(i['pos']))
+        if to_date:
+            end = min(end, bisect.bisect_right(index, to_date, key=lambda i: i['time'][:len(to_date)]))
+        candidates = ((i['pos'], i['time'], i['dir'], None) for i in reversed(index[:end]))
+        page = _history_page(candidates, limit, from_date, None, direction)
+        entries = history.read([position for position, _ in page])
+        page = [(position, entry) for (position, _), entry in zip(page, entries)]
+    else:
+        def candidates():
+            for position, entry in history.reverse(before):
+                if SHARDED or my_username in (entry['from'], entry['to']):
+                    entry_dir = 'self' if entry['from'] == entry['to'] else 'out' if entry['from'] == my_username else 'in'
+                    yield position, entry['time'], entry_dir, entry
+        page = _history_page(candidates(), limit, from_date, to_date, direction)
     
-    return jsonify(my_history[:100])  # Last 100 transactions
+    return jsonify([dict(entry, cursor=f'{position[0]}.{position[1]}') for position, entry in page])
 
 # ==================== SHOP API ====================
 
 @app.route('/api/shop/products', methods=['GET'])
 def get_shop_products():
     """Get all shop products"""
-    products, _ = github_get_file('shop_products.json')
+    products, _ = storage_get('shop_products.json')
     return jsonify(products or [])
 
 @app.route('/api/shop/my-store', methods=['GET'])
 @require_auth
 def get_my_store():
     """Get current user's store"""
-    stores, _ = github_get_file('shop_stores.json')
+    stores, _ = storage_get('shop_stores.json')
     if not stores:
         return jsonify(None)
     
@@ -394,7 +1566,7 @@ def shop_purchase():
         return jsonify({'success': False, 'error': 'Empty cart'}), 400
     
     # Calculate total
-    products, p_sha = github_get_file('shop_products.json')
+    products, p_sha = storage_get('shop_products.json')
     total = 0
     for item in cart:
         product = next((p for p in products if p['id'] == item['id']), None)
@@ -403,8 +1575,13 @@ def shop_purchase():
         total += product['price'] * item['qty']
     
     # Check bank balance
-    users, u_sha = github_get_file('bank_users.json')
-    user = next((u for u in users if u.get('telegram_id') == session['user_id']), None)
+    if SHARDED:
+        account_file = user_file(session['user_id'], 'account.json')
+        user, u_sha = storage_get(account_file)
+    else:
+        account_file = 'bank_users.json'
+        users, u_sha = storage_get(account_file)
+        user = next((u for u in users if u.get('telegram_id') == session['user_id']), None)
     
     if not user or user['balance'] < total:
         return jsonify({'success': False, 'error': 'Insufficient funds'}), 400
@@ -417,18 +1594,57 @@ def shop_purchase():
     
     user['balance'] -= total
     
-    github_put_file('shop_products.json', products, p_sha)
-    github_put_file('bank_users.json', users, u_sha)
+    saved = storage_commit(
+        {'shop_products.json': products, account_file: user if SHARDED else users},
+        f"Purchase by {session['username']}",
+        expected_shas={'shop_products.json': p_sha, account_file: u_sha}
+    )
+    if not saved:
+        return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
     
+    event_bus.publish([session['user_id']], 'balance', {'balance': user['balance']})
+    _publish_sale(cart, products)
     return jsonify({'success': True, 'balance': user['balance']})
 
+def _publish_sale(cart, products):
+    """Tell the owners of the stores the cart bought from"""
+    sold = {}
+    for item in cart:
+        product = next(p for p in products if p['id'] == item['id'])
+        if product.get('storeId') is not None:
+            sold.setdefault(product['storeId'], []).append({'id': product['id'], 'title': product.get('title'), 'qty': item['qty']})
+    if not sold:
+        return
+    stores, _ = storage_get('shop_stores.json')
+    for store in stores or []:
+        if store.get('id') in sold and store.get('owner_telegram_id'):
+            items = sold[store['id']]
+            event_bus.publish([store['owner_telegram_id']], 'notification', {
+                'type': 'sale',
+                'buyer': session['username'],
+                'items': items,
+                'message': f"{session['username']} bought " + ', '.join(f"{i['title']} x{i['qty']}" for i in items)
+            })
+
 # ==================== MYWORK API ====================
 
 @app.route('/api/mywork/start-shift', methods=['POST'])
 @require_auth
 def start_shift():
     """Start a work shift"""
-    running, sha = github_get_file('mywork_running.json')
+    if SHARDED:
+        path = user_file(session['user_id'], 'mywork.json')
+        mywork, sha = storage_get(path)
+        mywork = mywork or {'running': None, 'shifts': []}
+        if mywork['running']:
+            return jsonify({'success': False, 'error': 'Shift already started'}), 400
+        mywork['running'] = datetime.now().isoformat()
+        if not storage_commit({path: mywork}, f"Start shift for {session['username']}", {path: sha}):
+            return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
+        event_bus.publish([session['user_id']], 'shift', {'running': mywork['running']})
+        return jsonify({'success': True})
+    
+    running, sha = storage_get('mywork_running.json')
     if running is None:
         running = {}
     
@@ -437,8 +1653,10 @@ def start_shift():
         return jsonify({'success': False, 'error': 'Shift already started'}), 400
     
     running[username] = datetime.now().isoformat()
-    github_put_file('mywork_running.json', running, sha)
+    if not storage_commit({'mywork_running.json': running}, f"Start shift for {username}", {'mywork_running.json': sha}):
+        return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
     
+    event_bus.publish([session['user_id']], 'shift', {'running': running[username]})
     return jsonify({'success': True})
 
 @app.route('/api/mywork/stop-shift', methods=['POST'])
@@ -449,17 +1667,33 @@ def stop_shift():
     minutes = data.get('minutes', 0)
     pay = data.get('pay', 0)
     
-    running, r_sha = github_get_file('mywork_running.json')
+    if SHARDED:
+        path = user_file(session['user_id'], 'mywork.json')
+        mywork, sha = storage_get(path)
+        if not mywork or not mywork['running']:
+            return jsonify({'success': False, 'error': 'No active shift'}), 400
+        mywork['shifts'].insert(0, {
+            'start': mywork['running'],
+            'end': datetime.now().isoformat(),
+            'minutes': minutes,
+            'pay': pay
+        })
+        mywork['running'] = None
+        if not storage_commit({path: mywork}, f"Stop shift for {session['username']}", {path: sha}):
+            return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
+        event_bus.publish([session['user_id']], 'shift', {'running': None, 'shift': mywork['shifts'][0]})
+        return jsonify({'success': True})
+    
+    running, r_sha = storage_get('mywork_running.json')
     username = session['username']
     
     if not running or username not in running:
         return jsonify({'success': False, 'error': 'No active shift'}), 400
     
     start_time = running.pop(username)
-    github_put_file('mywork_running.json', running, r_sha)
     
     # Save shift
-    shifts, s_sha = github_get_file('mywork_shifts.json')
+    shifts, s_sha = storage_get('mywork_shifts.json')
     if shifts is None:
         shifts = {}
     
@@ -473,15 +1707,26 @@ def stop_shift():
         'pay': pay
     })
     
-    github_put_file('mywork_shifts.json', shifts, s_sha)
+    saved = storage_commit(
+        {'mywork_running.json': running, 'mywork_shifts.json': shifts},
+        f"Stop shift for {username}",
+        expected_shas={'mywork_running.json': r_sha, 'mywork_shifts.json': s_sha}
+    )
+    if not saved:
+        return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
     
+    event_bus.publish([session['user_id']], 'shift', {'running': None, 'shift': shifts[username][0]})
     return jsonify({'success': True})
 
 @app.route('/api/mywork/shifts', methods=['GET'])
 @require_auth
 def get_shifts():
     """Get user's shift history"""
-    shifts, _ = github_get_file('mywork_shifts.json')
+    if SHARDED:
+        mywork, _ = storage_get(user_file(session['user_id'], 'mywork.json'))
+        return jsonify(mywork['shifts'] if mywork else [])
+    
+    shifts, _ = storage_get('mywork_shifts.json')
     if not shifts:
         return jsonify([])
     
@@ -494,7 +1739,11 @@ def get_shifts():
 @require_auth
 def get_myinfo_records():
     """Get user's info records"""
-    records, _ = github_get_file('myinfo_records.json')
+    if SHARDED:
+        records, _ = storage_get(user_file(session['user_id'], 'myinfo.json'))
+        return jsonify(records or {})
+    
+    records, _ = storage_get('myinfo_records.json')
     if not records:
         return jsonify({})
     
@@ -507,17 +1756,119 @@ def save_myinfo_records():
     """Save user's info records"""
     data = request.json
     
-    records, sha = github_get_file('myinfo_records.json')
+    if SHARDED:
+        path = user_file(session['user_id'], 'myinfo.json')
+        _, sha = storage_get(path)
+        if not storage_commit({path: data}, f"Update records for {session['username']}", {path: sha}):
+            return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
+        return jsonify({'success': True})
+    
+    records, sha = storage_get('myinfo_records.json')
     if records is None:
         records = {}
     
     username = session['username']
     records[username] = data
     
-    github_put_file('myinfo_records.json', records, sha)
+    if not storage_commit({'myinfo_records.json': records}, f"Update records for {username}", {'myinfo_records.json': sha}):
+        return jsonify({'success': False, 'error': 'Storage conflict, try again'}), 409
     
     return jsonify({'success': True})
 
+# ==================== BATCH API ====================
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Run several API calls in one round trip
+
+    Body: {'requests': [{'method': 'GET', 'path': '/api/...', 'body': {...}}]}.
+    Sub-requests run in order with the caller's session, and a storage file
+    read by one of them is not fetched again by the next. Returns
+    {'responses': [{'status', 'body'}]} in the same order.
+    """
+    calls = (request.get_json(silent=True) or {}).get('requests')
+    if not isinstance(calls, list) or not 1 <= len(calls) <= BATCH_MAX:
+        return jsonify({'success': False, 'error': f'requests must be a list of 1 to {BATCH_MAX} calls'}), 400
+    for call in calls:
+        path = call.get('path') if isinstance(call, dict) else None
+        if not isinstance(path, str) or not path.startswith('/api/') or urlparse(path).path in ('/api/batch', '/api/events'):
+            return jsonify({'success': False, 'error': f'Invalid call {call!r}'}), 400
+    
+    g.batch_reads = {}
+    outer_session = session._get_current_object()
+    responses = []
+    for call in calls:
+        environ = EnvironBuilder(path=call['path'], method=call.get('method', 'GET').upper(), json=call.get('body')).get_environ()
+        ctx = app.request_context(environ)
+        ctx.session = outer_session  # logins and logouts land in the batch response's cookie
+        with ctx:
+            try:
+                response = app.full_dispatch_request()
+            except Exception as e:
+                print(f"Batch call {call['path']} failed: {e}")
+                responses.append({'status': 500, 'body': {'success': False, 'error': str(e)}})
+                continue
+            responses.append({'status': response.status_code, 'body': response.get_json(silent=True)})
+    return jsonify({'responses': responses})
+
+# ==================== EVENTS API ====================
+
+@app.route('/api/events', methods=['GET'])
+@require_auth
+def get_events():
+    """Server-Sent Events for the current user, instead of polling
+
+    Events: balance {balance}, transfer {history entry} for incoming
+    transfers, notification {type, message, ...}, shift {running, shift},
+    and reset when missed events can't be replayed. Reconnects resume from
+    the Last-Event-ID header (or ?last_event_id=, for a fresh EventSource).
+    503 when EVENTS_MAX_STREAMS streams are open; the client polls instead.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    stream = event_bus.stream(session['user_id'], last_event_id, EVENTS_HEARTBEAT, EVENTS_MAX_STREAMS)
+    if stream is None:
+        return jsonify({'success': False, 'error': 'Too many open event streams'}), 503
+    return Response(stream_with_context(stream), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # nginx: don't hold events back in its buffer
+    })
+
+# ==================== CHANGES API ====================
+
+@app.route('/api/changes', methods=['GET'])
+@require_auth
+def get_changes():
+    """Records created, updated or deleted since a cursor
+
+    Query: since=<cursor from the previous response>, collections=a,b
+    (default: all of FEED_COLLECTIONS), limit (default and max 1000).
+    Returns {'changes': [{seq, collection, id, op: put|delete, data}],
+    'cursor', 'more'}. Without since, or with a cursor past the compaction
+    horizon, returns {'reset': True, 'cursor'}: reload the collections with
+    their GET endpoints and continue from that cursor.
+    """
+    names = request.args.get('collections')
+    names = names.split(',') if names else list(FEED_COLLECTIONS)
+    unknown = [name for name in names if name not in FEED_COLLECTIONS]
+    try:
+        limit = int(request.args.get('limit', CHANGES_PAGE_MAX))
+        if unknown or not 1 <= limit <= CHANGES_PAGE_MAX:
+            raise ValueError
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid parameters'}), 400
+    
+    # Reading the sources brings the feed up to date with other writers
+    for name in names:
+        for file_path in feed_sources(name):
+            storage_get(file_path)
+    
+    owners = {None, session['user_id'], session['username']}
+    page = change_feed.since(request.args.get('since'), set(names), owners, limit)
+    if page is None:
+        return jsonify({'reset': True, 'cursor': change_feed.cursor()})
+    changes, cursor, more = page
+    return jsonify({'changes': changes, 'cursor': cursor, 'more': more})
+
 # ==================== HEALTH & INIT ====================
 
 @app.route('/api/health', methods=['GET'])
@@ -527,33 +1878,45 @@ def health_check():
         'status': 'ok',
         'timestamp': datetime.now().isoformat(),
         'github_configured': GITHUB_TOKEN != 'YOUR_GITHUB_TOKEN_HERE',
-        'bot_configured': BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE'
+        'bot_configured': BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE',
+        'github': github_client.stats(),
+        'write_behind_pending': _write_behind.pending() if _write_behind else None,
+        'event_streams': event_bus.subscribers()
     })
 
 @app.route('/api/init', methods=['POST'])
 def initialize_storage():
     """Initialize GitHub storage with default data"""
     try:
-        # Initialize bank users
-        github_put_file('bank_users.json', [])
-        github_put_file('bank_history.json', [])
-        
-        # Initialize shop
-        github_put_file('shop_products.json', [
-            {'id': 1, 'title': 'Смартфон', 'description': 'Современный смартфон', 'price': 2500, 'stock': 5, 'category': 'electronics', 'icon': '📱', 'soldCount': 0},
-            {'id': 2, 'title': 'Ноутбук', 'description': 'Мощный ноутбук', 'price': 5000, 'stock': 3, 'category': 'electronics', 'icon': '💻', 'soldCount': 0},
-        ])
-        github_put_file('shop_stores.json', [])
-        
-        # Initialize mywork
-        github_put_file('mywork_shifts.json', {})
-        github_put_file('mywork_running.json', {})
-        
-        # Initialize myinfo
-        github_put_file('myinfo_records.json', {})
+        files = {
+            # Bank
+            'bank_users.json': [],
+            # Shop
+            'shop_products.json': [
+                {'id': 1, 'title': 'Смартфон', 'description': 'Современный смартфон', 'price': 2500, 'stock': 5, 'category': 'electronics', 'icon': '📱', 'soldCount': 0},
+                {'id': 2, 'title': 'Ноутбук', 'description': 'Мощный ноутбук', 'price': 5000, 'stock': 3, 'category': 'electronics', 'icon': '💻', 'soldCount': 0},
+            ],
+            'shop_stores.json': [],
+            # MyWork
+            'mywork_shifts.json': {},
+            'mywork_running.json': {},
+            # MyInfo
+            'myinfo_records.json': {},
+            # Users
+            'users.json': [],
+        }
+        if SHARDED:
+            # Per-user files are created on first use
+            for name in ('bank_users.json', 'mywork_shifts.json', 'mywork_running.json', 'myinfo_records.json'):
+                del files[name]
+            files[USER_INDEX] = []
+        else:
+            files.update(bank_history().reset())
+        files.update(user_directory.log.reset())
         
-        # Initialize users
-        github_put_file('users.json', [])
+        if not storage_commit(files, 'Initialize storage'):
+            return jsonify({'success': False, 'error': 'Failed to write to GitHub'}), 500
+        user_directory.reset()
         
         return jsonify({'success': True, 'message': 'Storage initialized'})
     except Exception as e:
@@ -567,9 +1930,17 @@ if __name__ == '__main__':
         print("export GITHUB_REPO='username/repository'")
         exit(1)
     
+    if sys.argv[1:] == ['migrate-sharded']:
+        exit(0 if migrate_to_sharded() else 1)
+    if sys.argv[1:] == ['reindex-history']:
+        exit(0 if reindex_history() else 1)
+    
     print("🚀 HomeOS Multi-User Server v2")
     print(f"📦 GitHub Repo: {GITHUB_REPO}")
     print(f"🌿 Branch: {GITHUB_BRANCH}")
+    print(f"🗂  Layout: {STORAGE_LAYOUT}")
+    if WRITE_BEHIND:
+        print(f"📝 Write-behind journal: {os.path.abspath(JOURNAL_PATH)} (flush every {FLUSH_INTERVAL}s, single worker only)")
     
     # Check BOT_TOKEN (warning only, not fatal)
     if BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
@@ -29,14 +29,26 @@ CURRENCY=MT$
 STORE_PRICE=1000
 # Platform fee in percent (e.g., 5 means 5%)
 PLATFORM_FEE_PCT=5
-# DB driver: json (default) or sqlite (reserved for future extension)
+# DB driver: json (default) or sqlite (indexed tables in data/SQLITE_DB, imports existing json on first start)
 DB_DRIVER=json
+SQLITE_DB=shop.db
 # Telegram bot token to validate initData (optional). If empty, Telegram validation is skipped.
 TELEGRAM_BOT_TOKEN=
+# initData older than this many seconds (auth_date) is rejected; 0 disables the check
+TELEGRAM_INIT_MAX_AGE=86400
+# Verified initData -> user cache: max entries and seconds before re-verifying
+AUTH_CACHE_SIZE=10000
+AUTH_CACHE_TTL=300
 # Escrow auto-release timeout in hours
 ESCROW_TIMEOUT_HOURS=72
 # Platform escrow account ID in the bank adapter
 PLATFORM_ACCOUNT_ID=platform_escrow
+# Seconds between checks for catalog changes written by other processes
+CATALOG_SYNC_SECONDS=2
+# Where the catalog's price facet buckets start (the first one starts at 0)
+CATALOG_PRICE_BUCKETS=100,500,1000,5000
+# Rendered /api/catalog responses kept in memory (LRU)
+CATALOG_CACHE_SIZE=1000
 # Flask
 FLASK_APP=app.py
 FLASK_DEBUG=1
@@ -151,42 +163,538 @@ class BankAdapter:
 # Repositories
 repo_base = r"""
 import os, json, threading, uuid
+from bisect import bisect_left
+from contextlib import contextmanager
 from typing import List, Dict, Optional, Any
 
-_lock = threading.Lock()
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking
+    fcntl = None
+
+DB_DRIVER = os.getenv("DB_DRIVER", "json").strip().lower()
+
+class _RWLock:
+    # Many readers or one writer; a waiting writer blocks new readers so a
+    # steady stream of reads can't starve it.
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+_registry_lock = threading.Lock()
+_file_locks: Dict[str, _RWLock] = {}
+
+def _rwlock_for(path: str) -> _RWLock:
+    with _registry_lock:
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = _file_locks[path] = _RWLock()
+        return lock
+
+@contextmanager
+def _process_lock(lock_path: str):
+    # Exclusive flock on a sidecar file so gunicorn workers serialize their
+    # read-modify-write cycles. Readers don't need it: writes land via
+    # os.replace, so a reader always opens either the old or the new file.
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class _Snapshot:
+    # Parsed contents of one json file plus hash indexes and sorted groups
+    # over it. Both are built on first use and thrown away with the snapshot.
+    __slots__ = ("sig", "items", "indexes", "orders")
+
+    def __init__(self, sig, items: List[Dict[str, Any]]):
+        self.sig = sig
+        self.items = items
+        self.indexes: Dict[Any, Dict[Any, List[Dict]]] = {}
+        self.orders: Dict[tuple, List[tuple]] = {}
+
+    def index(self, field: str, key=None) -> Optional[Dict[Any, List[Dict]]]:
+        # key: applied to each value before it's hashed, see JsonRepoBase._key
+        name = field if key is None else (field, key)
+        idx = self.indexes.get(name)
+        if idx is None:
+            idx = {}
+            try:
+                for item in self.items:
+                    value = item.get(field)
+                    idx.setdefault(value if key is None else key(value), []).append(item)
+            except TypeError:
+                return None  # unhashable values: caller falls back to a scan
+            self.indexes[name] = idx
+        return idx
+
+    def ordered(self, field: Optional[str], value, order_by: str, value_of=None) -> List[tuple]:
+        # (order_by value, id, item) for the items whose value_of(item) ==
+        # value (all items when field is None), ascending. value_of defaults
+        # to item.get(field) and must be the same on every call for field.
+        key = (field, value, order_by)
+        group = self.orders.get(key)
+        if group is None:
+            if value_of is None:
+                value_of = lambda it: it.get(field)
+            members = self.items if field is None else [it for it in self.items if value_of(it) == value]
+            entries = sorted((_order_entry(it, order_by) for it in members), key=lambda e: e[:2])
+            group = self.orders[key] = (value_of, entries)
+        return group[1]
+
+    def carry_orders(self, old: "_Snapshot"):
+        # Take over old's sorted groups, patched for the records that differ
+        # between the two snapshots instead of sorted again. Unchanged records
+        # keep pointing at old's dicts, which are equal to this one's.
+        if not old.orders:
+            return
+        before = {str(it.get("id")): it for it in old.items}
+        after = {str(it.get("id")): it for it in self.items}
+        if len(before) != len(old.items) or len(after) != len(self.items):
+            return  # duplicate ids: let ordered() sort from scratch
+        changed = [(before.get(i), after.get(i)) for i in before.keys() | after.keys() if before.get(i) != after.get(i)]
+        for (field, value, order_by), (value_of, entries) in old.orders.items():
+            entries = list(entries)  # old's list may still be read by another thread
+            for was, now in changed:
+                if was is not None and (field is None or value_of(was) == value):
+                    del entries[bisect_left(entries, _order_entry(was, order_by)[:2])]
+                if now is not None and (field is None or value_of(now) == value):
+                    entry = _order_entry(now, order_by)
+                    entries.insert(bisect_left(entries, entry[:2]), entry)
+            self.orders[(field, value, order_by)] = (value_of, entries)
+
+def _order_entry(item: Dict, order_by: str) -> tuple:
+    return (str(item.get(order_by) or ""), str(item.get("id")), item)
+
+# Shared by every repository instance pointing at the same file
+_snapshots: Dict[str, _Snapshot] = {}
+# file -> (version before, version after) of the calling thread's last write
+_last_writes = threading.local()
+
+def _thread_writes() -> Dict[str, tuple]:
+    writes = getattr(_last_writes, "by_file", None)
+    if writes is None:
+        writes = _last_writes.by_file = {}
+    return writes
+
+def _file_sig(path: str):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
 
 class JsonRepoBase:
+    # Fields subclasses look records up by (see find_one / find_all)
+    index_fields: tuple = ()
+    # Field page() orders by, newest first
+    page_order: str = "created_at"
+    # What page() takes a missing or null field for, e.g. {"is_blocked": False}
+    page_defaults: Dict[str, Any] = {}
+
     def __init__(self, data_dir: str, file_name: str):
         self.data_dir = data_dir
         self.file_path = os.path.join(data_dir, file_name)
+        self._cache_key = os.path.abspath(self.file_path)
+        self._rw = _rwlock_for(self._cache_key)
+        self._lock_path = self.file_path + ".lock"
         os.makedirs(data_dir, exist_ok=True)
         if not os.path.exists(self.file_path):
-            with open(self.file_path, "w", encoding="utf-8") as f:
-                json.dump([], f, ensure_ascii=False)
-
-    def _read_all(self) -> List[Dict[str, Any]]:
-        with _lock:
+            with self._rw.write(), _process_lock(self._lock_path):
+                if not os.path.exists(self.file_path):
+                    with open(self.file_path, "w", encoding="utf-8") as f:
+                        json.dump([], f, ensure_ascii=False)
+
+    def _load(self) -> _Snapshot:
+        # Re-parse only when the file changed on disk (this or another process).
+        # Caller holds this file's read or write lock.
+        sig = _file_sig(self.file_path)
+        snap = _snapshots.get(self._cache_key)
+        if snap is None or snap.sig != sig:
             with open(self.file_path, "r", encoding="utf-8") as f:
                 try:
-                    return json.load(f)
+                    items = json.load(f)
                 except json.JSONDecodeError:
-                    return []
+                    items = []
+            snap = _snapshots[self._cache_key] = _Snapshot(sig, items)
+        return snap
+
+    def _snapshot(self) -> _Snapshot:
+        with self._rw.read():
+            return self._load()
+
+    @staticmethod
+    def _key(value) -> Optional[str]:
+        # index_fields match by their string form, like the sqlite driver's
+        # columns: a record's telegram_id 123 is found by "123"
+        return None if value is None else str(value)
+
+    def _lookup(self, field: str, value) -> List[Dict]:
+        snap = self._snapshot()
+        if field in self.index_fields:
+            return snap.index(field, self._key).get(self._key(value), [])
+        idx = snap.index(field)
+        if idx is None:
+            return [it for it in snap.items if it.get(field) == value]
+        try:
+            return idx.get(value, [])
+        except TypeError:
+            return []
+
+    def _read_all(self) -> List[Dict[str, Any]]:
+        # Shallow copies, so callers editing a record can't touch the cache
+        return [dict(it) for it in self._snapshot().items]
 
     def _write_all(self, data: List[Dict[str, Any]]):
-        with _lock:
-            tmp = self.file_path + ".tmp"
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            os.replace(tmp, self.file_path)
+        # Caller holds the write lock (see _mutate)
+        tmp = self.file_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.file_path)
+        snap = _Snapshot(_file_sig(self.file_path), [dict(it) for it in data])
+        old = _snapshots.get(self._cache_key)
+        if old is not None:
+            snap.carry_orders(old)
+        _snapshots[self._cache_key] = snap
+
+    def _mutate(self, fn):
+        # Read-modify-write under this file's exclusive lock, in-process and
+        # across processes. fn edits the list in place; raising aborts the write.
+        with self._rw.write(), _process_lock(self._lock_path):
+            before = _file_sig(self.file_path)
+            data = [dict(it) for it in self._load().items]
+            result = fn(data)
+            self._write_all(data)
+            _thread_writes()[self._cache_key] = (before, _file_sig(self.file_path))
+            return result
 
     def list(self) -> List[Dict]:
         return self._read_all()
 
+    def version(self):
+        # Changes whenever the file is rewritten, by this process or another
+        return _file_sig(self.file_path)
+
+    def last_write(self) -> Optional[tuple]:
+        # (version before, version after) of this thread's last write to the
+        # file, by any repository instance; lets a cache over the file tell
+        # its own write from one by another process that came first
+        return _thread_writes().get(self._cache_key)
+
     def get(self, _id: str) -> Optional[Dict]:
-        for item in self._read_all():
-            if item.get("id") == _id:
-                return item
-        return None
+        found = self._lookup("id", _id)
+        return dict(found[0]) if found else None
+
+    def get_many(self, ids) -> Dict[str, Dict]:
+        # {id: record} for those of ids that exist, all from one snapshot
+        snap = self._snapshot()
+        idx = snap.index("id")
+        found = {}
+        for _id in ids:
+            try:
+                hits = idx.get(_id) if idx is not None else [it for it in snap.items if it.get("id") == _id]
+            except TypeError:
+                continue
+            if hits:
+                found[_id] = dict(hits[0])
+        return found
+
+    def require(self, _id: str) -> Dict:
+        found = self.get(_id)
+        if not found:
+            raise ValueError("Not found")
+        return found
+
+    def find_one(self, field: str, value) -> Optional[Dict]:
+        found = self._lookup(field, value)
+        return dict(found[0]) if found else None
+
+    def find_all(self, field: str, value) -> List[Dict]:
+        return [dict(it) for it in self._lookup(field, value)]
+
+    def page(self, field: Optional[str] = None, value=None, after: Optional[List[str]] = None, limit: int = 20) -> List[Dict]:
+        # Up to limit records with field == value (all when field is None),
+        # newest first by (page_order, id); after: that pair for the last
+        # record of the previous page
+        if field is not None and field in self.index_fields:
+            value = self._key(value)
+        entries = self._snapshot().ordered(field, value, self.page_order, self._page_value(field))
+        end = len(entries) if after is None else bisect_left(entries, (str(after[0]), str(after[1])))
+        return [dict(e[2]) for e in reversed(entries[max(end - limit, 0):end])]
+
+    def _page_value(self, field: Optional[str]):
+        # item -> what page() compares with the value asked for: index_fields
+        # by their string form, as in _lookup, and page_defaults filled in
+        default = self.page_defaults.get(field)
+        def value_of(item):
+            found = item.get(field)
+            if found is None:
+                found = default
+            return self._key(found) if field in self.index_fields else found
+        return value_of
+
+    def cursor(self, item: Dict) -> List[str]:
+        # The `after` of the page that follows item
+        return [str(item.get(self.page_order) or ""), str(item.get("id"))]
+
+    def create(self, item: Dict) -> Dict:
+        if "id" not in item or not item["id"]:
+            item["id"] = str(uuid.uuid4())
+        def apply(data):
+            data.append(item)
+            return item
+        return self._mutate(apply)
+
+    def update(self, _id: str, new_item: Dict) -> Dict:
+        def apply(data):
+            for i, it in enumerate(data):
+                if it.get("id") == _id:
+                    data[i] = new_item
+                    return new_item
+            raise ValueError("Not found")
+        return self._mutate(apply)
+
+    def update_many(self, items: List[Dict]) -> List[Dict]:
+        # update() for every item, by its id, in a single rewrite; if any of
+        # them doesn't exist nothing is written
+        def apply(data):
+            pending = {it["id"]: it for it in items}
+            for i, it in enumerate(data):
+                new_item = pending.pop(it.get("id"), None)
+                if new_item is not None:
+                    data[i] = new_item
+            if pending:
+                raise ValueError("Not found")
+            return items
+        return self._mutate(apply)
+
+    def modify_many(self, ids, fn) -> Dict[str, Dict]:
+        # fn({id: record}) for those of ids that exist, read and written back
+        # under the write lock, so nothing changes them in between. fn edits
+        # the records in place; raising aborts the write.
+        wanted = set(ids)
+        def apply(data):
+            found = {it["id"]: it for it in data if it.get("id") in wanted}
+            fn(found)
+            return found
+        return self._mutate(apply)
+
+    def delete(self, _id: str):
+        def apply(data):
+            data[:] = [it for it in data if it.get("id") != _id]
+        self._mutate(apply)
+
+def _driver_base():
+    if DB_DRIVER == "sqlite":
+        from .sqlite_repo import SqliteRepoBase
+        return SqliteRepoBase
+    if DB_DRIVER != "json":
+        raise ValueError(f"Unknown DB_DRIVER: {DB_DRIVER}")
+    return JsonRepoBase
+
+# Base class every repository subclasses; chosen once from DB_DRIVER
+RepoBase = _driver_base()
+"""
+
+repo_sqlite = r"""
+import os, json, sqlite3, threading, uuid
+from typing import List, Dict, Optional, Any
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+
+class SqliteRepoBase:
+    # One table per collection: the record is kept as JSON in `data`, and every
+    # field in index_fields is copied into its own indexed column.
+    index_fields: tuple = ()
+    page_order: str = "created_at"
+    page_defaults: Dict[str, Any] = {}
+
+    def __init__(self, data_dir: str, file_name: str):
+        self.data_dir = data_dir
+        self.db_path = os.path.join(data_dir, os.getenv("SQLITE_DB", "shop.db"))
+        self.json_path = os.path.join(data_dir, file_name)
+        self.table = os.path.splitext(file_name)[0]
+        os.makedirs(data_dir, exist_ok=True)
+        self._init_schema()
+
+    def _conn(self) -> sqlite3.Connection:
+        conns = getattr(_local, "conns", None)
+        if conns is None:
+            conns = _local.conns = {}
+        conn = conns.get(self.db_path)
+        if conn is None:
+            # Autocommit mode; multi-statement writes open their own transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conns[self.db_path] = conn
+        return conn
+
+    def _init_schema(self):
+        # One IMMEDIATE transaction, so of several workers starting together
+        # only the first creates the table and imports the json file
+        with _schema_lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._create_schema(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (self.table,)
+        ).fetchone()
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table}" (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{self.table}")')}
+        for field in self.index_fields:
+            if field not in columns:
+                conn.execute(f'ALTER TABLE "{self.table}" ADD COLUMN "{field}" TEXT')
+                conn.execute(f'UPDATE "{self.table}" SET "{field}" = json_extract(data, ?)', (f"$.{field}",))
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{self.table}_{field}" ON "{self.table}" ("{field}")')
+        if self.page_order in self.index_fields:
+            # page(): one index walk per filter field, newest first. The
+            # expression must match _page_order() for SQLite to use the index.
+            order = f"{self._page_order()}, id"
+            conn.execute(f'DROP INDEX IF EXISTS "ix_{self.table}_page"')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{self.table}_keyset" ON "{self.table}" ({order})')
+            for field in self.index_fields:
+                if field != self.page_order:
+                    conn.execute(f'DROP INDEX IF EXISTS "ix_{self.table}_{field}_page"')
+                    conn.execute(
+                        f'CREATE INDEX IF NOT EXISTS "ix_{self.table}_{field}_keyset" ON "{self.table}" ("{field}", {order})'
+                    )
+        # Per-table write counter behind version(), bumped by triggers so
+        # writes from every connection and process count
+        conn.execute('CREATE TABLE IF NOT EXISTS "_versions" (tbl TEXT PRIMARY KEY, n INTEGER NOT NULL)')
+        conn.execute('INSERT OR IGNORE INTO "_versions" (tbl, n) VALUES (?, 0)', (self.table,))
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f'CREATE TRIGGER IF NOT EXISTS "tr_{self.table}_{op.lower()}" AFTER {op} ON "{self.table}" '
+                f'BEGIN UPDATE "_versions" SET n = n + 1 WHERE tbl = \'{self.table}\'; END'
+            )
+        if not exists:
+            self._import_json(conn)
+
+    def _import_json(self, conn: sqlite3.Connection):
+        # First start on sqlite: carry over whatever the json driver left behind
+        if not os.path.exists(self.json_path):
+            return
+        with open(self.json_path, "r", encoding="utf-8") as f:
+            try:
+                items = json.load(f)
+            except json.JSONDecodeError:
+                items = []
+        for item in items:
+            if not item.get("id"):
+                item["id"] = str(uuid.uuid4())
+            self._insert(conn, item)
+
+    @staticmethod
+    def _key(value) -> Optional[str]:
+        return None if value is None else str(value)
+
+    def _row_values(self, item: Dict) -> list:
+        return [self._key(item.get(field)) for field in self.index_fields]
+
+    def _insert(self, conn: sqlite3.Connection, item: Dict):
+        cols = ", ".join(["id", "data"] + [f'"{f}"' for f in self.index_fields])
+        marks = ", ".join("?" * (2 + len(self.index_fields)))
+        conn.execute(
+            f'INSERT INTO "{self.table}" ({cols}) VALUES ({marks})',
+            [str(item["id"]), json.dumps(item, ensure_ascii=False)] + self._row_values(item),
+        )
+
+    def _select(self, where: str = "", params: tuple = (), limit: Optional[int] = None) -> List[Dict]:
+        sql = f'SELECT data FROM "{self.table}"'
+        if where:
+            sql += f" WHERE {where}"
+        sql += " ORDER BY rowid"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [json.loads(row[0]) for row in self._conn().execute(sql, params)]
+
+    def list(self) -> List[Dict]:
+        return self._select()
+
+    def version(self):
+        return self._version(self._conn())
+
+    def _version(self, conn: sqlite3.Connection):
+        row = conn.execute('SELECT n FROM "_versions" WHERE tbl = ?', (self.table,)).fetchone()
+        return row[0] if row else None
+
+    def last_write(self) -> Optional[tuple]:
+        # (version before, version after) of this thread's last write to the table
+        return getattr(_local, "writes", {}).get((self.db_path, self.table))
+
+    def _write(self, fn):
+        # fn(conn) in one IMMEDIATE transaction, noting the table's version
+        # around it for last_write()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            before = self._version(conn)
+            result = fn(conn)
+            after = self._version(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if getattr(_local, "writes", None) is None:
+            _local.writes = {}
+        _local.writes[(self.db_path, self.table)] = (before, after)
+        return result
+
+    def get(self, _id: str) -> Optional[Dict]:
+        rows = self._select("id = ?", (self._key(_id),), limit=1)
+        return rows[0] if rows else None
+
+    def get_many(self, ids) -> Dict[str, Dict]:
+        keys = {self._key(_id): _id for _id in ids}
+        found = {}
+        chunk = list(keys)
+        # Stay under SQLite's limit on bound parameters
+        for start in range(0, len(chunk), 500):
+            part = chunk[start:start + 500]
+            for item in self._select(f"id IN ({', '.join('?' * len(part))})", tuple(part)):
+                found[keys[self._key(item["id"])]] = item
+        return found
 
     def require(self, _id: str) -> Dict:
         found = self.get(_id)
@@ -194,47 +702,113 @@ class JsonRepoBase:
             raise ValueError("Not found")
         return found
 
+    def find_one(self, field: str, value) -> Optional[Dict]:
+        rows = self.find_all(field, value, limit=1)
+        return rows[0] if rows else None
+
+    def find_all(self, field: str, value, limit: Optional[int] = None) -> List[Dict]:
+        if field == "id":
+            found = self.get(value)
+            return [found] if found else []
+        if field in self.index_fields:
+            return self._select(f'"{field}" = ?', (self._key(value),), limit=limit)
+        return self._select("json_extract(data, ?) = ?", (f"$.{field}", value), limit=limit)
+
+    def _page_order(self) -> str:
+        # A missing page_order sorts as "", like the json driver's cursor()
+        if self.page_order in self.index_fields:
+            return f'COALESCE("{self.page_order}", \'\')'
+        return f"COALESCE(json_extract(data, '$.{self.page_order}'), '')"
+
+    def page(self, field: Optional[str] = None, value=None, after: Optional[List[str]] = None, limit: int = 20) -> List[Dict]:
+        # The same expression as the (field, page_order, id) indexes, so they serve the ORDER BY
+        order = self._page_order()
+        where, params = [], []
+        if field is not None:
+            default = self.page_defaults.get(field)
+            if field in self.index_fields:
+                column, value, default = f'"{field}"', self._key(value), self._key(default)
+            else:
+                column = "json_extract(data, ?)"
+                params.append(f"$.{field}")
+            if default is not None:
+                column = f"COALESCE({column}, ?)"
+                params.append(default)
+            where.append(f"{column} = ?")
+            params.append(value)
+        if after is not None:
+            where.append(f"({order}, id) < (?, ?)")
+            params += [str(after[0]), str(after[1])]
+        sql = f'SELECT data FROM "{self.table}"'
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order} DESC, id DESC LIMIT {int(limit)}"
+        return [json.loads(row[0]) for row in self._conn().execute(sql, params)]
+
+    def cursor(self, item: Dict) -> List[str]:
+        return [str(item.get(self.page_order) or ""), str(item.get("id"))]
+
     def create(self, item: Dict) -> Dict:
-        data = self._read_all()
         if "id" not in item or not item["id"]:
             item["id"] = str(uuid.uuid4())
-        data.append(item)
-        self._write_all(data)
+        self._write(lambda conn: self._insert(conn, item))
         return item
 
+    def _update(self, conn: sqlite3.Connection, _id: str, new_item: Dict):
+        sets = ", ".join(["data = ?"] + [f'"{f}" = ?' for f in self.index_fields])
+        cur = conn.execute(
+            f'UPDATE "{self.table}" SET {sets} WHERE id = ?',
+            [json.dumps(new_item, ensure_ascii=False)] + self._row_values(new_item) + [self._key(_id)],
+        )
+        if cur.rowcount == 0:
+            raise ValueError("Not found")
+
     def update(self, _id: str, new_item: Dict) -> Dict:
-        data = self._read_all()
-        for i, it in enumerate(data):
-            if it.get("id") == _id:
-                data[i] = new_item
-                self._write_all(data)
-                return new_item
-        raise ValueError("Not found")
+        self._write(lambda conn: self._update(conn, _id, new_item))
+        return new_item
+
+    def update_many(self, items: List[Dict]) -> List[Dict]:
+        def apply(conn):
+            for item in items:
+                self._update(conn, item["id"], item)
+        self._write(apply)
+        return items
+
+    def modify_many(self, ids, fn) -> Dict[str, Dict]:
+        # fn({id: record}) for those of ids that exist, read and written back
+        # in one IMMEDIATE transaction; raising rolls it back
+        def apply(conn):
+            found = self.get_many(ids)  # this thread's connection, inside the transaction
+            fn(found)
+            for item in found.values():
+                self._update(conn, item["id"], item)
+            return found
+        return self._write(apply)
 
     def delete(self, _id: str):
-        data = self._read_all()
-        data = [it for it in data if it.get("id") != _id]
-        self._write_all(data)
+        self._write(lambda conn: conn.execute(f'DELETE FROM "{self.table}" WHERE id = ?', (self._key(_id),)))
 """
 
 users_repo = r"""
-from .repo_base import JsonRepoBase
+from .repo_base import RepoBase
+
+class UsersRepo(RepoBase):
+    index_fields = ("telegram_id",)
 
-class UsersRepo(JsonRepoBase):
     def __init__(self, data_dir: str):
         super().__init__(data_dir, "users.json")
 
     def find_by_telegram(self, telegram_id: str):
-        for u in self.list():
-            if str(u.get("telegram_id")) == str(telegram_id):
-                return u
-        return None
+        return self.find_one("telegram_id", str(telegram_id))
 """
 
 stores_repo = r"""
-from .repo_base import JsonRepoBase
+from .repo_base import RepoBase
+
+class StoresRepo(RepoBase):
+    index_fields = ("created_at",)
+    page_defaults = {"is_blocked": False}
 
-class StoresRepo(JsonRepoBase):
     def __init__(self, data_dir: str):
         super().__init__(data_dir, "stores.json")
 
@@ -246,54 +820,76 @@ class StoresRepo(JsonRepoBase):
 """
 
 products_repo = r"""
-from .repo_base import JsonRepoBase
+from typing import Dict, List
+from .repo_base import RepoBase
+
+class ProductsRepo(RepoBase):
+    index_fields = ("store_id",)
 
-class ProductsRepo(JsonRepoBase):
     def __init__(self, data_dir: str):
         super().__init__(data_dir, "products.json")
 
     def list_active_public(self):
         return [p for p in self.list() if p.get("active", True)]
+
+    def take_stock(self, quantities: Dict[str, int]) -> List[Dict]:
+        # Move qty from stock to sold_count for every product in quantities,
+        # all or none: ValueError if any of them is gone or short
+        def apply(found):
+            for pid, qty in quantities.items():
+                p = found.get(pid)
+                if not p or int(p["stock"]) < qty:
+                    raise ValueError("Out of stock")
+                p["stock"] = int(p["stock"]) - qty
+                p["sold_count"] = int(p.get("sold_count", 0)) + qty
+        return list(self.modify_many(quantities, apply).values())
+
+    def return_stock(self, quantities: Dict[str, int]) -> List[Dict]:
+        # Undo take_stock, for the products that still exist
+        def apply(found):
+            for p in found.values():
+                qty = quantities[p["id"]]
+                p["stock"] = int(p["stock"]) + qty
+                p["sold_count"] = max(int(p.get("sold_count", 0)) - qty, 0)
+        return list(self.modify_many(quantities, apply).values())
 """
 
 orders_repo = r"""
-from .repo_base import JsonRepoBase
+from .repo_base import RepoBase
+
+class OrdersRepo(RepoBase):
+    index_fields = ("buyer_id", "store_id", "idempotency_key", "created_at")
 
-class OrdersRepo(JsonRepoBase):
     def __init__(self, data_dir: str):
         super().__init__(data_dir, "orders.json")
 
     def find_by_buyer(self, buyer_id: str):
-        return [o for o in self.list() if o.get("buyer_id") == buyer_id]
+        return self.find_all("buyer_id", buyer_id)
 
     def find_by_store(self, store_id: str):
-        return [o for o in self.list() if o.get("store_id") == store_id]
+        return self.find_all("store_id", store_id)
 
     def find_by_key(self, idem_key: str):
-        for o in self.list():
-            if o.get("idempotency_key") == idem_key:
-                return o
-        return None
+        return self.find_one("idempotency_key", idem_key)
 """
 
 transactions_repo = r"""
-from .repo_base import JsonRepoBase
+from .repo_base import RepoBase
+
+class TransactionsRepo(RepoBase):
+    index_fields = ("idempotency_key",)
 
-class TransactionsRepo(JsonRepoBase):
     def __init__(self, data_dir: str):
         super().__init__(data_dir, "transactions.json")
 
     def find_by_key(self, idem_key: str):
-        for t in self.list():
-            if t.get("idempotency_key") == idem_key:
-                return t
-        return None
+        return self.find_one("idempotency_key", idem_key)
 """
 
 notifications_repo = r"""
-from .repo_base import JsonRepoBase
+from .repo_base import RepoBase
 
-class NotificationsRepo(JsonRepoBase):
+class NotificationsRepo(RepoBase):
     def __init__(self, data_dir: str):
         super().__init__(data_dir, "notifications.json")
 """
@@ -332,7 +928,7 @@ class Store(BaseModel):
 
 models_product = r"""
 from pydantic import BaseModel, field_validator
-from typing import List
+from typing import List, Optional
 
 class Product(BaseModel):
     id: str
@@ -344,6 +940,8 @@ class Product(BaseModel):
     images: List[str] = []
     category: str
     active: bool = True
+    sold_count: int = 0
+    created_at: Optional[str] = None
 
     @field_validator("price")
     def price_positive(cls, v):
@@ -399,7 +997,9 @@ class Transaction(BaseModel):
 
 # Helpers
 util_common = r"""
-import hmac, hashlib, urllib.parse, datetime
+import base64, hmac, hashlib, urllib.parse, datetime, json, threading, time
+from collections import OrderedDict
+from typing import Dict, List, Optional
 
 def now_iso():
     return datetime.datetime.utcnow().isoformat()
@@ -409,6 +1009,38 @@ def paginate(items, page: int, size: int):
     end = start + size
     return items[start:end], len(items)
 
+def encode_cursor(values: List) -> str:
+    # Opaque to clients: url-safe base64 of the JSON position
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Optional[List]:
+    # The position encode_cursor was given, or None if cursor isn't one
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        return None
+    return values if isinstance(values, list) else None
+
+def parse_limit(val, default: int = 20, maximum: int = 100) -> int:
+    return min(max(parse_int(val, default), 1), maximum)
+
+def keyset_requested(args) -> bool:
+    # Whether a list that also serves old page/size clients was asked for a cursor page
+    return "cursor" in args or "limit" in args
+
+def keyset_page(repo, args, field: Optional[str] = None, value=None) -> Optional[Dict]:
+    # {"items", "next_cursor", "limit"} for the page the request args ask
+    # for ("cursor": a previous next_cursor, "limit"), None for a bad cursor
+    limit = parse_limit(args.get("limit"))
+    after = None
+    if args.get("cursor"):
+        after = decode_cursor(args["cursor"])
+        if after is None or len(after) != 2 or not all(isinstance(v, str) for v in after):
+            return None
+    items = repo.page(field, value, after, limit)
+    next_cursor = encode_cursor(repo.cursor(items[-1])) if len(items) == limit else None
+    return {"items": items, "next_cursor": next_cursor, "limit": limit}
+
 def parse_int(val, default):
     try:
         return int(val)
@@ -421,19 +1053,746 @@ def parse_float(val, default):
     except:
         return default
 
-def verify_telegram_init_data(init_data: str, bot_token: str) -> bool:
+def telegram_secret(bot_token: str) -> bytes:
+    # Derive once at startup and pass to parse_telegram_init_data
+    return hashlib.sha256(bot_token.encode()).digest()
+
+def parse_telegram_init_data(init_data: str, secret_key: bytes, max_age: int = 0) -> Optional[Dict[str, str]]:
+    # Decoded initData fields if the hash checks out and auth_date is within
+    # max_age seconds (0: no limit), else None
     try:
-        data = dict([kv.split("=") for kv in init_data.split("&")])
+        data = dict(urllib.parse.parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
         hash_received = data.pop("hash", None)
-        check_arr = []
-        for k in sorted(data.keys()):
-            check_arr.append(f"{k}={urllib.parse.unquote_plus(data[k])}")
-        check_string = "\n".join(check_arr)
-        secret_key = hashlib.sha256(bot_token.encode()).digest()
+        check_string = "\n".join(f"{k}={data[k]}" for k in sorted(data.keys()))
         h = hmac.new(secret_key, check_string.encode(), hashlib.sha256).hexdigest()
-        return h == hash_received
+        if not hash_received or not hmac.compare_digest(h, hash_received):
+            return None
+        if max_age and time.time() - int(data.get("auth_date", 0)) > max_age:
+            return None
+        return data
     except Exception:
+        return None
+
+def verify_telegram_init_data(init_data: str, bot_token: str) -> bool:
+    return parse_telegram_init_data(init_data, telegram_secret(bot_token)) is not None
+
+class InitDataCache:
+    # initData strings that already passed verification -> resolved user id.
+    # Keyed by a digest of the whole string, so a hit means the exact same
+    # signed data; entries expire after ttl seconds or when the initData
+    # itself does (auth_date + max_age), whichever is first. LRU-bounded.
+    def __init__(self, size: int = 10000, ttl: float = 300.0):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[bytes, tuple]" = OrderedDict()
+
+    @staticmethod
+    def _key(init_data: str) -> bytes:
+        return hashlib.sha256(init_data.encode()).digest()
+
+    def get(self, init_data: str) -> Optional[str]:
+        key = self._key(init_data)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            user_id, expires = entry
+            if time.monotonic() >= expires:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return user_id
+
+    def put(self, init_data: str, user_id: str, auth_date: int = 0, max_age: int = 0):
+        ttl = self.ttl
+        if max_age:
+            ttl = min(ttl, auth_date + max_age - time.time())
+        if ttl <= 0 or self.size <= 0:
+            return
+        key = self._key(init_data)
+        with self._lock:
+            self._items[key] = (user_id, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+"""
+
+util_catalog = r"""
+import hashlib, heapq, itertools, math, os, re, threading, time
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+_WORD = re.compile(r"\w+")
+
+# Endings dropped by stem(), longest match first: common Russian case/number/
+# adjective endings plus the English plural. Crude on purpose; it only has to
+# map the forms people type onto the same key.
+_SUFFIXES = {
+    "иями", "ями", "ами", "иях", "ях", "ах", "ией", "ой", "ей", "ий", "ый", "ая", "яя",
+    "ое", "ее", "ые", "ие", "ых", "их", "ым", "им", "ом", "ем", "ую", "юю", "ов", "ев",
+    "ия", "ья", "ью", "ию", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й", "s",
+}
+_SUFFIX_LENGTHS = sorted({len(s) for s in _SUFFIXES}, reverse=True)
+
+PREFIX_EXPANSIONS = 50   # vocabulary terms one query word may expand to by prefix
+FUZZY_EXPANSIONS = 10    # ... and by trigram similarity
+FUZZY_MIN_SIMILARITY = 0.4
+
+@lru_cache(maxsize=200_000)
+def stem(word: str) -> str:
+    for n in _SUFFIX_LENGTHS:
+        if len(word) - n >= 3 and word[-n:] in _SUFFIXES:
+            return word[:-n]
+    return word
+
+def tokenize(text: Optional[str]) -> List[str]:
+    # Lowercased, ё folded into е, stemmed; \w covers Cyrillic as well as Latin
+    return [stem(w) for w in _WORD.findall((text or "").lower().replace("ё", "е"))]
+
+def _trigrams(term: str) -> Set[str]:
+    padded = f" {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TextIndex:
+    # Inverted index over product titles and descriptions: stemmed term ->
+    # {product id: weight}, a title occurrence weighing TITLE_WEIGHT times a
+    # description one. A sorted vocabulary answers prefix lookups by bisection
+    # and a trigram -> terms map finds near misses for typo tolerance. Not
+    # thread-safe; CatalogIndex serializes access.
+    TITLE_WEIGHT = 3
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._docs: Dict[str, Dict[str, int]] = {}  # product id -> its term weights, for removal
+        self._vocab: List[str] = []
+        self._grams: Dict[str, Set[str]] = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    @classmethod
+    def build(cls, docs) -> "TextIndex":
+        # docs: (id, title, description) triples; sorts the vocabulary once
+        # instead of inserting every new term in place
+        index = cls()
+        for doc_id, title, description in docs:
+            index._index(doc_id, title, description)
+        index._vocab = sorted(index._postings)
+        return index
+
+    def add(self, doc_id: str, title: Optional[str], description: Optional[str]):
+        self.remove(doc_id)
+        for term in self._index(doc_id, title, description):
+            insort(self._vocab, term)
+
+    def _index(self, doc_id: str, title: Optional[str], description: Optional[str]) -> List[str]:
+        # Adds postings for a document not in the index; returns its new terms
+        weights = Counter(tokenize(description))
+        for term in tokenize(title):
+            weights[term] += self.TITLE_WEIGHT
+        self._docs[doc_id] = dict(weights)
+        new_terms = []
+        for term, weight in weights.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                new_terms.append(term)
+                for gram in _trigrams(term):
+                    self._grams.setdefault(gram, set()).add(term)
+            postings[doc_id] = weight
+        return new_terms
+
+    def remove(self, doc_id: str):
+        for term in self._docs.pop(doc_id, ()):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+                del self._vocab[bisect_left(self._vocab, term)]
+                for gram in _trigrams(term):
+                    terms = self._grams[gram]
+                    terms.discard(term)
+                    if not terms:
+                        del self._grams[gram]
+
+    def _expand(self, word: str, fuzzy: bool):
+        # (term, factor) pairs a query word matches: itself, terms it is a
+        # prefix of, and failing both, similar terms when fuzzy
+        matches = []
+        if word in self._postings:
+            matches.append((word, 1.0))
+        if len(word) >= 2:
+            i = bisect_left(self._vocab, word)
+            while i < len(self._vocab) and len(matches) < PREFIX_EXPANSIONS and self._vocab[i].startswith(word):
+                if self._vocab[i] != word:
+                    matches.append((self._vocab[i], 0.6))
+                i += 1
+        if not matches and fuzzy and len(word) >= 4:
+            grams = _trigrams(word)
+            shared = Counter(t for g in grams for t in self._grams.get(g, ()))
+            similar = []
+            for term, count in shared.items():
+                similarity = 2.0 * count / (len(grams) + len(term))  # Dice; a term has len(term) trigrams
+                if similarity >= FUZZY_MIN_SIMILARITY:
+                    similar.append((similarity, term))
+            similar.sort(reverse=True)
+            matches = [(term, 0.4 * similarity) for similarity, term in similar[:FUZZY_EXPANSIONS]]
+        return matches
+
+    def search(self, query: str, fuzzy: bool = True) -> Optional[Dict[str, float]]:
+        # {product id: relevance} for products matching every query word;
+        # None when the query has no words at all
+        words = list(dict.fromkeys(tokenize(query)))
+        if not words:
+            return None
+        expansions = [self._expand(word, fuzzy) for word in words]
+        # Rarest word first: later words only look up the documents still in the running
+        expansions.sort(key=lambda matches: sum(len(self._postings[term]) for term, _ in matches))
+        n = len(self._docs)
+        scores: Optional[Dict[str, float]] = None
+        for matches in expansions:
+            found: Dict[str, float] = {}
+            for term, factor in matches:
+                postings = self._postings[term]
+                idf = math.log(1.0 + n / len(postings))
+                if scores is None:
+                    hits = postings.items()
+                else:
+                    hits = ((doc_id, postings[doc_id]) for doc_id in scores if doc_id in postings)
+                for doc_id, weight in hits:
+                    score = weight * idf * factor
+                    if score > found.get(doc_id, 0.0):
+                        found[doc_id] = score
+            if scores is not None:
+                found = {doc_id: s + scores[doc_id] for doc_id, s in found.items()}
+            scores = found
+            if not scores:
+                return {}
+        return scores
+
+class SortedIndex:
+    # Visible products ordered by (key(product), seq, id), seq being the
+    # product's position in the catalog so ties keep catalog order. Ranges
+    # of keys are found by bisection and pages are plain slices; an update is
+    # a bisection plus one list insert or delete.
+    def __init__(self, key):
+        self.key = key
+        self._entries: List[tuple] = []
+        self._by_id: Dict[str, tuple] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def build(self, items):
+        # items: (seq, product) pairs
+        self._by_id = {p["id"]: (self.key(p), seq, p["id"]) for seq, p in items}
+        self._entries = sorted(self._by_id.values())
+
+    def add(self, seq: int, p: Dict):
+        entry = self._by_id[p["id"]] = (self.key(p), seq, p["id"])
+        insort(self._entries, entry)
+
+    def remove(self, pid: str):
+        entry = self._by_id.pop(pid, None)
+        if entry is not None:
+            del self._entries[bisect_left(self._entries, entry)]
+
+    def entry(self, pid: str) -> tuple:
+        return self._by_id[pid]
+
+    def bounds(self, low, high):
+        # [start, stop) of the entries with low <= key <= high
+        return bisect_left(self._entries, (low,)), bisect_right(self._entries, (high, math.inf))
+
+    def rank(self, key) -> int:
+        # Number of entries with a smaller key
+        return bisect_left(self._entries, (key,))
+
+    def ids(self, start: int, stop: int) -> List[str]:
+        return [entry[2] for entry in self._entries[start:stop]]
+
+    def position(self, after, descending: bool = False) -> int:
+        # Where a page continuing after the entry prefix (key, seq) starts:
+        # the first index past it, or with descending the end of what precedes it
+        if descending:
+            return bisect_left(self._entries, (after[0], after[1]))
+        return bisect_left(self._entries, (after[0], after[1] + 1))
+
+    def iter_ids(self, descending: bool = False, after=None):
+        entries = self._entries
+        if descending:
+            stop = len(entries) if after is None else self.position(after, True)
+            return (entries[i][2] for i in range(stop - 1, -1, -1))
+        start = 0 if after is None else self.position(after)
+        return (entries[i][2] for i in range(start, len(entries)))
+
+def _price(p: Dict) -> float:
+    return float(p.get("price", 0))
+
+# Lower bounds of the price facet's buckets after the first, which starts at 0
+PRICE_BUCKETS = tuple(float(b) for b in os.getenv("CATALOG_PRICE_BUCKETS", "100,500,1000,5000").split(","))
+
+def price_bucket(price: float) -> int:
+    return bisect_right(PRICE_BUCKETS, price)
+
+# Facet fields, and the filters a facet's counts can be narrowed by
+FACETS = ("category", "store_id", "price")
+_FACET_FILTERS = ((), ("category",), ("store_id",), ("category", "store_id"))
+
+class FacetCounts:
+    # Visible products per category, store and price bucket, counted for
+    # every combination of category and store filter, so the facets of an
+    # unfiltered, store or category page are a dict lookup. Facets are
+    # disjunctive: a facet's counts ignore the filter on that facet itself,
+    # so the other chips keep their numbers once one is picked. The category
+    # and store counts are also kept per price bucket, for price ranges.
+    def __init__(self):
+        self._counts: Dict[tuple, Counter] = {}  # (facet, filter fields, filter values[, bucket]) -> counts
+
+    def add(self, p: Dict, n: int = 1):
+        values = {"category": p.get("category"), "store_id": p.get("store_id"), "price": price_bucket(_price(p))}
+        for facet in FACETS:
+            for filters in _FACET_FILTERS:
+                if facet in filters:
+                    continue
+                key = (facet, filters, tuple(values[f] for f in filters))
+                self._count(key, values[facet], n)
+                if facet != "price":
+                    self._count(key + (values["price"],), values[facet], n)
+
+    def _count(self, key: tuple, value, n: int):
+        counts = self._counts.setdefault(key, Counter())
+        counts[value] += n
+        if counts[value] <= 0:
+            del counts[value]
+            if not counts:
+                del self._counts[key]
+
+    def remove(self, p: Dict):
+        self.add(p, -1)
+
+    def get(self, category: Optional[str] = None, store_id: Optional[str] = None,
+            bucket: Optional[int] = None) -> Dict[str, Counter]:
+        # bucket: the category and store counts of that price bucket alone
+        given = {"category": category, "store_id": store_id}
+        result = {}
+        for facet in FACETS:
+            filters = tuple(f for f in ("category", "store_id") if f != facet and given[f])
+            key = (facet, filters, tuple(given[f] for f in filters))
+            if bucket is not None and facet != "price":
+                key += (bucket,)
+            result[facet] = self._counts.get(key, Counter())
+        return result
+
+# sort= values of /api/catalog: (SortedIndex name, descending)
+SORTS = {
+    "price_asc": ("price", False),
+    "price_desc": ("price", True),
+    "newest": ("created", True),
+    "popular": ("sold", True),
+}
+
+def _valid_cursor(name: str, after) -> bool:
+    # Whether after is a position query() hands out for the order name
+    if len(after) != 3 or after[0] != name or type(after[2]) is not int:
         return False
+    key_type = (str,) if name in SORTS and SORTS[name][0] == "created" else (int, float)
+    return isinstance(after[1], key_type) and not isinstance(after[1], bool)
+
+
+class CatalogQuery(NamedTuple):
+    # Arguments of CatalogIndex.query, in order
+    search: str = ""
+    store_id: Optional[str] = None
+    category: Optional[str] = None
+    min_price: float = 0
+    max_price: float = math.inf
+    fuzzy: bool = True
+    sort: Optional[str] = None
+    offset: int = 0
+    limit: int = 20
+    facets: bool = False
+    after: Optional[tuple] = None  # cursor from the previous page, see query()
+
+    def cache_key(self) -> tuple:
+        # Queries that must give the same response map to the same key
+        words = tuple(sorted(set(tokenize(self.search))))
+        return (words, self.store_id or None, self.category or None, float(self.min_price), float(self.max_price),
+                self.fuzzy or not words, self.sort, self.offset, self.limit, self.facets,
+                tuple(self.after) if self.after else None)
+
+class _CachedResponse(NamedTuple):
+    query: CatalogQuery
+    body: bytes
+    etag: str
+    ids: frozenset  # products on the page
+
+class CatalogIndex:
+    # In-memory view of the catalog shared by the routes of one process. Every
+    # product is kept by id; the visible ones (active, in a store that isn't
+    # blocked) are also in a TextIndex, in SortedIndexes by catalog order,
+    # price, creation time and sales, in per-store and per-category sets and
+    # in FacetCounts. Rendered responses are cached by query until a write
+    # touches them (see response()).
+    # Routes that write products or stores report it via put_product /
+    # remove_product / put_store, which update the view in place. Writes by
+    # other processes show up as a changed repository version, checked at most
+    # every sync_interval seconds, and cause a rebuild; so does our own write
+    # if another one landed before it (see _applied).
+    def __init__(self, products_repo, stores_repo, sync_interval: float = 2.0, cache_size: int = 1000):
+        self.products = products_repo
+        self.stores = stores_repo
+        self.sync_interval = sync_interval
+        self.cache_size = cache_size
+        self._responses: "OrderedDict[tuple, _CachedResponse]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._items: Dict[str, Dict] = {}
+        self._seq: Dict[str, int] = {}
+        self._next_seq = 0
+        self._by_store: Dict[str, Set[str]] = {}  # every product, for blocking and unblocking
+        self._blocked: Set[str] = set()
+        self._text = TextIndex()
+        self._sorted = {
+            "catalog": SortedIndex(lambda p: 0),
+            "price": SortedIndex(_price),
+            "created": SortedIndex(lambda p: p.get("created_at") or ""),
+            "sold": SortedIndex(lambda p: int(p.get("sold_count") or 0)),
+        }
+        self._visible_by: Dict[str, Dict[str, Set[str]]] = {"store_id": {}, "category": {}}
+        self._facets = FacetCounts()
+        self._versions = None
+        self._checked = 0.0
+
+    def _repo_versions(self):
+        return (self.products.version(), self.stores.version())
+
+    def _visible(self, p: Dict) -> bool:
+        return bool(p.get("active", True)) and p.get("store_id") not in self._blocked
+
+    def _rebuild(self):
+        # Versions first: a write landing while we list shows up as a change next time
+        self._versions = self._repo_versions()
+        self._responses.clear()
+        self._blocked = {s["id"] for s in self.stores.list() if s.get("is_blocked")}
+        self._items, self._seq, self._by_store = {}, {}, {}
+        for p in self.products.list():
+            self._items[p["id"]] = p
+            self._seq[p["id"]] = len(self._seq)
+            self._by_store.setdefault(p.get("store_id"), set()).add(p["id"])
+        self._next_seq = len(self._seq)
+        visible = [(self._seq[p["id"]], p) for p in self._items.values() if self._visible(p)]
+        self._text = TextIndex.build((p["id"], p.get("title"), p.get("description")) for _, p in visible)
+        for index in self._sorted.values():
+            index.build(visible)
+        for field, groups in self._visible_by.items():
+            groups.clear()
+            for _, p in visible:
+                groups.setdefault(p.get(field), set()).add(p["id"])
+        self._facets = FacetCounts()
+        for _, p in visible:
+            self._facets.add(p)
+
+    def _sync(self):
+        now = time.monotonic()
+        if self._versions is not None and now - self._checked < self.sync_interval:
+            return
+        self._checked = now
+        if self._versions is None or self._repo_versions() != self._versions:
+            self._rebuild()
+
+    def _show(self, p: Dict):
+        pid = p["id"]
+        self._text.add(pid, p.get("title"), p.get("description"))
+        for index in self._sorted.values():
+            index.add(self._seq[pid], p)
+        for field, groups in self._visible_by.items():
+            groups.setdefault(p.get(field), set()).add(pid)
+        self._facets.add(p)
+
+    def _hide(self, p: Dict):
+        pid = p["id"]
+        self._text.remove(pid)
+        for index in self._sorted.values():
+            index.remove(pid)
+        for field, groups in self._visible_by.items():
+            groups.get(p.get(field), set()).discard(pid)
+        self._facets.remove(p)
+
+    def _applied(self, repo):
+        # Our own write to repo is already in the view, so move past it without
+        # a rebuild, but only if the view had seen everything before it. If
+        # another process wrote in between, keep the old version: the next
+        # _sync sees the difference and rebuilds.
+        i = 0 if repo is self.products else 1
+        write = repo.last_write()
+        if write is not None and write[1] == self._versions[i]:
+            return  # a product of the same write (checkout's update_many) already moved us past it
+        if write is not None and write[0] == self._versions[i]:
+            self._versions = self._versions[:i] + (write[1],) + self._versions[i + 1:]
+        else:
+            self._checked = 0.0
+
+    def put_product(self, p: Dict):
+        with self._lock:
+            if self._versions is None:
+                return  # built from the repositories on first query
+            p = dict(p)
+            pid = p["id"]
+            old = self._items.get(pid)
+            shown = old if old is not None and self._visible(old) else None
+            if shown is not None:
+                self._hide(old)
+            if old is None:
+                self._seq[pid] = self._next_seq
+                self._next_seq += 1
+            elif old.get("store_id") != p.get("store_id"):
+                self._by_store.get(old.get("store_id"), set()).discard(pid)
+            self._items[pid] = p
+            self._by_store.setdefault(p.get("store_id"), set()).add(pid)
+            if self._visible(p):
+                self._show(p)
+            self._invalidate(pid, shown, p if self._visible(p) else None)
+            self._applied(self.products)
+
+    def remove_product(self, pid: str):
+        with self._lock:
+            if self._versions is None:
+                return
+            p = self._items.pop(pid, None)
+            if p is not None:
+                if self._visible(p):
+                    self._hide(p)
+                    self._invalidate(pid, p, None)
+                self._by_store.get(p.get("store_id"), set()).discard(pid)
+                del self._seq[pid]
+            self._applied(self.products)
+
+    def put_store(self, s: Dict):
+        with self._lock:
+            if self._versions is None:
+                return
+            blocked = bool(s.get("is_blocked"))
+            if blocked != (s["id"] in self._blocked):
+                products = [self._items[pid] for pid in self._by_store.get(s["id"], ())]
+                if blocked:
+                    for p in products:
+                        if self._visible(p):
+                            self._hide(p)
+                    self._blocked.add(s["id"])
+                else:
+                    self._blocked.discard(s["id"])
+                    for p in products:
+                        if self._visible(p):
+                            self._show(p)
+                for key, entry in list(self._responses.items()):
+                    q = entry.query
+                    if q.search or q.facets or q.store_id in (None, s["id"]):
+                        del self._responses[key]
+            self._applied(self.stores)
+
+    def _invalidate(self, pid: str, old: Optional[Dict], new: Optional[Dict]):
+        # Drop the cached responses a product change can alter; old / new: the
+        # product as it was / is now while visible, else None
+        if not self._responses or (old is None and new is None):
+            return
+        both = old is not None and new is not None
+        text_changed = not both or (old.get("title"), old.get("description")) != (new.get("title"), new.get("description"))
+        moved = not both or any(old.get(f) != new.get(f) for f in ("store_id", "category", "price"))
+        for key, entry in list(self._responses.items()):
+            q = entry.query
+            if pid in entry.ids or (q.search and text_changed):  # term statistics shift every relevance score
+                del self._responses[key]
+                continue
+            order = self._sorted[SORTS[q.sort][0] if q.sort else "catalog"]
+            if moved or order.key(old) != order.key(new):
+                if any(self._may_match(q, p) for p in (old, new) if p is not None):
+                    del self._responses[key]
+
+    @staticmethod
+    def _may_match(q: CatalogQuery, p: Dict) -> bool:
+        # Whether p can count towards q's results or facets; search is not checked
+        in_range = q.min_price <= _price(p) <= q.max_price
+        in_store = not q.store_id or p.get("store_id") == q.store_id
+        in_category = not q.category or p.get("category") == q.category
+        if q.facets:
+            # Facets are disjunctive: the category counts ignore the category
+            # filter, the price counts the price range, and so on
+            return (in_store and in_category) or (in_range and (in_store or in_category))
+        return in_range and in_store and in_category
+
+    def response(self, q: CatalogQuery, render: Callable[..., bytes]) -> Tuple[bytes, str]:
+        # (body, strong ETag) for q, rendering render(*query(*q)) only when no
+        # cached response is still valid
+        key = q.cache_key()
+        with self._lock:
+            self._sync()
+            entry = self._responses.get(key)
+            if entry is None:
+                result = self.query(*q)
+                body = render(*result)
+                page = result[0]
+                entry = self._responses[key] = _CachedResponse(
+                    q, body, hashlib.sha1(body).hexdigest(), frozenset(p["id"] for p in page))
+                while len(self._responses) > self.cache_size:
+                    self._responses.popitem(last=False)
+            else:
+                self._responses.move_to_end(key)
+            return entry.body, entry.etag
+
+    def query(self, search: str = "", store_id: Optional[str] = None, category: Optional[str] = None,
+              min_price: float = 0, max_price: float = math.inf, fuzzy: bool = True,
+              sort: Optional[str] = None, offset: int = 0, limit: int = 20, facets: bool = False,
+              after: Optional[tuple] = None):
+        # (page of visible products, total matches, facets or None, cursor).
+        # Order: sort (see SORTS), else relevance when searching, else catalog
+        # order. The cursor is a tuple naming the order and the last product's
+        # place in it, or None on the last page; passed back as after (offset
+        # 0), it continues right behind that product. ValueError if after
+        # belongs to another order.
+        with self._lock:
+            self._sync()
+            scores = self._text.search(search, fuzzy) if search else None
+            name = sort or ("relevance" if scores is not None else "catalog")
+            if after is not None and not _valid_cursor(name, after):
+                raise ValueError("cursor does not match this query")
+            counts = self._facet_counts(scores, category, store_id, min_price, max_price) if facets else None
+            page, total = self._page(scores, store_id, category, min_price, max_price, sort, offset, limit,
+                                     after[1:] if after else None)
+            cursor = None
+            if page and len(page) == limit:
+                last = page[-1]["id"]
+                if name == "relevance":
+                    cursor = (name, -scores[last], self._seq[last])
+                else:
+                    cursor = (name,) + self._sorted[SORTS[sort][0] if sort else "catalog"].entry(last)[:2]
+            return page, total, counts, cursor
+
+    def _facet_counts(self, scores, category, store_id, min_price, max_price):
+        # The price range narrows the category and store counts but not the
+        # price buckets, the same way each facet ignores its own filter
+        prices = self._sorted["price"]
+        start, stop = prices.bounds(min_price, max_price)
+        if scores is not None:
+            # Search: count the products it found in one pass
+            counts = {facet: Counter() for facet in FACETS}
+            for pid in scores:
+                p = self._items[pid]
+                in_category = not category or p.get("category") == category
+                in_store = not store_id or p.get("store_id") == store_id
+                if min_price <= _price(p) <= max_price:
+                    self._tally(counts, (pid,), category, store_id)
+                if in_category and in_store:
+                    counts["price"][price_bucket(_price(p))] += 1
+        elif (start, stop) == (0, len(prices)):
+            counts = self._facets.get(category, store_id)
+        else:
+            # Buckets inside the range come from the counters; of a bucket the
+            # range cuts through, scan the smaller part and adjust
+            counts = {"category": Counter(), "store_id": Counter(), "price": self._facets.get(category, store_id)["price"]}
+            edges = [0] + [prices.rank(low) for low in PRICE_BUCKETS] + [len(prices)]
+            for bucket in range(len(edges) - 1):
+                first, last = edges[bucket], edges[bucket + 1]
+                lo, hi = max(first, start), min(last, stop)
+                if lo >= hi:
+                    continue
+                if hi - lo <= (last - first) // 2:
+                    self._tally(counts, prices.ids(lo, hi), category, store_id)
+                    continue
+                whole = self._facets.get(category, store_id, bucket)
+                counts["category"].update(whole["category"])
+                counts["store_id"].update(whole["store_id"])
+                self._tally(counts, prices.ids(first, lo) + prices.ids(hi, last), category, store_id, -1)
+            counts["category"], counts["store_id"] = +counts["category"], +counts["store_id"]
+        bounds = (0.0,) + PRICE_BUCKETS
+        return {
+            "categories": dict(counts["category"]),
+            "stores": dict(counts["store_id"]),
+            "prices": [{"min": low, "max": bounds[i + 1] if i + 1 < len(bounds) else None, "count": counts["price"][i]}
+                       for i, low in enumerate(bounds)],
+        }
+
+    def _tally(self, counts, ids, category, store_id, n: int = 1):
+        # Add n for each of ids to the category and store counts it belongs to
+        for pid in ids:
+            p = self._items[pid]
+            if not store_id or p.get("store_id") == store_id:
+                counts["category"][p.get("category")] += n
+            if not category or p.get("category") == category:
+                counts["store_id"][p.get("store_id")] += n
+
+    def _page(self, scores, store_id, category, min_price, max_price, sort, offset, limit, after):
+        # (page, total) for query(); candidate sets are intersected smallest first
+        sets = [] if scores is None else [scores]
+        if store_id:
+            sets.append(self._visible_by["store_id"].get(store_id, set()))
+        if category:
+            sets.append(self._visible_by["category"].get(category, set()))
+        sets.sort(key=len)
+        name, descending = SORTS[sort] if sort else ("catalog", False)
+        order = self._sorted[name]
+        start, stop = self._sorted["price"].bounds(min_price, max_price)
+        if not sets and (name == "price" or (start, stop) == (0, len(order))):
+            # Nothing else to filter by: the page is a slice of the sort order
+            if name != "price":
+                start, stop = 0, len(order)
+            total = stop - start
+            if after is not None:
+                if descending:
+                    stop = min(stop, order.position(after, True))
+                else:
+                    start = max(start, order.position(after))
+            if descending:
+                start, stop = max(stop - offset - limit, start), stop - offset
+            else:
+                start, stop = start + offset, min(start + offset + limit, stop)
+            ids = order.ids(start, stop) if start < stop else []
+            return [self._items[pid] for pid in (reversed(ids) if descending else ids)], total
+        if (start, stop) != (0, len(order)):
+            if not sets or stop - start <= len(sets[0]):
+                sets.insert(0, self._sorted["price"].ids(start, stop))
+            else:
+                sets[0] = [pid for pid in sets[0] if min_price <= _price(self._items[pid]) <= max_price]
+        ids = set(sets[0]).intersection(*sets[1:])
+        end = offset + limit
+        if not sort and scores is not None:
+            rank = lambda pid: (-scores[pid], self._seq[pid])
+            rest = ids if after is None else [pid for pid in ids if rank(pid) > tuple(after)]
+            page = heapq.nsmallest(end, rest, key=rank)[offset:]
+        elif len(ids) * 8 < len(order):
+            rest = ids
+            if after is not None:
+                after = tuple(after)
+                if descending:
+                    rest = [pid for pid in ids if order.entry(pid)[:2] < after]
+                else:
+                    rest = [pid for pid in ids if order.entry(pid)[:2] > after]
+            page = sorted(rest, key=order.entry, reverse=descending)[offset:end]
+        else:
+            # Most of the catalog matches: walk the sort order until the page is full
+            walk = (pid for pid in order.iter_ids(descending, after) if pid in ids)
+            page = list(itertools.islice(walk, offset, end))
+        return [self._items[pid] for pid in page], len(ids)
+
+_indexes: Dict[str, CatalogIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_catalog_index(products_repo, stores_repo) -> CatalogIndex:
+    # One view per data directory, shared by every blueprint that uses it
+    key = os.path.abspath(products_repo.data_dir)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = CatalogIndex(
+                products_repo, stores_repo, float(os.getenv("CATALOG_SYNC_SECONDS", "2")),
+                int(os.getenv("CATALOG_CACHE_SIZE", "1000")))
+        return index
 """
 
 # Routes
@@ -442,32 +1801,47 @@ from flask import Blueprint, request, jsonify, g
 import os, json
 from adapters.bank_adapter import BankAdapter
 from repositories.users_repo import UsersRepo
-from utils.common import verify_telegram_init_data
+from utils.common import InitDataCache, parse_telegram_init_data, telegram_secret
 
 auth_bp = Blueprint("auth", __name__)
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 bank = BankAdapter(DATA_DIR)
 users = UsersRepo(DATA_DIR)
 
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN","")
+BOT_SECRET = telegram_secret(BOT_TOKEN) if BOT_TOKEN else None
+INIT_DATA_MAX_AGE = int(os.getenv("TELEGRAM_INIT_MAX_AGE","86400"))
+verified_init_data = InitDataCache(int(os.getenv("AUTH_CACHE_SIZE","10000")), float(os.getenv("AUTH_CACHE_TTL","300")))
+
+def _telegram_user(tg_init: str):
+    # Cache hit: the same signed initData was verified recently, skip HMAC and parsing
+    user_id = verified_init_data.get(tg_init)
+    if user_id:
+        u = users.get(user_id)
+        if u:
+            return u
+    data = parse_telegram_init_data(tg_init, BOT_SECRET, INIT_DATA_MAX_AGE)
+    if data is None:
+        return None
+    user_obj = json.loads(data.get("user", "{}"))
+    telegram_id = str(user_obj.get("id"))
+    u = users.find_by_telegram(telegram_id)
+    if not u:
+        u = users.create({
+            "name": user_obj.get("first_name","TG User"),
+            "telegram_id": telegram_id,
+            "role": "user",
+            "balance": 0.0
+        })
+    verified_init_data.put(tg_init, u["id"], int(data.get("auth_date", 0)), INIT_DATA_MAX_AGE)
+    return u
+
 def load_current_user():
     g.user = None
     tg_init = request.headers.get("X-Telegram-Init-Data")
-    if tg_init:
-        bot_token = os.getenv("TELEGRAM_BOT_TOKEN","")
-        if bot_token and verify_telegram_init_data(tg_init, bot_token):
-            from urllib.parse import parse_qs, unquote_plus
-            q = parse_qs(tg_init)
-            user_json = unquote_plus(q.get("user", ["{}"])[0])
-            user_obj = json.loads(user_json)
-            telegram_id = str(user_obj.get("id"))
-            u = users.find_by_telegram(telegram_id)
-            if not u:
-                u = users.create({
-                    "name": user_obj.get("first_name","TG User"),
-                    "telegram_id": telegram_id,
-                    "role": "user",
-                    "balance": 0.0
-                })
+    if tg_init and BOT_SECRET:
+        u = _telegram_user(tg_init)
+        if u:
             g.user = u
             return
     auth = request.headers.get("Authorization","")
@@ -490,41 +1864,64 @@ def me():
 """
 
 routes_catalog = r"""
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, current_app, request, jsonify
 import os
 from repositories.products_repo import ProductsRepo
 from repositories.stores_repo import StoresRepo
-from utils.common import paginate, parse_int, parse_float
+from utils.catalog import SORTS, CatalogQuery, get_catalog_index
+from utils.common import decode_cursor, encode_cursor, parse_int, parse_float, parse_limit
 
 catalog_bp = Blueprint("catalog", __name__)
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 products = ProductsRepo(DATA_DIR)
 stores = StoresRepo(DATA_DIR)
+catalog_index = get_catalog_index(products, stores)
 
 @catalog_bp.get("/catalog")
 def catalog():
-    search = (request.args.get("search") or "").lower()
+    search = request.args.get("search") or ""
     store_id = request.args.get("store_id")
     category = request.args.get("category")
     min_price = parse_float(request.args.get("min"), 0)
     max_price = parse_float(request.args.get("max"), 10**12)
-    page = parse_int(request.args.get("page"), 1)
-    size = parse_int(request.args.get("size"), 20)
-
-    items = products.list_active_public()
-    blocked = {s["id"] for s in stores.list_public(include_blocked=True) if s.get("is_blocked")}
-    items = [p for p in items if p.get("store_id") not in blocked]
-
-    if search:
-        items = [p for p in items if search in p.get("title","").lower() or search in p.get("description","").lower()]
-    if store_id:
-        items = [p for p in items if p.get("store_id")==store_id]
-    if category:
-        items = [p for p in items if p.get("category")==category]
-    items = [p for p in items if min_price <= float(p.get("price",0)) <= max_price]
-
-    page_items, total = paginate(items, page, size)
-    return jsonify({"items": page_items, "total": total, "page": page, "size": size})
+    fuzzy = request.args.get("fuzzy", "1") != "0"
+    with_facets = request.args.get("facets", "1") != "0"
+    sort = request.args.get("sort")
+    if sort and sort not in SORTS:
+        return jsonify({"error":"invalid_sort", "allowed": sorted(SORTS)}), 400
+    after = None
+    if "page" in request.args:
+        # page/size offset paging, kept for old clients
+        page = max(parse_int(request.args.get("page"), 1), 1)
+        size = max(parse_int(request.args.get("size"), 20), 0)
+        offset, limit = (page-1)*size, size
+    else:
+        limit, offset = parse_limit(request.args.get("limit")), 0
+        if request.args.get("cursor"):
+            after = decode_cursor(request.args["cursor"])
+            if after is None:
+                return jsonify({"error":"invalid_cursor"}), 400
+            after = tuple(after)
+
+    def render(page_items, total, facets, cursor):
+        # Depends on q alone, as the response is shared by every request with its cache key
+        body = {"items": page_items, "total": total, "next_cursor": encode_cursor(list(cursor)) if cursor else None}
+        if after is None:
+            body.update(page=offset // limit + 1 if limit else 1, size=limit)
+        if facets is not None:
+            body["facets"] = facets
+        return current_app.json.dumps(body).encode()
+
+    # Served from memory until a product or store write changes this response
+    q = CatalogQuery(search, store_id, category, min_price, max_price, fuzzy, sort, offset, limit, with_facets, after)
+    try:
+        body, etag = catalog_index.response(q, render)
+    except ValueError:
+        return jsonify({"error":"invalid_cursor"}), 400
+    resp = Response(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
 """
 
 routes_stores = r"""
@@ -533,7 +1930,7 @@ import os, uuid, datetime
 from adapters.bank_adapter import BankAdapter
 from repositories.stores_repo import StoresRepo
 from repositories.users_repo import UsersRepo
-from utils.common import paginate, parse_int
+from utils.common import keyset_page, keyset_requested, paginate, parse_int
 
 stores_bp = Blueprint("stores", __name__)
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
@@ -543,11 +1940,17 @@ bank = BankAdapter(DATA_DIR)
 
 @stores_bp.get("/stores")
 def list_stores():
-    page = parse_int(request.args.get("page"), 1)
-    size = parse_int(request.args.get("size"), 20)
-    items = stores.list_public(include_blocked=False)
-    page_items, total = paginate(items, page, size)
-    return jsonify({"items": page_items, "total": total, "page": page, "size": size})
+    if "page" in request.args or not keyset_requested(request.args):
+        # page/size offset paging, kept for old clients
+        page = parse_int(request.args.get("page"), 1)
+        size = parse_int(request.args.get("size"), 20)
+        items = stores.list_public(include_blocked=False)
+        page_items, total = paginate(items, page, size)
+        return jsonify({"items": page_items, "total": total, "page": page, "size": size})
+    body = keyset_page(stores, request.args, "is_blocked", False)
+    if body is None:
+        return jsonify({"error":"invalid_cursor"}), 400
+    return jsonify(body)
 
 @stores_bp.get("/stores/<store_id>")
 def get_store(store_id):
@@ -596,16 +1999,19 @@ def buy_and_create_store():
 
 routes_mystore = r"""
 from flask import Blueprint, request, jsonify, g
-import os
+import os, datetime
 from repositories.stores_repo import StoresRepo
 from repositories.products_repo import ProductsRepo
 from repositories.orders_repo import OrdersRepo
+from utils.catalog import get_catalog_index
+from utils.common import keyset_page
 
 mystore_bp = Blueprint("mystore", __name__)
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 stores = StoresRepo(DATA_DIR)
 products = ProductsRepo(DATA_DIR)
 orders = OrdersRepo(DATA_DIR)
+catalog_index = get_catalog_index(products, stores)
 
 def require_owner():
     if not g.user:
@@ -649,8 +2055,11 @@ def create_product():
         "stock": int(data.get("stock",0)),
         "images": data.get("images", []),
         "category": data.get("category","general"),
-        "active": bool(data.get("active", True))
+        "active": bool(data.get("active", True)),
+        "sold_count": 0,
+        "created_at": datetime.datetime.utcnow().isoformat()
     })
+    catalog_index.put_product(p)
     return jsonify(p), 201
 
 @mystore_bp.patch("/mystore/products/<pid>")
@@ -666,6 +2075,7 @@ def update_product(pid):
     if float(p.get("price",0))<=0 or int(p.get("stock",0))<0:
         return jsonify({"error":"invalid_price_or_stock"}), 400
     products.update(pid, p)
+    catalog_index.put_product(p)
     return jsonify(p)
 
 @mystore_bp.delete("/mystore/products/<pid>")
@@ -676,14 +2086,17 @@ def delete_product(pid):
     if not p or p.get("store_id")!=s["id"]:
         return jsonify({"error":"not_found"}), 404
     products.delete(pid)
+    catalog_index.remove_product(pid)
     return jsonify({"ok":True})
 
 @mystore_bp.get("/mystore/orders")
 def store_orders():
     s, err = require_owner()
     if err: return err
-    items = [o for o in orders.list() if o.get("store_id")==s["id"]]
-    return jsonify({"items":items, "total":len(items), "page":1, "size":len(items)})
+    body = keyset_page(orders, request.args, "store_id", s["id"])
+    if body is None:
+        return jsonify({"error":"invalid_cursor"}), 400
+    return jsonify(body)
 """
 
 routes_orders = r"""
@@ -693,6 +2106,8 @@ from adapters.bank_adapter import BankAdapter
 from repositories.orders_repo import OrdersRepo
 from repositories.products_repo import ProductsRepo
 from repositories.stores_repo import StoresRepo
+from utils.catalog import get_catalog_index
+from utils.common import keyset_page
 
 orders_bp = Blueprint("orders", __name__)
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
@@ -700,19 +2115,22 @@ orders = OrdersRepo(DATA_DIR)
 products = ProductsRepo(DATA_DIR)
 stores = StoresRepo(DATA_DIR)
 bank = BankAdapter(DATA_DIR)
+catalog_index = get_catalog_index(products, stores)
 
 def _compute_total_and_validate(items):
     if not items:
         raise ValueError("Empty items")
+    found = products.get_many([it["product_id"] for it in items])
+    store_by_id = stores.get_many({p["store_id"] for p in found.values()})
     store_id = None
     expanded = []
     total = 0.0
     for it in items:
-        p = products.get(it["product_id"])
+        p = found.get(it["product_id"])
         if not p or not p.get("active", True):
             raise ValueError("Product not available")
-        st = stores.get(p["store_id"])
-        if st.get("is_blocked"):
+        st = store_by_id.get(p["store_id"])
+        if not st or st.get("is_blocked"):
             raise ValueError("Store is blocked")
         if store_id is None:
             store_id = p["store_id"]
@@ -743,17 +2161,24 @@ def checkout():
     except Exception as e:
         return jsonify({"error":"validation_failed","detail":str(e)}), 400
 
+    # Stock first, checked and taken in one locked write, so losing a race
+    # for the last items costs the buyer nothing; given back if payment fails
+    quantities = {}
+    for it in expanded:
+        quantities[it["product_id"]] = quantities.get(it["product_id"], 0) + int(it["qty"])
+    try:
+        taken = products.take_stock(quantities)
+    except ValueError:
+        return jsonify({"error":"race_stock"}), 409
+
     try:
         bank.transfer(g.user["id"], bank.platform_account(), total, f"Order escrow for store {store_id}", idem)
     except Exception as e:
+        for p in products.return_stock(quantities):
+            catalog_index.put_product(p)
         return jsonify({"error":"payment_failed","detail":str(e)}), 400
-
-    for it in expanded:
-        p = products.require(it["product_id"])
-        if int(p["stock"]) < int(it["qty"]):
-            return jsonify({"error":"race_stock"}), 409
-        p["stock"] = int(p["stock"]) - int(it["qty"])
-        products.update(p["id"], p)
+    for p in taken:
+        catalog_index.put_product(p)
 
     o = orders.create({
         "buyer_id": g.user["id"],
@@ -772,8 +2197,10 @@ def checkout():
 def my_orders():
     if not g.user:
         return jsonify({"error":"unauthorized"}), 401
-    items = [o for o in orders.list() if o.get("buyer_id")==g.user["id"]]
-    return jsonify({"items":items, "total":len(items), "page":1, "size":len(items)})
+    body = keyset_page(orders, request.args, "buyer_id", g.user["id"])
+    if body is None:
+        return jsonify({"error":"invalid_cursor"}), 400
+    return jsonify(body)
 
 @orders_bp.post("/orders/<oid>/ship")
 def ship(oid):
@@ -833,6 +2260,8 @@ from repositories.stores_repo import StoresRepo
 from repositories.products_repo import ProductsRepo
 from repositories.orders_repo import OrdersRepo
 from repositories.users_repo import UsersRepo
+from utils.catalog import get_catalog_index
+from utils.common import keyset_page
 
 admin_bp = Blueprint("admin", __name__)
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
@@ -840,6 +2269,7 @@ stores = StoresRepo(DATA_DIR)
 products = ProductsRepo(DATA_DIR)
 orders = OrdersRepo(DATA_DIR)
 users = UsersRepo(DATA_DIR)
+catalog_index = get_catalog_index(products, stores)
 
 def require_admin():
     return bool(g.user and g.user.get("role") == "admin")
@@ -848,12 +2278,13 @@ def require_admin():
 def admin_stores():
     if not require_admin(): return ({"error":"forbidden"}, 403)
     status = request.args.get("status")
-    items = stores.list()
-    if status == "blocked":
-        items = [s for s in items if s.get("is_blocked")]
-    elif status == "active":
-        items = [s for s in items if not s.get("is_blocked")]
-    return jsonify({"items":items, "total": len(items)})
+    if status in ("blocked", "active"):
+        body = keyset_page(stores, request.args, "is_blocked", status == "blocked")
+    else:
+        body = keyset_page(stores, request.args)
+    if body is None:
+        return jsonify({"error":"invalid_cursor"}), 400
+    return jsonify(body)
 
 @admin_bp.patch("/stores/<sid>/block")
 def block_store(sid):
@@ -863,6 +2294,7 @@ def block_store(sid):
     if not s: return ({"error":"not_found"},404)
     s["is_blocked"] = bool(data.get("is_blocked", True))
     stores.update(sid, s)
+    catalog_index.put_store(s)
     return jsonify(s)
 
 @admin_bp.get("/reports/summary")
@@ -911,7 +2343,9 @@ def mk_products_for_store(sid, prefix):
             "stock": 5 + i,
             "images": ["https://picsum.photos/seed/"+str(uuid.uuid4())+"/600/400"],
             "category": "general",
-            "active": True
+            "active": True,
+            "sold_count": 0,
+            "created_at": datetime.datetime.utcnow().isoformat()
         })
     return items
 
@@ -0,0 +1,963 @@
+#!/usr/bin/env python3
+"""
+Tests for the GitHub storage layer of server_v2.py
+Runs against a small in-process stand-in for the GitHub REST API
+
+Run: python -m pytest test_github_storage.py
+"""
+
+import base64
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+import server_v2
+
+REPO = 'octo/homeos-data'
+BRANCH = 'main'
+
+# ==================== FAKE GITHUB ====================
+
+def _sha(kind, data):
+    return hashlib.sha1(f'{kind} {len(data)}\0'.encode() + data).hexdigest()
+
+class FakeGitHub:
+    """Just enough of the Contents and Git Data APIs, for a single branch"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.trees = {}      # tree sha -> {path: blob sha}
+        self.commits = {}    # commit sha -> {'tree', 'parents', 'message'}
+        self.head = None
+        self.calls = []
+        self.statuses = []
+        self.connections = set()
+        self.fail_next = []      # [(method or None, status, headers, message)] served before real handling
+        self.extra_headers = {}  # sent with every response
+        self.reject_ref_updates = 0
+        self._commit({}, 'Initial commit')
+
+    # ---- object store ----
+
+    def _blob(self, data):
+        sha = _sha('blob', data)
+        self.blobs[sha] = data
+        return sha
+
+    def _tree(self, files):
+        sha = _sha('tree', json.dumps(sorted(files.items())).encode())
+        self.trees[sha] = dict(files)
+        return sha
+
+    def _new_commit(self, tree_sha, parents, message):
+        sha = _sha('commit', json.dumps([tree_sha, parents, message, len(self.commits)]).encode())
+        self.commits[sha] = {'tree': tree_sha, 'parents': parents, 'message': message}
+        return sha
+
+    def _commit(self, files, message):
+        parents = [self.head] if self.head else []
+        self.head = self._new_commit(self._tree(files), parents, message)
+        return self.head
+
+    def files_at(self, ref=None):
+        commit = self.head if ref in (None, BRANCH) else ref
+        return self.trees[self.commits[commit]['tree']]
+
+    def read(self, path):
+        """Decoded JSON of a file on the branch, for assertions"""
+        return json.loads(self.blobs[self.files_at()[path]].decode('utf-8'))
+
+    def commit_count(self):
+        count, sha = 0, self.head
+        while sha:
+            count += 1
+            parents = self.commits[sha]['parents']
+            sha = parents[0] if parents else None
+        return count
+
+    def write(self, path, content):
+        """Commit a file directly, as another client would"""
+        files = dict(self.files_at())
+        files[path] = self._blob(json.dumps(content).encode('utf-8'))
+        self._commit(files, f'External update {path}')
+
+    # ---- HTTP ----
+
+    def handle(self, method, path, query, body, headers=None):
+        prefix = f'/repos/{REPO}'
+        assert path.startswith(prefix), path
+        path = path[len(prefix):]
+        self.calls.append((method, path))
+
+        if path.startswith('/contents/'):
+            return self._contents(method, path[len('/contents/'):], query, body, headers or {})
+        if method == 'GET' and path == f'/git/ref/heads/{BRANCH}':
+            return 200, {'ref': f'refs/heads/{BRANCH}', 'object': {'sha': self.head, 'type': 'commit'}}
+        if method == 'GET' and path.startswith('/git/commits/'):
+            commit = self.commits.get(path.rsplit('/', 1)[1])
+            if not commit:
+                return 404, {'message': 'Not Found'}
+            return 200, {'sha': path.rsplit('/', 1)[1], 'tree': {'sha': commit['tree']}, 'parents': commit['parents']}
+        if method == 'POST' and path == '/git/blobs':
+            return 201, {'sha': self._blob(base64.b64decode(body['content']))}
+        if method == 'POST' and path == '/git/trees':
+            files = dict(self.trees[body['base_tree']]) if body.get('base_tree') else {}
+            entries = []
+            for entry in body['tree']:
+                if 'content' in entry:
+                    blob_sha = self._blob(entry['content'].encode('utf-8'))
+                else:
+                    blob_sha = entry['sha']
+                files[entry['path']] = blob_sha
+                entries.append({'path': entry['path'], 'mode': entry['mode'], 'type': 'blob', 'sha': blob_sha})
+            return 201, {'sha': self._tree(files), 'tree': entries}
+        if method == 'POST' and path == '/git/commits':
+            return 201, {'sha': self._new_commit(body['tree'], body['parents'], body['message'])}
+        if method == 'PATCH' and path == f'/git/refs/heads/{BRANCH}':
+            if self.reject_ref_updates:
+                self.reject_ref_updates -= 1
+                self.write('noise.json', {'moved': True})
+                return 422, {'message': 'Update is not a fast forward'}
+            if self.head not in self.commits[body['sha']]['parents'] and not body.get('force'):
+                return 422, {'message': 'Update is not a fast forward'}
+            self.head = body['sha']
+            return 200, {'object': {'sha': self.head}}
+        return 404, {'message': 'Not Found'}
+
+    def _contents(self, method, path, query, body, headers):
+        files = self.files_at(query.get('ref', [BRANCH])[0])
+        if method == 'GET':
+            if path in files:
+                if headers.get('If-None-Match') == f'"{files[path]}"':
+                    return 304, None
+                data = self.blobs[files[path]]
+                return 200, {'name': path.rsplit('/', 1)[-1], 'path': path, 'sha': files[path],
+                             'content': base64.b64encode(data).decode()}
+            children = {}
+            for file_path, blob_sha in files.items():
+                if file_path.startswith(path + '/'):
+                    rest = file_path[len(path) + 1:]
+                    name = rest.split('/', 1)[0]
+                    if '/' in rest:
+                        children.setdefault(name, {'name': name, 'type': 'dir', 'sha': None})
+                    else:
+                        children[name] = {'name': name, 'type': 'file', 'sha': blob_sha}
+            if not children:
+                return 404, {'message': 'Not Found'}
+            return 200, list(children.values())
+        if method == 'PUT':
+            current = files.get(path)
+            if current and body.get('sha') != current:
+                return 409, {'message': f'{path} does not match {body.get("sha")}'}
+            new_files = dict(files)
+            new_files[path] = self._blob(base64.b64decode(body['content']))
+            self._commit(new_files, body['message'])
+            return (200 if current else 201), {'content': {'sha': new_files[path]}}
+        return 405, {'message': 'Method not allowed'}
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, so connection reuse is observable
+        disable_nagle_algorithm = True
+
+        def _dispatch(self, method):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            headers = dict(fake.extra_headers)
+            with fake.lock:
+                fake.connections.add(self.client_address)
+                if fake.fail_next and fake.fail_next[0][0] in (None, method):
+                    _, status, extra, message = fake.fail_next.pop(0)
+                    payload = {'message': message}
+                    headers.update(extra)
+                else:
+                    status, payload = fake.handle(method, url.path, parse_qs(url.query), body, dict(self.headers))
+                fake.statuses.append(status)
+            data = b'' if payload is None else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            if isinstance(payload, dict) and 'content' in payload and 'sha' in payload:
+                self.send_header('ETag', f'"{payload["sha"]}"')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PATCH(self):
+            self._dispatch('PATCH')
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+@pytest.fixture
+def github(monkeypatch):
+    fake = FakeGitHub()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(fake))
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    monkeypatch.setattr(server_v2, 'GITHUB_API', f'http://127.0.0.1:{httpd.server_port}')
+    monkeypatch.setattr(server_v2, 'GITHUB_REPO', REPO)
+    monkeypatch.setattr(server_v2, 'GITHUB_BRANCH', BRANCH)
+    monkeypatch.setattr(server_v2, '_file_cache', {})
+    monkeypatch.setattr(server_v2, 'github_client', server_v2.GitHubClient('test-token', backoff=0))
+    monkeypatch.setattr(server_v2, 'user_directory', server_v2.UserDirectory())
+    yield fake
+    httpd.shutdown()
+    httpd.server_close()
+
+def _client(user_id=None, username=None):
+    client = server_v2.app.test_client()
+    if user_id is not None:
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['username'] = username
+    return client
+
+# ==================== MULTI-FILE COMMITS ====================
+
+def test_commit_files_writes_all_files_in_one_commit(github):
+    before = github.commit_count()
+    assert server_v2.github_commit_files({'a.json': [1], 'b.json': {'x': 2}}, 'Two files')
+    assert github.commit_count() == before + 1
+    assert github.read('data/a.json') == [1]
+    assert github.read('data/b.json') == {'x': 2}
+    assert server_v2.github_get_file('b.json')[0] == {'x': 2}
+
+def test_commit_files_refuses_stale_expected_sha(github):
+    github.write('data/a.json', [1])
+    _, sha = server_v2.github_get_file('a.json')
+    github.write('data/a.json', [1, 2])
+    before = github.commit_count()
+
+    assert not server_v2.github_commit_files({'a.json': [9], 'b.json': [9]}, 'Stale', expected_shas={'a.json': sha})
+    assert github.commit_count() == before
+    assert github.read('data/a.json') == [1, 2]
+    assert 'data/b.json' not in github.files_at()
+
+def test_commit_files_expects_missing_file(github):
+    assert server_v2.github_commit_files({'new.json': []}, 'Create', expected_shas={'new.json': None})
+    assert not server_v2.github_commit_files({'new.json': [1]}, 'Create again', expected_shas={'new.json': None})
+
+def test_commit_files_retries_when_branch_moves(github):
+    github.reject_ref_updates = 1
+    assert server_v2.github_commit_files({'a.json': [1]}, 'Retry')
+    assert github.read('data/a.json') == [1]
+    assert github.read('noise.json') == {'moved': True}
+
+def test_transfer_is_a_single_commit(github):
+    github.write('data/bank_users.json', [
+        {'telegram_id': 1, 'username': 'alice', 'balance': 100},
+        {'telegram_id': 2, 'username': 'bob', 'balance': 0},
+    ])
+    github.write('data/bank_history.json', [])
+    before = github.commit_count()
+
+    response = _client(1, 'alice').post('/api/bank/transfer', json={'to': 'bob', 'amount': 30})
+    assert response.status_code == 200
+    assert response.json['balance'] == 70
+    assert github.commit_count() == before + 1
+    assert [u['balance'] for u in github.read('data/bank_users.json')] == [70, 30]
+    assert github.read('data/bank_history/000001.json')[-1]['to'] == 'bob'
+    assert not [c for c in github.calls if c[0] == 'PUT']
+
+def test_init_is_a_single_commit(github):
+    before = github.commit_count()
+    response = _client().post('/api/init')
+    assert response.json['success']
+    assert github.commit_count() == before + 1
+    assert len(github.read('data/shop_products.json')) == 2
+    assert github.read('data/users.json') == []
+
+# ==================== READ CACHE ====================
+
+def _reads(github, path):
+    return [c for c in github.calls if c == ('GET', f'/contents/data/{path}')]
+
+def test_reads_within_ttl_are_served_from_memory(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 60)
+    github.write('data/shop_products.json', [{'id': 1}])
+    for _ in range(5):
+        products, _ = server_v2.github_get_file('shop_products.json')
+        assert products == [{'id': 1}]
+    assert len(_reads(github, 'shop_products.json')) == 1
+
+def test_cached_reads_are_independent_copies(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 60)
+    github.write('data/bank_users.json', [{'balance': 1}])
+    users, _ = server_v2.github_get_file('bank_users.json')
+    users[0]['balance'] = 999
+    assert server_v2.github_get_file('bank_users.json')[0] == [{'balance': 1}]
+
+def test_stale_entries_revalidate_with_etag(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 0)
+    github.write('data/shop_products.json', [{'id': 1}])
+    first = server_v2.github_get_file('shop_products.json')
+    second = server_v2.github_get_file('shop_products.json')
+    assert first == second
+    assert github.statuses[-1] == 304
+
+    github.write('data/shop_products.json', [{'id': 2}])
+    products, sha = server_v2.github_get_file('shop_products.json')
+    assert products == [{'id': 2}]
+    assert sha == github.files_at()['data/shop_products.json']
+    assert github.statuses[-1] == 200
+
+def test_writes_refresh_the_cache(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 60)
+    assert server_v2.github_put_file('a.json', [1])
+    assert server_v2.github_commit_files({'b.json': [2]}, 'b')
+    calls = len(github.calls)
+    assert server_v2.github_get_file('a.json') == ([1], github.files_at()['data/a.json'])
+    assert server_v2.github_get_file('b.json') == ([2], github.files_at()['data/b.json'])
+    assert len(github.calls) == calls
+
+def test_conflict_drops_stale_cache_entry(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 60)
+    github.write('data/a.json', [1])
+    _, sha = server_v2.github_get_file('a.json')
+    github.write('data/a.json', [2])
+    assert not server_v2.github_commit_files({'a.json': [3]}, 'stale', expected_shas={'a.json': sha})
+    assert server_v2.github_get_file('a.json')[0] == [2]
+
+# ==================== CLIENT ====================
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+    monkeypatch.setattr(server_v2.time, 'sleep', calls.append)
+    return calls
+
+def test_client_reuses_one_connection(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 0)
+    github.write('data/a.json', [1])
+    for _ in range(5):
+        assert server_v2.github_get_file('a.json')[0] == [1]
+    assert len(github.connections) == 1
+
+def test_client_retries_server_errors(github):
+    github.write('data/a.json', [1])
+    github.fail_next = [(None, 502, {}, 'Bad gateway'), (None, 503, {}, 'Unavailable')]
+    assert server_v2.github_get_file('a.json')[0] == [1]
+    stats = server_v2.github_client.stats()['calls']['GET contents']
+    assert stats['calls'] == 3
+    assert stats['retries'] == 2
+    assert stats['errors'] == 2
+
+def test_client_retries_write_conflicts_only(github):
+    github.fail_next = [('PATCH', 409, {}, 'Reference update failed')]
+    assert server_v2.github_commit_files({'a.json': [1]}, 'conflict once')
+    assert server_v2.github_client.stats()['calls']['PATCH git/refs']['retries'] == 1
+
+def test_client_does_not_retry_sha_mismatch(github, sleeps):
+    github.write('data/a.json', [1])
+    assert not server_v2.github_put_file('a.json', [2], sha='0' * 40)
+    assert server_v2.github_client.stats()['calls']['PUT contents']['retries'] == 0
+    assert sleeps == []
+
+def test_client_waits_out_secondary_rate_limit(github, sleeps):
+    github.write('data/a.json', [1])
+    github.fail_next = [(None, 403, {'Retry-After': '7'}, 'You have exceeded a secondary rate limit')]
+    assert server_v2.github_get_file('a.json')[0] == [1]
+    assert any(6 <= s <= 7 for s in sleeps)
+
+def test_client_does_not_retry_plain_forbidden(github):
+    github.fail_next = [(None, 403, {}, 'Resource not accessible by integration')]
+    assert server_v2.github_get_file('a.json') == (None, None)
+    assert server_v2.github_client.stats()['calls']['GET contents']['retries'] == 0
+
+def test_client_slows_down_when_quota_runs_low(github, sleeps, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 0)
+    github.write('data/a.json', [1])
+    reset = server_v2.time.time() + 100
+    github.extra_headers = {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': str(int(reset))}
+    server_v2.github_get_file('a.json')
+    assert sleeps == []
+    server_v2.github_get_file('a.json')
+    assert len(sleeps) == 1 and 8 <= sleeps[0] <= 10
+    assert server_v2.github_client.stats()['rate_limit_remaining'] == 10
+
+def test_client_spaces_out_concurrent_paced_calls(github, sleeps, monkeypatch):
+    client = server_v2.github_client
+    now = server_v2.time.time()
+    monkeypatch.setattr(client, '_remaining', 10)
+    monkeypatch.setattr(client, '_reset_at', now + 100)
+    threads = [threading.Thread(target=client._pace) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 100s over 10, 9 and 8 remaining requests: each thread takes the slot after the last
+    assert sorted(round(s) for s in sleeps) == [10, 21, 34]
+
+# ==================== HISTORY LOG ====================
+
+def test_history_appends_rotate_into_bounded_segments(github):
+    log = server_v2.SegmentedHistory('h', segment_size=2)
+    for i in range(5):
+        files, expected, position = log.append({'n': i})
+        assert position == [i // 2 + 1, i % 2]
+        assert server_v2.storage_commit(files, 'append', expected)
+    assert github.read('data/h/000001.json') == [{'n': 0}, {'n': 1}]
+    assert github.read('data/h/000003.json') == [{'n': 4}]
+    assert github.read('data/h/head.json') == {'segment': 3, 'first': 1, 'indexed': True}
+    assert [e['n'] for _, e in log.reverse()] == [4, 3, 2, 1, 0]
+    assert [e['n'] for _, e in log.reverse(before=[2, 1])] == [2, 1, 0]
+
+def test_history_reads_only_the_segments_it_needs(github):
+    log = server_v2.SegmentedHistory('h', segment_size=2)
+    github.write('data/h/head.json', {'segment': 3, 'first': 1})
+    for n in (1, 2, 3):
+        github.write(f'data/h/{n:06d}.json', [{'n': 2 * n - 2}, {'n': 2 * n - 1}])
+    assert [e['n'] for e in log.latest(3)] == [5, 4, 3]
+    assert not _reads(github, 'h/000001.json')
+
+def test_history_reads_legacy_file_after_segments(github):
+    github.write('data/bank_history.json', [
+        {'from': 'alice', 'to': 'bob', 'amount': 2, 'time': '2023'},
+        {'from': 'carol', 'to': 'dave', 'amount': 1, 'time': '2022'},
+    ])
+    files, expected, _ = server_v2.bank_history().append({'from': 'bob', 'to': 'alice', 'amount': 3, 'time': '2024'})
+    assert server_v2.storage_commit(files, 'append', expected)
+    response = _client(1, 'alice').get('/api/bank/history')
+    assert [h['amount'] for h in response.json] == [3, 2]
+
+    assert _client().post('/api/init').json['success']
+    assert _client(1, 'alice').get('/api/bank/history').json == []
+
+def test_history_append_refuses_concurrent_writer(github):
+    log = server_v2.SegmentedHistory('h')
+    first = log.append({'n': 1})[:2]
+    second = log.append({'n': 2})[:2]
+    assert server_v2.storage_commit(first[0], 'first', first[1])
+    assert not server_v2.storage_commit(second[0], 'second', second[1])
+
+# ==================== HISTORY INDEX ====================
+
+def _transfers(github, monkeypatch, count):
+    monkeypatch.setattr(server_v2, 'HISTORY_SEGMENT_SIZE', 2)
+    github.write('data/bank_users.json', [
+        {'telegram_id': 1, 'username': 'alice', 'balance': 1000},
+        {'telegram_id': 2, 'username': 'bob', 'balance': 1000},
+        {'telegram_id': 3, 'username': 'carol', 'balance': 1000},
+    ])
+    clock = iter(f'2024-01-{day:02d}T12:00:00' for day in range(1, count + 1))
+    monkeypatch.setattr(server_v2, '_transfer_entry', lambda f, t, amount, comment: {
+        'time': next(clock), 'from': f['username'], 'to': t['username'], 'amount': amount, 'comment': comment, 'type': 'transfer'})
+    alice, bob = _client(1, 'alice'), _client(2, 'bob')
+    for n in range(1, count + 1):
+        # alice -> bob on odd days, bob -> carol on even days
+        client, to = (alice, 'bob') if n % 2 else (bob, 'carol')
+        assert client.post('/api/bank/transfer', json={'to': to, 'amount': n}).json['success']
+
+def test_history_index_follows_transfers(github, monkeypatch):
+    _transfers(github, monkeypatch, 6)
+    assert [i['dir'] for i in github.read('data/bank_history/index/1/2.json')] == ['in', 'out'] * 3
+    assert [i['pos'] for i in github.read('data/bank_history/index/1/1.json')] == [[1, 0], [2, 0], [3, 0]]
+
+def test_history_pages_with_cursor(github, monkeypatch):
+    _transfers(github, monkeypatch, 6)
+    bob = _client(2, 'bob')
+    first = bob.get('/api/bank/history?limit=4').json
+    assert [h['amount'] for h in first] == [6, 5, 4, 3]
+    rest = bob.get(f"/api/bank/history?limit=4&before={first[-1]['cursor']}").json
+    assert [h['amount'] for h in rest] == [2, 1]
+
+def test_history_filters_by_date_and_direction(github, monkeypatch):
+    _transfers(github, monkeypatch, 6)
+    bob = _client(2, 'bob')
+    assert [h['amount'] for h in bob.get('/api/bank/history?direction=in').json] == [5, 3, 1]
+    assert [h['amount'] for h in bob.get('/api/bank/history?direction=out&to_date=2024-01-04').json] == [4, 2]
+    assert [h['amount'] for h in bob.get('/api/bank/history?from_date=2024-01-02&to_date=2024-01-03').json] == [3, 2]
+    assert bob.get('/api/bank/history?direction=sideways').status_code == 400
+    assert bob.get('/api/bank/history?limit=0').status_code == 400
+
+def test_history_page_reads_only_its_segments(github, monkeypatch):
+    _transfers(github, monkeypatch, 6)
+    github.calls.clear()
+    monkeypatch.setattr(server_v2, '_file_cache', {})
+    page = _client(1, 'alice').get('/api/bank/history?limit=1').json
+    assert [h['amount'] for h in page] == [5]
+    assert not _reads(github, 'bank_history/000001.json') and not _reads(github, 'bank_history/000002.json')
+
+def test_reindex_covers_legacy_history(github, monkeypatch):
+    github.write('data/bank_users.json', [{'telegram_id': 1, 'username': 'alice'}, {'telegram_id': 2, 'username': 'bob'}])
+    github.write('data/bank_history.json', [
+        {'time': '2023-01-02', 'from': 'bob', 'to': 'alice', 'amount': 2},
+        {'time': '2023-01-01', 'from': 'alice', 'to': 'bob', 'amount': 1},
+    ])
+    assert server_v2.HistoryIndex(server_v2.bank_history()).get(1) is None
+    assert server_v2.reindex_history()
+    assert [i['dir'] for i in github.read('data/bank_history/index/1/1.json')] == ['out', 'in']
+    page = _client(1, 'alice').get('/api/bank/history?direction=in').json
+    assert [(h['amount'], h['cursor']) for h in page] == [(2, '0.1')]
+
+# ==================== SHARDED LAYOUT ====================
+
+def _seed_flat(github):
+    github.write('data/bank_users.json', [
+        {'telegram_id': 1, 'username': 'alice', 'balance': 100},
+        {'telegram_id': 2, 'username': 'bob', 'balance': 0},
+    ])
+    github.write('data/bank_history.json', [
+        {'time': '2024-01-02', 'from': 'bob', 'to': 'alice', 'amount': 5, 'comment': '', 'type': 'transfer'},
+        {'time': '2024-01-01', 'from': 'alice', 'to': 'carol', 'amount': 1, 'comment': '', 'type': 'transfer'},
+    ])
+    github.write('data/mywork_shifts.json', {'alice': [{'minutes': 60}]})
+    github.write('data/mywork_running.json', {'bob': '2024-01-03T09:00:00'})
+    github.write('data/myinfo_records.json', {'alice': {'note': 'hi'}, 'dave': {}})
+
+@pytest.fixture
+def sharded(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'SHARDED', True)
+    _seed_flat(github)
+    assert server_v2.migrate_to_sharded()
+    return github
+
+def test_migration_splits_flat_files_per_user(sharded):
+    assert sharded.read('data/users/index.json') == [
+        {'telegram_id': 1, 'username': 'alice', 'isAdmin': None, 'deleted': None},
+        {'telegram_id': 2, 'username': 'bob', 'isAdmin': None, 'deleted': None},
+    ]
+    assert [h['from'] for h in sharded.read('data/users/1/history/000001.json')] == ['alice', 'bob']
+    assert [h['from'] for h in sharded.read('data/users/2/history/000001.json')] == ['bob']
+    assert sharded.read('data/users/1/history/head.json') == {'segment': 1, 'first': 1, 'indexed': True}
+    assert sharded.read('data/users/1/mywork.json') == {'running': None, 'shifts': [{'minutes': 60}]}
+    assert sharded.read('data/users/2/mywork.json') == {'running': '2024-01-03T09:00:00', 'shifts': []}
+    assert sharded.read('data/users/1/myinfo.json') == {'note': 'hi'}
+    assert sharded.read('data/bank_users.json')[0]['balance'] == 100
+
+def test_build_sharded_layout_reports_unknown_users():
+    _, skipped = server_v2.build_sharded_layout([], [{'from': 'x', 'to': 'y'}], {}, {}, {'z': {}})
+    assert skipped == ['x', 'y', 'z']
+
+def test_sharded_transfer_touches_only_both_parties(sharded):
+    sharded.calls.clear()
+    response = _client(1, 'alice').post('/api/bank/transfer', json={'to': 'bob', 'amount': 30})
+    assert response.json == {'success': True, 'balance': 70}
+    assert sharded.read('data/users/1/account.json')['balance'] == 70
+    assert sharded.read('data/users/2/account.json')['balance'] == 30
+    assert sharded.read('data/users/2/history/000001.json')[-1]['amount'] == 30
+    touched = {c[1] for c in sharded.calls if '/contents/' in c[1]}
+    assert all(path == '/contents/data/users/index.json' or path.startswith(('/contents/data/users/1', '/contents/data/users/2'))
+               for path in touched)
+
+def test_sharded_reads_only_the_callers_shard(sharded):
+    client = _client(2, 'bob')
+    sharded.calls.clear()
+    assert [h['to'] for h in client.get('/api/bank/history').json] == ['alice']
+    assert client.post('/api/mywork/stop-shift', json={'minutes': 30, 'pay': 5}).json['success']
+    assert client.get('/api/mywork/shifts').json[0]['start'] == '2024-01-03T09:00:00'
+    assert client.post('/api/myinfo/records', json={'a': 1}).json['success']
+    assert client.get('/api/myinfo/records').json == {'a': 1}
+    assert all('/data/users/2/' in c[1] for c in sharded.calls if '/contents/' in c[1])
+
+def test_sharded_account_is_created_on_first_visit(sharded):
+    response = _client(3, 'carol').get('/api/bank/my-account')
+    assert response.json['balance'] == 1000
+    assert sharded.read('data/users/3/account.json')['username'] == 'carol'
+    assert sharded.read('data/users/index.json')[-1]['username'] == 'carol'
+
+# ==================== USER DIRECTORY ====================
+
+@pytest.fixture
+def login(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'verify_telegram_auth', lambda init_data: json.loads(init_data))
+
+    def login(telegram_id, username):
+        init_data = json.dumps({'id': telegram_id, 'username': username})
+        return _client().post('/api/auth/telegram', json={'initData': init_data}).json
+    return login
+
+def test_registration_appends_to_the_log(github, login):
+    assert login(1, 'alice')['success']
+    assert login(2, 'bob')['success']
+    assert [u['username'] for u in github.read('data/registrations/000001.json')] == ['alice', 'bob']
+    assert github.read('data/registrations/head.json')['segment'] == 1
+
+def test_known_user_login_makes_no_storage_request(github, login):
+    login(1, 'alice')
+    github.calls.clear()
+    assert login(1, 'alice')['user']['username'] == 'alice'
+    assert github.calls == []
+
+def test_directory_reads_legacy_users_file(github, login):
+    github.write('data/users.json', [{'telegram_id': 1, 'username': 'alice'}])
+    before = github.commit_count()
+    login(1, 'alice')
+    assert github.commit_count() == before
+    login(2, 'bob')
+    assert [u['username'] for u in github.read('data/registrations/000001.json')] == ['bob']
+    assert {u['username'] for u in server_v2.user_directory.users()} == {'alice', 'bob'}
+
+def test_directory_picks_up_other_workers_registrations(github, login, monkeypatch):
+    login(1, 'alice')
+    other = server_v2.UserDirectory()
+    assert other.register({'telegram_id': 2, 'username': 'bob'})
+    monkeypatch.setattr(server_v2, '_file_cache', {})
+    assert server_v2.user_directory.get(2)['username'] == 'bob'
+    before = github.commit_count()
+    login(2, 'bob')
+    assert github.commit_count() == before
+
+def test_login_fails_when_registration_keeps_losing(github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'verify_telegram_auth', lambda init_data: json.loads(init_data))
+    monkeypatch.setattr(server_v2, 'storage_commit', lambda files, message, expected_shas=None: False)
+    client = _client()
+    response = client.post('/api/auth/telegram', json={'initData': json.dumps({'id': 5, 'username': 'eve'})})
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert not response.json['success']
+    assert server_v2.user_directory.get(5) is None
+    with client.session_transaction() as sess:
+        assert 'user_id' not in sess
+
+# ==================== WRITE-BEHIND ====================
+
+@pytest.fixture
+def write_behind(github, tmp_path, monkeypatch):
+    # Long interval: tests flush explicitly
+    store = server_v2.WriteBehindStore(str(tmp_path / 'write_behind.journal'), interval=3600).start()
+    monkeypatch.setattr(server_v2, 'WRITE_BEHIND', True)
+    monkeypatch.setattr(server_v2, '_write_behind', store)
+    yield store
+    store.stop()
+
+def test_write_behind_commit_does_not_touch_github(github, write_behind):
+    github.write('data/a.json', [1])
+    _, version = server_v2.storage_get('a.json')
+    calls = len(github.calls)
+    assert server_v2.storage_commit({'a.json': [1, 2]}, 'Append', {'a.json': version})
+    assert len(github.calls) == calls
+    assert server_v2.storage_get('a.json')[0] == [1, 2]
+    assert github.read('data/a.json') == [1]
+
+def test_write_behind_refuses_stale_version(github, write_behind):
+    _, version = server_v2.storage_get('a.json')
+    assert server_v2.storage_commit({'a.json': [1]}, 'First', {'a.json': version})
+    assert not server_v2.storage_commit({'a.json': [2]}, 'Stale', {'a.json': version})
+    assert server_v2.storage_get('a.json')[0] == [1]
+
+def test_write_behind_flush_coalesces_into_one_commit(github, write_behind):
+    before = github.commit_count()
+    for i in range(5):
+        data, version = server_v2.storage_get('a.json')
+        assert server_v2.storage_commit({'a.json': (data or []) + [i], 'b.json': {'n': i}}, 'Step', {'a.json': version})
+    assert write_behind.flush()
+    assert github.commit_count() == before + 1
+    assert github.read('data/a.json') == [0, 1, 2, 3, 4]
+    assert github.read('data/b.json') == {'n': 4}
+    assert write_behind.pending() == []
+    assert open(write_behind.journal_path).read() == ''
+
+def test_write_behind_replays_journal_after_crash(github, tmp_path):
+    journal = str(tmp_path / 'write_behind.journal')
+    store = server_v2.WriteBehindStore(journal, interval=3600).start()
+    store.commit({'a.json': [1]}, 'One')
+    store.commit({'a.json': [1, 2]}, 'Two')
+    store._stop.set()  # crash: the flusher never runs and nothing was pushed
+    with open(journal, 'a') as f:
+        f.write('{"seq": 3, "files": {"a.js')  # torn final write
+
+    revived = server_v2.WriteBehindStore(journal, interval=3600).start()
+    assert revived.pending() == ['a.json']
+    assert revived.get('a.json')[0] == [1, 2]
+    assert revived.commit({'b.json': []}, 'After restart')
+    assert revived.flush()
+    assert github.read('data/a.json') == [1, 2]
+    revived.stop()
+
+def test_write_behind_keeps_writes_made_after_a_torn_record(github, tmp_path):
+    journal = str(tmp_path / 'write_behind.journal')
+    store = server_v2.WriteBehindStore(journal, interval=3600).start()
+    store.commit({'a.json': [1]}, 'One')
+    store._stop.set()
+    with open(journal, 'a') as f:
+        f.write('{"seq": 2, "files": {"a.js')
+
+    revived = server_v2.WriteBehindStore(journal, interval=3600).start()
+    assert revived.commit({'b.json': [42]}, 'After restart')
+    revived._stop.set()  # second crash before any flush
+
+    again = server_v2.WriteBehindStore(journal, interval=3600).start()
+    assert again.pending() == ['a.json', 'b.json']
+    assert again.get('b.json')[0] == [42]
+    again.stop()
+
+def test_write_behind_flush_refuses_to_overwrite_another_writer(github, write_behind):
+    github.write('data/a.json', [1])
+    for n in (2, 3):
+        data, version = write_behind.get('a.json')
+        assert write_behind.commit({'a.json': data + [n]}, 'Append', {'a.json': version})
+        assert write_behind.flush()
+    assert write_behind.commit({'a.json': [1, 2, 3, 4]}, 'Append')
+    github.write('data/a.json', ['another worker'])
+    assert not write_behind.flush()
+    assert github.read('data/a.json') == ['another worker']
+    assert write_behind.pending() == ['a.json']
+
+def test_write_behind_remembers_github_shas_across_restarts(github, tmp_path):
+    journal = str(tmp_path / 'write_behind.journal')
+    github.write('data/a.json', [1])
+    store = server_v2.WriteBehindStore(journal, interval=3600).start()
+    store.commit({'a.json': [1, 2], 'new.json': {}}, 'One')
+    store._stop.set()  # crash before the flush
+
+    github.write('data/a.json', ['another worker'])
+    revived = server_v2.WriteBehindStore(journal, interval=3600).start()
+    assert not revived.flush()
+    assert github.read('data/a.json') == ['another worker']
+    revived._stop.set()
+
+def test_write_behind_does_not_cache_failed_reads(github, write_behind):
+    github.write('data/a.json', [1, 2, 3])
+    github.fail_next = [('GET', 500, {}, 'Server error')] * 10  # both calls, retries included
+    with pytest.raises(server_v2.GitHubReadError):
+        write_behind.get('a.json')
+    with pytest.raises(server_v2.GitHubReadError):
+        write_behind.commit({'a.json': [9]}, 'Blind write', {'a.json': None})
+    data, version = write_behind.get('a.json')
+    assert data == [1, 2, 3]
+    assert not write_behind.commit({'a.json': [9]}, 'Blind write', {'a.json': None})
+    assert write_behind.commit({'a.json': data + [4]}, 'Append', {'a.json': version})
+    assert write_behind.flush()
+    assert github.read('data/a.json') == [1, 2, 3, 4]
+
+def test_write_behind_transfer_returns_before_push(github, write_behind):
+    github.write('data/bank_users.json', [
+        {'telegram_id': 1, 'username': 'alice', 'balance': 100},
+        {'telegram_id': 2, 'username': 'bob', 'balance': 0},
+    ])
+    client = _client(1, 'alice')
+    client.post('/api/bank/transfer', json={'to': 'bob', 'amount': 30})
+    writes = [c for c in github.calls if c[0] in ('PUT', 'POST', 'PATCH')]
+    response = client.post('/api/bank/transfer', json={'to': 'bob', 'amount': 30})
+    assert response.json['balance'] == 40
+    assert [c for c in github.calls if c[0] in ('PUT', 'POST', 'PATCH')] == writes == []
+    assert write_behind.flush()
+    assert [u['balance'] for u in github.read('data/bank_users.json')] == [40, 60]
+
+# ==================== CHANGE FEED ====================
+
+@pytest.fixture
+def feed(github, monkeypatch):
+    feed = server_v2.ChangeFeed(server_v2.feed_records, size=50)
+    monkeypatch.setattr(server_v2, 'change_feed', feed)
+    _seed_flat(github)
+    return feed
+
+def _changes(client, cursor, **params):
+    return client.get('/api/changes', query_string=dict(params, since=cursor)).json
+
+def test_changes_start_with_reset(feed):
+    response = _client(1, 'alice').get('/api/changes').json
+    assert response['reset'] and response['cursor'] == f'{feed.epoch}.0'
+
+def test_changes_return_only_changed_records(feed):
+    alice, bob = _client(1, 'alice'), _client(2, 'bob')
+    cursor = alice.get('/api/changes').json['cursor']
+    assert bob.post('/api/bank/transfer', json={'to': 'alice', 'amount': 0.5}).status_code == 400
+    assert alice.post('/api/bank/transfer', json={'to': 'bob', 'amount': 40}).json['success']
+    response = _changes(alice, cursor, collections='bank_users')
+    assert [(c['id'], c['op'], c['data']['balance']) for c in response['changes']] == [(1, 'put', 60), (2, 'put', 40)]
+    assert not response['more']
+    assert _changes(alice, response['cursor']) == {'changes': [], 'cursor': response['cursor'], 'more': False}
+
+def test_changes_see_external_writes_and_deletes(feed, github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 0)
+    client = _client(1, 'alice')
+    cursor = client.get('/api/changes').json['cursor']
+    github.write('data/shop_products.json', [{'id': 7, 'title': 'New'}])
+    response = _changes(client, cursor, collections='shop_products')
+    assert [(c['id'], c['op']) for c in response['changes']] == [(7, 'put')]
+    github.write('data/shop_products.json', [])
+    assert [(c['id'], c['op']) for c in _changes(client, response['cursor'])['changes']] == [(7, 'delete')]
+
+def test_private_changes_go_to_their_owner_only(feed):
+    alice, bob = _client(1, 'alice'), _client(2, 'bob')
+    cursors = [c.get('/api/changes').json['cursor'] for c in (alice, bob)]
+    assert alice.post('/api/myinfo/records', json={'note': 'new'}).json['success']
+    assert [c['data'] for c in _changes(alice, cursors[0], collections='myinfo_records')['changes']] == [{'note': 'new'}]
+    assert _changes(bob, cursors[1], collections='myinfo_records')['changes'] == []
+
+def test_changes_page_and_reset_past_the_horizon(feed):
+    client = _client(1, 'alice')
+    cursor = client.get('/api/changes').json['cursor']
+    for n in range(3):
+        assert client.post('/api/myinfo/records', json={'n': n}).json['success']
+    first = _changes(client, cursor, limit=2)
+    assert [c['data']['n'] for c in first['changes']] == [0, 1] and first['more']
+    assert [c['data']['n'] for c in _changes(client, first['cursor'])['changes']] == [2]
+    for n in range(60):
+        feed.observe('shop_products.json', [{'id': 1, 'n': n}])
+    assert _changes(client, cursor)['reset']
+    assert _changes(client, 'other-process.0')['reset']
+    assert client.get('/api/changes', query_string={'collections': 'secrets'}).status_code == 400
+
+def test_feed_skips_files_it_has_already_compared(feed):
+    compared = []
+    def records(file_path, content):
+        compared.append(file_path)
+        return server_v2.feed_records(file_path, content)
+    feed = server_v2.ChangeFeed(records)
+    feed.observe('shop_products.json', [{'id': 1}], 'sha-1')
+    feed.observe('shop_products.json', [{'id': 1}], 'sha-1')
+    feed.observe('shop_products.json', [{'id': 1}, {'id': 2}], 'sha-2')
+    assert compared == ['shop_products.json', 'shop_products.json']
+    assert feed.since(f'{feed.epoch}.0', {'shop_products'}, {None}, 10)[0] == [
+        {'seq': 1, 'collection': 'shop_products', 'id': 2, 'op': 'put', 'data': {'id': 2}}]
+
+def test_feed_ignores_products_without_id(feed, github, monkeypatch):
+    monkeypatch.setattr(server_v2, 'GITHUB_CACHE_TTL', 0)
+    client = _client(1, 'alice')
+    cursor = client.get('/api/changes').json['cursor']
+    github.write('data/shop_products.json', [{'title': 'Draft'}, {'id': 7, 'title': 'New'}])
+    assert [(c['id'], c['op']) for c in _changes(client, cursor, collections='shop_products')['changes']] == [(7, 'put')]
+
+# ==================== EVENTS ====================
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = server_v2.EventBus(size=4)
+    monkeypatch.setattr(server_v2, 'event_bus', bus)
+    monkeypatch.setattr(server_v2, 'EVENTS_HEARTBEAT', 0.05)
+    return bus
+
+def _events(messages):
+    """(id, event, data) of the SSE messages, skipping comments and retry"""
+    events = []
+    for message in messages:
+        fields = dict(line.split(': ', 1) for line in message.strip().split('\n') if not line.startswith((':', 'retry')))
+        if fields:
+            events.append((fields.get('id'), fields['event'], json.loads(fields['data'])))
+    return events
+
+def test_events_reach_only_their_recipients(bus):
+    alice, bob = bus.stream(1, heartbeat=0.05), bus.stream(2, heartbeat=0.05)
+    next(alice), next(bob)  # retry: line; both are subscribed from here on
+    bus.publish([1], 'balance', {'balance': 5})
+    assert _events([next(alice)]) == [(f'{bus.epoch}.1', 'balance', {'balance': 5})]
+    assert next(bob) == ': heartbeat\n\n'
+    alice.close()
+    bob.close()
+    assert bus.subscribers() == 0
+
+def test_events_resume_from_last_event_id(bus):
+    bus.publish([1], 'balance', {'balance': 1})
+    bus.publish([2], 'balance', {'balance': 2})
+    bus.publish([1], 'balance', {'balance': 3})
+    stream = bus.stream(1, f'{bus.epoch}.1')
+    assert _events([next(stream), next(stream)]) == [(f'{bus.epoch}.3', 'balance', {'balance': 3})]
+    stream.close()
+    for n in range(4):
+        bus.publish([2], 'balance', {'balance': n})
+    stream = bus.stream(1, f'{bus.epoch}.1')
+    assert _events([next(stream), next(stream)]) == [(f'{bus.epoch}.7', 'reset', {})]
+    stream.close()
+    stream = bus.stream(1, 'another-process.3')
+    assert _events([next(stream), next(stream)])[0][1] == 'reset'
+    stream.close()
+
+def test_transfer_pushes_balances_and_the_entry(github, bus):
+    _seed_flat(github)
+    response = _client(2, 'bob').get('/api/events', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    next(chunks)
+    assert _client(1, 'alice').post('/api/bank/transfer', json={'to': 'bob', 'amount': 30}).json['success']
+    events = _events([next(chunks).decode(), next(chunks).decode()])
+    assert [(event, data.get('balance'), data.get('from')) for _, event, data in events] == \
+        [('balance', 30, None), ('transfer', None, 'alice')]
+    response.close()
+    assert bus.subscribers() == 0
+
+def test_shift_events(github, bus):
+    stream = bus.stream(1)
+    next(stream)
+    client = _client(1, 'alice')
+    assert client.post('/api/mywork/start-shift').json['success']
+    assert client.post('/api/mywork/stop-shift', json={'minutes': 5, 'pay': 1}).json['success']
+    (_, _, started), (_, _, stopped) = _events([next(stream), next(stream)])
+    assert started['running'] and stopped['running'] is None and stopped['shift']['minutes'] == 5
+    stream.close()
+
+def test_events_turn_clients_away_past_the_cap(github, bus, monkeypatch):
+    monkeypatch.setattr(server_v2, 'EVENTS_MAX_STREAMS', 1)
+    stream = bus.stream(1)
+    next(stream)
+    assert _client(2, 'bob').get('/api/events').status_code == 503
+    stream.close()
+    response = _client(2, 'bob').get('/api/events', buffered=False)
+    assert response.status_code == 200
+    response.close()
+
+def test_event_stream_cap_holds_under_concurrent_connects(bus):
+    barrier = threading.Barrier(10)
+    streams = []
+
+    def connect(user):
+        barrier.wait()
+        streams.append(bus.stream(user, limit=3))
+    threads = [threading.Thread(target=connect, args=(n,)) for n in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    opened = [stream for stream in streams if stream is not None]
+    assert len(opened) == 3 and bus.subscribers() == 3
+    for stream in opened:
+        stream.close()
+    assert bus.subscribers() == 0
+
+# ==================== BATCH ====================
+
+def test_batch_runs_calls_in_order_with_one_read_per_file(github):
+    _seed_flat(github)
+    client = _client(1, 'alice')
+    github.calls.clear()
+    response = client.post('/api/batch', json={'requests': [
+        {'path': '/api/auth/check'},
+        {'path': '/api/translations/en'},
+        {'path': '/api/bank/my-account'},
+        {'path': '/api/bank/users'},
+        {'method': 'POST', 'path': '/api/bank/transfer', 'body': {'to': 'bob', 'amount': 10}},
+        {'path': '/api/bank/users'},
+        {'path': '/api/bank/history?limit=1'},
+    ]})
+    statuses, bodies = zip(*((r['status'], r['body']) for r in response.json['responses']))
+    assert statuses == (200,) * 7
+    assert bodies[0]['user']['username'] == 'alice' and bodies[1]['balance'] == 'Balance'
+    assert bodies[2]['balance'] == 100 and bodies[4] == {'success': True, 'balance': 90}
+    assert [u['balance'] for u in bodies[5]] == [90, 10]
+    assert bodies[6][0]['amount'] == 10
+    reads = [path for method, path in github.calls if method == 'GET' and path == '/contents/data/bank_users.json']
+    assert len(reads) == 1
+
+def test_batch_shares_the_session(github):
+    client = _client(1, 'alice')
+    response = client.post('/api/batch', json={'requests': [
+        {'method': 'POST', 'path': '/api/auth/logout'},
+        {'path': '/api/bank/users'},
+    ]})
+    assert [r['status'] for r in response.json['responses']] == [200, 401]
+    assert client.get('/api/auth/check').json == {'authenticated': False}
+
+@pytest.mark.parametrize('body', [{}, {'requests': []}, {'requests': [{'path': '/api/batch'}]},
+                                  {'requests': [{'path': '/api/events'}]}, {'requests': [{'path': 'http://x/'}]}])
+def test_batch_rejects_invalid_calls(body):
+    assert _client(1, 'alice').post('/api/batch', json=body).status_code == 400
@@ -0,0 +1,767 @@
+#!/usr/bin/env python3
+"""
+Tests for the shop backend generated by shop.py
+Writes the generated modules into a temp dir and checks them there
+
+Run: python -m pytest test_shop_backend.py
+"""
+
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import shop
+
+# ==================== GENERATED BACKEND ====================
+
+MODULES = {
+    'app.py': shop.app_py,
+    'adapters/__init__.py': '\n',
+    'adapters/bank_adapter.py': shop.bank_adapter,
+    'repositories/__init__.py': '\n',
+    'repositories/repo_base.py': shop.repo_base,
+    'repositories/sqlite_repo.py': shop.repo_sqlite,
+    'repositories/users_repo.py': shop.users_repo,
+    'repositories/stores_repo.py': shop.stores_repo,
+    'repositories/products_repo.py': shop.products_repo,
+    'repositories/orders_repo.py': shop.orders_repo,
+    'repositories/transactions_repo.py': shop.transactions_repo,
+    'repositories/notifications_repo.py': shop.notifications_repo,
+    'utils/__init__.py': '\n',
+    'utils/common.py': shop.util_common,
+    'utils/catalog.py': shop.util_catalog,
+    'routes/__init__.py': '\n',
+    'routes/auth.py': shop.routes_auth,
+    'routes/catalog.py': shop.routes_catalog,
+    'routes/stores.py': shop.routes_stores,
+    'routes/mystore.py': shop.routes_mystore,
+    'routes/orders.py': shop.routes_orders,
+    'routes/admin.py': shop.routes_admin,
+    'routes/webhooks.py': shop.routes_webhooks,
+}
+
+@pytest.fixture(scope='session')
+def backend(tmp_path_factory):
+    """The generated backend, importable for the whole session"""
+    root = tmp_path_factory.mktemp('shop') / 'backend'
+    for rel, src in MODULES.items():
+        shop.w(root / rel, src)
+    sys.path.insert(0, str(root))
+    importlib.invalidate_caches()
+    yield root
+    sys.path.remove(str(root))
+
+BOT_TOKEN = '123:test-token'
+
+SEEDS = {
+    'users.json': shop.seed_users,
+    'stores.json': shop.seed_stores,
+    'products.json': shop.seed_products,
+    'orders.json': [],
+    'transactions.json': [],
+}
+
+@pytest.fixture(scope='session')
+def app(backend):
+    """The generated Flask app over backend/data, Telegram auth enabled"""
+    saved = dict(os.environ)
+    os.environ.update({'TELEGRAM_BOT_TOKEN': BOT_TOKEN, 'CATALOG_SYNC_SECONDS': '0', 'DB_DRIVER': 'json'})
+    os.makedirs(backend / 'data', exist_ok=True)
+    for name, items in SEEDS.items():
+        write_json(backend / 'data' / name, items)
+    try:
+        yield importlib.import_module('app').app
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+@pytest.fixture
+def client(app, backend):
+    """A test client over freshly seeded data"""
+    for name, items in SEEDS.items():
+        write_json(backend / 'data' / name, items)
+    return app.test_client()
+
+def repo_class(base, file_name, fields=()):
+    """A repository over file_name on the driver `base`"""
+    class Repo(base):
+        index_fields = fields
+
+        def __init__(self, data_dir):
+            super().__init__(data_dir, file_name)
+    return Repo
+
+@pytest.fixture(params=['json', 'sqlite'])
+def driver(backend, request):
+    if request.param == 'json':
+        return importlib.import_module('repositories.repo_base').JsonRepoBase
+    return importlib.import_module('repositories.sqlite_repo').SqliteRepoBase
+
+def write_json(path, items):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(items, f, ensure_ascii=False)
+
+# ==================== DRIVERS ====================
+
+def _crud(repo):
+    """Every read after a fixed series of writes"""
+    for i in range(6):
+        repo.create({'id': f'o{i}', 'buyer_id': f'u{i % 2}', 'total': i})
+    repo.create({'buyer_id': 'u9', 'total': 99})
+    repo.update('o1', {'id': 'o1', 'buyer_id': 'u0', 'total': 10})
+    repo.delete('o2')
+    with pytest.raises(ValueError):
+        repo.update('missing', {'id': 'missing'})
+    return {
+        'list': [o['total'] for o in repo.list()],
+        'get': repo.get('o3'),
+        'missing': repo.get('nope'),
+        'find_one': repo.find_one('buyer_id', 'u9')['total'],
+        'find_all': sorted(o['id'] for o in repo.find_all('buyer_id', 'u0')),
+        'by_total': [o['id'] for o in repo.find_all('total', 5)],
+    }
+
+def test_drivers_agree_on_crud(backend, tmp_path):
+    base = importlib.import_module('repositories.repo_base')
+    sqlite_repo = importlib.import_module('repositories.sqlite_repo')
+    results = []
+    for name, driver_base in [('json', base.JsonRepoBase), ('sqlite', sqlite_repo.SqliteRepoBase)]:
+        Orders = repo_class(driver_base, 'orders.json', ('buyer_id',))
+        results.append(_crud(Orders(str(tmp_path / name))))
+    assert results[0] == results[1]
+    assert results[0]['find_all'] == ['o0', 'o1', 'o4']
+
+def test_index_fields_match_by_string(driver, tmp_path):
+    write_json(tmp_path / 'users.json', [{'id': '1', 'telegram_id': 123456}, {'id': '2', 'telegram_id': '77'}])
+    users = repo_class(driver, 'users.json', ('telegram_id',))(str(tmp_path))
+    assert users.find_one('telegram_id', '123456')['id'] == '1'
+    assert users.find_one('telegram_id', 77)['id'] == '2'
+    assert users.find_one('telegram_id', '5') is None
+
+def _open_repo(root, data_dir, barrier, fields):
+    sys.path.insert(0, root)
+    sqlite_repo = importlib.import_module('repositories.sqlite_repo')
+    barrier.wait()
+    repo_class(sqlite_repo.SqliteRepoBase, 'orders.json', fields)(data_dir)
+
+@pytest.mark.parametrize('fields', [(), ('buyer_id', 'created_at')])
+def test_sqlite_schema_is_created_once_by_concurrent_workers(backend, tmp_path, fields):
+    write_json(tmp_path / 'orders.json', [{'id': f'o{i}', 'buyer_id': 'u1', 'created_at': str(i)} for i in range(200)])
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(4)
+    workers = [ctx.Process(target=_open_repo, args=(str(backend), str(tmp_path), barrier, fields)) for _ in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(30)
+    assert [p.exitcode for p in workers] == [0] * 4
+    sqlite_repo = importlib.import_module('repositories.sqlite_repo')
+    orders = repo_class(sqlite_repo.SqliteRepoBase, 'orders.json', fields)(str(tmp_path))
+    assert len(orders.list()) == 200
+
+# ==================== JSON CACHE ====================
+
+@pytest.fixture
+def json_orders(backend, tmp_path):
+    base = importlib.import_module('repositories.repo_base')
+    return repo_class(base.JsonRepoBase, 'orders.json', ('buyer_id',))(str(tmp_path))
+
+def test_json_reads_are_independent_copies(json_orders):
+    json_orders.create({'id': 'o1', 'buyer_id': 'u1', 'total': 1})
+    json_orders.get('o1')['total'] = 100
+    json_orders.list()[0]['total'] = 100
+    json_orders.find_all('buyer_id', 'u1')[0]['total'] = 100
+    assert json_orders.get('o1')['total'] == 1
+
+def test_json_index_follows_writes(json_orders):
+    json_orders.create({'id': 'o1', 'buyer_id': 'u1'})
+    assert json_orders.find_one('buyer_id', 'u1')['id'] == 'o1'
+    json_orders.update('o1', {'id': 'o1', 'buyer_id': 'u2'})
+    assert json_orders.find_one('buyer_id', 'u1') is None
+    assert json_orders.find_one('buyer_id', 'u2')['id'] == 'o1'
+
+def test_json_cache_sees_files_written_by_other_processes(json_orders):
+    json_orders.create({'id': 'o1', 'buyer_id': 'u1'})
+    assert json_orders.get('o1') is not None
+    write_json(json_orders.file_path, [{'id': 'o2', 'buyer_id': 'u3', 'note': 'written elsewhere'}])
+    assert json_orders.get('o1') is None
+    assert json_orders.find_one('buyer_id', 'u3')['id'] == 'o2'
+
+# ==================== LOCKING ====================
+
+def test_rwlock_readers_share_and_writer_waits(backend):
+    lock = importlib.import_module('repositories.repo_base')._RWLock()
+    events = []
+    reading = threading.Event()
+    release = threading.Event()
+
+    def reader():
+        with lock.read():
+            reading.set()
+            release.wait(5)
+            events.append('reader done')
+
+    def writer():
+        with lock.write():
+            events.append('writer')
+
+    r = threading.Thread(target=reader)
+    r.start()
+    reading.wait(5)
+    w = threading.Thread(target=writer)
+    w.start()
+    time.sleep(0.05)
+    assert events == []
+    release.set()
+    r.join(5)
+    w.join(5)
+    assert events == ['reader done', 'writer']
+
+def test_rwlock_waiting_writer_blocks_new_readers(backend):
+    lock = importlib.import_module('repositories.repo_base')._RWLock()
+    order = []
+
+    def writer():
+        with lock.write():
+            order.append('writer')
+
+    def reader():
+        with lock.read():
+            order.append('reader')
+
+    with lock.read():
+        w = threading.Thread(target=writer)
+        w.start()
+        time.sleep(0.05)
+        r = threading.Thread(target=reader)
+        r.start()
+        time.sleep(0.05)
+        assert order == []
+    w.join(5)
+    r.join(5)
+    assert order == ['writer', 'reader']
+
+def test_concurrent_creates_lose_nothing(json_orders):
+    def create(t):
+        for i in range(25):
+            json_orders.create({'id': f'{t}-{i}', 'buyer_id': t})
+    threads = [threading.Thread(target=create, args=(f't{t}',)) for t in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(json_orders.list()) == 100
+
+def _create_many(root, data_dir, driver_name, worker, barrier):
+    sys.path.insert(0, root)
+    if driver_name == 'json':
+        base = importlib.import_module('repositories.repo_base').JsonRepoBase
+    else:
+        base = importlib.import_module('repositories.sqlite_repo').SqliteRepoBase
+    orders = repo_class(base, 'orders.json', ('buyer_id',))(data_dir)
+    barrier.wait()
+    for i in range(25):
+        orders.create({'id': f'{worker}-{i}', 'buyer_id': worker})
+
+@pytest.mark.parametrize('driver_name', ['json', 'sqlite'])
+def test_creates_from_several_processes_lose_nothing(backend, tmp_path, driver_name):
+    write_json(tmp_path / 'orders.json', [])
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(4)
+    workers = [ctx.Process(target=_create_many, args=(str(backend), str(tmp_path), driver_name, f'w{w}', barrier))
+               for w in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(60)
+    assert [p.exitcode for p in workers] == [0] * 4
+    if driver_name == 'json':
+        with open(tmp_path / 'orders.json', encoding='utf-8') as f:
+            assert len(json.load(f)) == 100
+    else:
+        sqlite_repo = importlib.import_module('repositories.sqlite_repo')
+        orders = repo_class(sqlite_repo.SqliteRepoBase, 'orders.json', ('buyer_id',))(str(tmp_path))
+        assert len(orders.list()) == 100
+
+# ==================== TELEGRAM AUTH ====================
+
+def sign_init_data(fields, token=BOT_TOKEN):
+    """initData as Telegram would send it for fields"""
+    common = importlib.import_module('utils.common')
+    check = '\n'.join(f'{k}={fields[k]}' for k in sorted(fields))
+    digest = common.hmac.new(common.telegram_secret(token), check.encode(), 'sha256').hexdigest()
+    return common.urllib.parse.urlencode({**fields, 'hash': digest})
+
+def test_init_data_checks_hash_and_age(backend):
+    common = importlib.import_module('utils.common')
+    secret = common.telegram_secret(BOT_TOKEN)
+    fresh = sign_init_data({'auth_date': str(int(time.time())), 'user': '{"id": 5}'})
+    stale = sign_init_data({'auth_date': str(int(time.time()) - 7200), 'user': '{"id": 5}'})
+    assert common.parse_telegram_init_data(fresh, secret, 3600)['user'] == '{"id": 5}'
+    assert common.parse_telegram_init_data(stale, secret, 3600) is None
+    assert common.parse_telegram_init_data(stale, secret) is not None
+    assert common.parse_telegram_init_data(fresh.replace('5', '6'), secret) is None
+    assert common.parse_telegram_init_data(fresh, common.telegram_secret('other')) is None
+
+def test_init_data_cache_expires_with_the_init_data(backend, monkeypatch):
+    common = importlib.import_module('utils.common')
+    cache = common.InitDataCache(size=10, ttl=300)
+    now = time.time()
+    cache.put('a', 'u1', int(now), 3600)
+    cache.put('b', 'u2', int(now) - 3590, 3600)
+    cache.put('c', 'u3', int(now) - 7200, 3600)
+    assert cache.get('a') == 'u1'
+    assert cache.get('b') == 'u2'
+    assert cache.get('c') is None
+    clock = time.monotonic() + 60
+    monkeypatch.setattr(common.time, 'monotonic', lambda: clock)
+    assert cache.get('a') == 'u1'
+    assert cache.get('b') is None
+
+def test_init_data_cache_is_lru_bounded(backend):
+    cache = importlib.import_module('utils.common').InitDataCache(size=2, ttl=300)
+    cache.put('a', 'u1')
+    cache.put('b', 'u2')
+    assert cache.get('a') == 'u1'
+    cache.put('c', 'u3')
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == ('u1', None, 'u3')
+
+def test_me_rejects_expired_init_data(client):
+    user = '{"id": 424242, "first_name": "Tg"}'
+    fresh = sign_init_data({'auth_date': str(int(time.time())), 'user': user})
+    stale = sign_init_data({'auth_date': str(int(time.time()) - 2 * 86400), 'user': user})
+    assert client.get('/api/auth/me', headers={'X-Telegram-Init-Data': stale}).status_code == 401
+    me = client.get('/api/auth/me', headers={'X-Telegram-Init-Data': fresh})
+    assert me.status_code == 200 and me.get_json()['telegram_id'] == '424242'
+    again = client.get('/api/auth/me', headers={'X-Telegram-Init-Data': fresh})
+    assert again.get_json()['id'] == me.get_json()['id']
+
+# ==================== CATALOG SEARCH ====================
+
+def test_text_index_stems_prefixes_and_forgives_typos(backend):
+    catalog = importlib.import_module('utils.catalog')
+    index = catalog.TextIndex.build([
+        ('1', 'Смартфон', 'Современный смартфон с камерой'),
+        ('2', 'Чехол для смартфонов', 'Кожаный'),
+        ('3', 'Ноутбук', 'Мощный ноутбук для работы'),
+    ])
+    assert set(index.search('смартфоны')) == {'1', '2'}
+    assert index.search('смартфон')['1'] > index.search('смартфон')['2']  # title and description beat one title hit
+    assert set(index.search('ноут')) == {'3'}  # prefix
+    assert set(index.search('ноутбк')) == {'3'}  # typo
+    assert index.search('ноутбк', fuzzy=False) == {}
+    assert set(index.search('смартфон кожаный')) == {'2'}  # every word must match
+    assert index.search('!!') is None
+
+def test_text_index_updates_in_place(backend):
+    catalog = importlib.import_module('utils.catalog')
+    index = catalog.TextIndex()
+    index.add('1', 'Красный чайник', '')
+    index.add('2', 'Синий чайник', '')
+    index.add('1', 'Красная кружка', '')
+    assert set(index.search('чайник')) == {'2'}
+    assert set(index.search('кружк')) == {'1'}
+    index.remove('2')
+    assert index.search('чайник') == {} and len(index) == 1
+    assert index._vocab == sorted(index._postings)
+
+def _catalog_repos(base, data_dir):
+    products = repo_class(base, 'products.json', ('store_id',))(data_dir)
+    stores = repo_class(base, 'stores.json', ('created_at',))(data_dir)
+    return products, stores
+
+def _product(pid, title, **fields):
+    return dict({'id': pid, 'store_id': 's1', 'title': title, 'price': 10, 'active': True}, **fields)
+
+def test_catalog_index_follows_own_writes_without_rebuilding(driver, tmp_path):
+    catalog = importlib.import_module('utils.catalog')
+    products, stores = _catalog_repos(driver, str(tmp_path))
+    stores.create({'id': 's1', 'name': 'S'})
+    products.create(_product('p1', 'Красный чайник'))
+    index = catalog.CatalogIndex(products, stores, sync_interval=0)
+    assert index.query('чайник')[1] == 1
+    rebuilds = []
+    index._rebuild = lambda real=index._rebuild: rebuilds.append(1) or real()
+    index.put_product(products.create(_product('p2', 'Синий чайник')))
+    index.put_product(products.update('p1', _product('p1', 'Красная кружка')))
+    products.delete('p2')
+    index.remove_product('p2')
+    assert [p['id'] for p in index.query('чайник')[0]] == []
+    assert [p['id'] for p in index.query('кружка')[0]] == ['p1']
+    assert rebuilds == []
+
+def _write_elsewhere(root, data_dir, driver_name):
+    sys.path.insert(0, root)
+    if driver_name == 'json':
+        base = importlib.import_module('repositories.repo_base').JsonRepoBase
+    else:
+        sqlite_repo = importlib.import_module('repositories.sqlite_repo')
+        sqlite_repo._local.conns = {}  # not the parent's connection
+        base = sqlite_repo.SqliteRepoBase
+    products, _ = _catalog_repos(base, data_dir)
+    products.create(_product('theirs', 'Чайник из другого процесса'))
+
+@pytest.mark.parametrize('driver_name', ['json', 'sqlite'])
+def test_catalog_index_sees_other_process_write_before_its_own(backend, tmp_path, driver_name):
+    if driver_name == 'json':
+        base = importlib.import_module('repositories.repo_base').JsonRepoBase
+    else:
+        base = importlib.import_module('repositories.sqlite_repo').SqliteRepoBase
+    catalog = importlib.import_module('utils.catalog')
+    products, stores = _catalog_repos(base, str(tmp_path))
+    stores.create({'id': 's1', 'name': 'S'})
+    products.create(_product('first', 'Чайник'))
+    index = catalog.CatalogIndex(products, stores, sync_interval=3600)
+    assert index.query('чайник')[1] == 1
+    worker = multiprocessing.get_context('fork').Process(
+        target=_write_elsewhere, args=(str(backend), str(tmp_path), driver_name))
+    worker.start()
+    worker.join(30)
+    assert worker.exitcode == 0
+    index.put_product(products.create(_product('mine', 'Мой чайник')))
+    assert {p['id'] for p in index.query('чайник')[0]} == {'first', 'theirs', 'mine'}
+
+# ==================== CATALOG SORTING ====================
+
+def test_sorted_index_ranges_and_updates(backend):
+    catalog = importlib.import_module('utils.catalog')
+    index = catalog.SortedIndex(lambda p: p['price'])
+    index.build([(0, {'id': 'a', 'price': 30}), (1, {'id': 'b', 'price': 10}), (2, {'id': 'c', 'price': 30})])
+    assert index.ids(0, len(index)) == ['b', 'a', 'c']  # ties keep catalog order
+    assert index.bounds(10, 29) == (0, 1) and index.bounds(30, 30) == (1, 3)
+    index.add(3, {'id': 'd', 'price': 20})
+    index.remove('a')
+    assert index.ids(0, len(index)) == ['b', 'd', 'c']
+    assert list(index.iter_ids(descending=True)) == ['c', 'd', 'b']
+    assert list(index.iter_ids(after=index.entry('d')[:2])) == ['c']
+    assert list(index.iter_ids(descending=True, after=index.entry('d')[:2])) == ['b']
+
+@pytest.fixture
+def sortable_catalog(driver, tmp_path):
+    catalog = importlib.import_module('utils.catalog')
+    products, stores = _catalog_repos(driver, str(tmp_path))
+    stores.create({'id': 's1', 'name': 'Open'})
+    stores.create({'id': 's2', 'name': 'Blocked', 'is_blocked': True})
+    for i in range(30):
+        products.create(_product(f'p{i:02d}', f'Товар {i}', price=(i * 7) % 50 + 1, category='a' if i % 3 else 'b',
+                                 created_at=f'2024-01-{i % 28 + 1:02d}', sold_count=i % 5))
+    products.create(_product('hidden', 'Скрыт', store_id='s2', price=1))
+    products.create(_product('off', 'Выключен', price=1, active=False))
+    return catalog.CatalogIndex(products, stores, sync_interval=0), products.list()
+
+@pytest.mark.parametrize('sort, key, reverse', [
+    ('price_asc', lambda p: p['price'], False),
+    ('price_desc', lambda p: -p['price'], False),
+    ('newest', lambda p: p['created_at'], True),
+    ('popular', lambda p: p['sold_count'], True),
+])
+def test_catalog_sorts_match_a_full_sort(sortable_catalog, sort, key, reverse):
+    index, items = sortable_catalog
+    visible = [p for p in items if p['id'] not in ('hidden', 'off')]
+    # keys only: how ties are broken is the index's business
+    expected = sorted(visible, key=key, reverse=reverse)
+    ids = [p['id'] for p in index.query(sort=sort, limit=100)[0]]
+    assert sorted(ids) == sorted(p['id'] for p in expected)
+    assert [key(index._items[pid]) for pid in ids] == [key(p) for p in expected]
+    deep, total, _, _ = index.query(sort=sort, offset=25, limit=10)
+    assert [p['id'] for p in deep] == ids[25:] and total == 30
+
+def test_catalog_price_range_intersects_filters(sortable_catalog):
+    index, items = sortable_catalog
+    page, total, _, _ = index.query(category='b', min_price=10, max_price=30, sort='price_asc', limit=100)
+    expected = sorted((p for p in items if p['id'] not in ('hidden', 'off') and p['category'] == 'b'
+                       and 10 <= p['price'] <= 30), key=lambda p: p['price'])
+    assert [p['price'] for p in page] == [p['price'] for p in expected] and total == len(expected)
+    assert index.query(min_price=1, max_price=1, limit=100)[1] == sum(
+        1 for p in items if p['price'] == 1 and p['id'] not in ('hidden', 'off'))
+
+def test_catalog_sort_parameter_is_validated(client):
+    assert client.get('/api/catalog', query_string={'sort': 'cheapest'}).status_code == 400
+    prices = [p['price'] for p in client.get('/api/catalog', query_string={'sort': 'price_desc'}).json['items']]
+    assert prices == sorted(prices, reverse=True)
+
+# ==================== CATALOG FACETS ====================
+
+def _expected_facets(catalog, items, scores, category, store_id, low, high):
+    """Facets counted the slow way: each facet ignores its own filter"""
+    from collections import Counter
+    base = [p for p in items if scores is None or p['id'] in scores]
+    in_range = lambda p: low <= p['price'] <= high
+    in_category = lambda p: not category or p.get('category') == category
+    in_store = lambda p: not store_id or p.get('store_id') == store_id
+    prices = Counter(catalog.price_bucket(p['price']) for p in base if in_category(p) and in_store(p))
+    return {
+        'categories': dict(Counter(p.get('category') for p in base if in_range(p) and in_store(p))),
+        'stores': dict(Counter(p.get('store_id') for p in base if in_range(p) and in_category(p))),
+        'prices': [prices[i] for i in range(len(catalog.PRICE_BUCKETS) + 1)],
+    }
+
+@pytest.fixture
+def faceted_catalog(backend, tmp_path):
+    catalog = importlib.import_module('utils.catalog')
+    base = importlib.import_module('repositories.repo_base').JsonRepoBase
+    products, stores = _catalog_repos(base, str(tmp_path))
+    for sid in ('s1', 's2'):
+        stores.create({'id': sid, 'name': sid})
+    rng = __import__('random').Random(7)
+    words = ('чайник', 'кружка', 'лампа')
+    write_json(products.file_path, [
+        _product(f'p{i}', f'{words[i % 3]} {i}', store_id=f's{1 + i % 2}', category='abc'[i % 3],
+                 price=rng.choice([rng.randint(1, 8000), 100, 500, 1000, 5000]))
+        for i in range(400)])
+    return catalog, catalog.CatalogIndex(products, stores, sync_interval=0), products.list()
+
+@pytest.mark.parametrize('search', ['', 'чайник'])
+@pytest.mark.parametrize('category, store_id', [(None, None), ('a', None), (None, 's2'), ('b', 's1')])
+@pytest.mark.parametrize('low, high', [(0, 10 ** 12), (100, 1000), (250, 4000), (1000, 1000), (6000, 10 ** 12)])
+def test_facets_match_a_full_count(faceted_catalog, search, category, store_id, low, high):
+    catalog, index, items = faceted_catalog
+    facets = index.query(search, store_id, category, low, high, facets=True)[2]
+    scores = index._text.search(search) if search else None
+    got = dict(facets, prices=[b['count'] for b in facets['prices']])
+    assert got == _expected_facets(catalog, items, scores, category, store_id, low, high)
+
+def test_price_range_facets_scan_only_cut_buckets(faceted_catalog):
+    _, index, _ = faceted_catalog
+    scanned = []
+    tally = index._tally
+    index._tally = lambda counts, ids, *args: scanned.extend(ids) or tally(counts, ids, *args)
+    # bucket-aligned up to 5000: only the last bucket is cut, the rest come from the counters
+    index.query(min_price=100, max_price=5000, facets=True)
+    assert 0 < len(scanned) < len(index._items) // 4
+    assert all(index._items[pid]['price'] >= 5000 for pid in scanned)
+
+def test_facet_cache_follows_products_outside_the_price_range(faceted_catalog):
+    catalog, index, items = faceted_catalog
+    q = catalog.CatalogQuery(min_price=100, max_price=1000, facets=True)
+    render = lambda page, total, facets, cursor: json.dumps(facets).encode()
+    before = json.loads(index.response(q, render)[0])
+    cheap = index.products.create(_product('cheap', 'дешёвый', price=1, category='a'))
+    index.put_product(cheap)
+    after = json.loads(index.response(q, render)[0])
+    assert after['prices'][0]['count'] == before['prices'][0]['count'] + 1
+    assert after['categories'] == before['categories']
+
+# ==================== CATALOG RESPONSE CACHE ====================
+
+def _counting_render(renders):
+    def render(page, total, facets, cursor):
+        renders.append(1)
+        return json.dumps({'ids': [p['id'] for p in page], 'total': total}).encode()
+    return render
+
+def test_catalog_response_is_rendered_once_per_normalized_query(faceted_catalog):
+    catalog, index, _ = faceted_catalog
+    renders = []
+    render = _counting_render(renders)
+    first = index.response(catalog.CatalogQuery(search='Чайник  кружка', store_id=''), render)
+    assert index.response(catalog.CatalogQuery(search='кружка чайник'), render) == first
+    assert len(renders) == 1
+    index.response(catalog.CatalogQuery(search='кружка'), render)
+    assert len(renders) == 2
+
+def test_catalog_write_drops_only_the_responses_it_touches(faceted_catalog):
+    catalog, index, _ = faceted_catalog
+    renders = []
+    render = _counting_render(renders)
+    queries = {sid: catalog.CatalogQuery(store_id=sid) for sid in ('s1', 's2')}
+    bodies = {sid: index.response(q, render)[0] for sid, q in queries.items()}
+    p = index.products.get('p0')  # in s1, on the first page
+    p['price'] = 42
+    index.put_product(index.products.update('p0', p))
+    assert index.response(queries['s2'], render)[0] == bodies['s2']
+    assert len(renders) == 2
+    index.response(queries['s1'], render)
+    assert len(renders) == 3
+
+def test_catalog_serves_strong_etag_and_304(client):
+    first = client.get('/api/catalog', query_string={'store_id': 'store-2'})
+    assert first.status_code == 200 and not first.headers['ETag'].startswith('W/')
+    again = client.get('/api/catalog', query_string={'store_id': 'store-2'},
+                       headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304 and again.data == b''
+
+def test_catalog_cache_follows_mystore_and_admin_writes(client):
+    etags = {sid: client.get('/api/catalog', query_string={'store_id': sid}).headers['ETag']
+             for sid in ('store-1', 'store-2')}
+    owner = {'Authorization': 'Bearer 3'}
+    assert client.patch('/api/mystore/products/store-1-p1', json={'price': 77}, headers=owner).status_code == 200
+    store_1 = client.get('/api/catalog', query_string={'store_id': 'store-1'},
+                         headers={'If-None-Match': etags['store-1']})
+    assert store_1.status_code == 200
+    assert next(p for p in store_1.json['items'] if p['id'] == 'store-1-p1')['price'] == 77
+    assert client.get('/api/catalog', query_string={'store_id': 'store-2'},
+                      headers={'If-None-Match': etags['store-2']}).status_code == 304
+    blocked = client.patch('/api/admin/stores/store-2/block', json={'is_blocked': True},
+                           headers={'Authorization': 'Bearer 1'})
+    assert blocked.status_code == 200
+    assert client.get('/api/catalog', query_string={'store_id': 'store-2'}).json['items'] == []
+
+# ==================== CURSOR PAGING ====================
+
+def _walk(repo, field=None, value=None, limit=3):
+    ids, after = [], None
+    while True:
+        page = repo.page(field, value, after, limit)
+        ids += [it['id'] for it in page]
+        if len(page) < limit:
+            return ids
+        after = repo.cursor(page[-1])
+
+def _newest_first(items, keep=lambda it: True):
+    return [it['id'] for it in sorted(items, key=lambda it: (it['created_at'], it['id']), reverse=True) if keep(it)]
+
+@pytest.fixture
+def pageable(driver, tmp_path):
+    Stores = repo_class(driver, 'stores.json', ('owner_id', 'created_at'))
+    Stores.page_defaults = {'is_blocked': False}
+    stores = Stores(str(tmp_path))
+    for i in range(10):
+        item = {'id': f's{i}', 'owner_id': i % 3, 'created_at': f'2024-01-{i % 4 + 1:02d}'}
+        if i % 4:
+            item['is_blocked'] = i % 4 == 1
+        stores.create(item)
+    return stores
+
+def test_page_walks_newest_first_across_writes(pageable):
+    stores = pageable
+    assert _walk(stores) == _newest_first(stores.list())
+    assert _walk(stores, 'owner_id', '1') == _walk(stores, 'owner_id', 1) == _newest_first(
+        stores.list(), lambda it: it['owner_id'] == 1)
+    assert _walk(stores, 'is_blocked', False) == _newest_first(stores.list(), lambda it: not it.get('is_blocked'))
+    stores.update('s1', dict(stores.get('s1'), is_blocked=False, created_at='2024-02-01'))
+    stores.create({'id': 's10', 'owner_id': 1, 'created_at': '2023-12-31'})
+    stores.delete('s4')
+    items = stores.list()
+    assert _walk(stores, 'is_blocked', False) == _newest_first(items, lambda it: not it.get('is_blocked'))
+    assert _walk(stores, 'owner_id', 1) == _newest_first(items, lambda it: it['owner_id'] == 1)
+    assert _walk(stores, limit=4) == _newest_first(items)
+
+def test_json_page_order_is_patched_not_rebuilt(backend, tmp_path):
+    base = importlib.import_module('repositories.repo_base')
+    stores = repo_class(base.JsonRepoBase, 'stores.json')(str(tmp_path))
+    for i in range(5):
+        stores.create({'id': f's{i}', 'created_at': f'2024-01-0{i + 1}'})
+    stores.page()
+    stores.create({'id': 's5', 'created_at': '2024-01-03'})
+    assert stores._snapshot().orders  # carried over from the snapshot before the write
+    assert [it['id'] for it in stores.page(limit=10)] == ['s4', 's3', 's5', 's2', 's1', 's0']
+
+def test_store_lists_page_by_cursor_when_asked(client, backend):
+    stores = json.load(open(backend / 'data' / 'stores.json', encoding='utf-8'))
+    del stores[0]['is_blocked']
+    write_json(backend / 'data' / 'stores.json', stores)
+    old = client.get('/api/stores').json
+    assert old['total'] == 3 and old['page'] == 1 and 'next_cursor' not in old
+    first = client.get('/api/stores', query_string={'limit': 2}).json
+    second = client.get('/api/stores', query_string={'limit': 2, 'cursor': first['next_cursor']}).json
+    assert len(first['items']) == 2 and second['next_cursor'] is None
+    assert sorted(s['id'] for s in first['items'] + second['items']) == ['store-1', 'store-2', 'store-3']
+    assert client.get('/api/stores', query_string={'cursor': 'nope'}).status_code == 400
+    admin = {'Authorization': 'Bearer 1'}
+    assert len(client.get('/api/admin/stores', query_string={'status': 'active', 'limit': 5},
+                          headers=admin).json['items']) == 3
+
+def test_order_lists_are_paged_by_default(client):
+    orders = importlib.import_module('routes.orders').orders
+    for i in range(25):
+        orders.create({'id': f'o{i:02d}', 'buyer_id': '2', 'store_id': 'store-1', 'created_at': f'2024-01-01T00:00:{i:02d}'})
+    buyer = {'Authorization': 'Bearer 2'}
+    first = client.get('/api/orders/my', headers=buyer).json
+    assert len(first['items']) == 20 and first['items'][0]['id'] == 'o24' and first['next_cursor']
+    rest = client.get('/api/orders/my', query_string={'cursor': first['next_cursor']}, headers=buyer).json
+    assert [o['id'] for o in rest['items']] == ['o04', 'o03', 'o02', 'o01', 'o00'] and rest['next_cursor'] is None
+    assert len(client.get('/api/mystore/orders', headers={'Authorization': 'Bearer 3'}).json['items']) == 20
+    assert len(client.get('/api/admin/stores', headers={'Authorization': 'Bearer 1'}).json['items']) == 3
+
+@pytest.mark.parametrize('fields', [('buyer_id',), ('buyer_id', 'created_at')])
+def test_records_without_page_order_page_alike_on_both_drivers(backend, tmp_path, fields):
+    base = importlib.import_module('repositories.repo_base')
+    sqlite_repo = importlib.import_module('repositories.sqlite_repo')
+    items = [{'id': f'o{i}', 'buyer_id': 'b', **({'created_at': f'2024-01-0{i}'} if i % 2 else {})} for i in range(1, 8)]
+    walks = []
+    for name, driver_base in [('json', base.JsonRepoBase), ('sqlite', sqlite_repo.SqliteRepoBase)]:
+        orders = repo_class(driver_base, 'orders.json', fields)(str(tmp_path / name))
+        for item in items:
+            orders.create(dict(item))
+        walks.append((_walk(orders, limit=2), _walk(orders, 'buyer_id', 'b', limit=2)))
+    assert walks[0] == walks[1] == (['o7', 'o5', 'o3', 'o1', 'o6', 'o4', 'o2'],) * 2
+
+# ==================== BATCHED WRITES ====================
+
+def test_get_many_and_update_many(driver, tmp_path):
+    products = repo_class(driver, 'products.json', ('store_id',))(str(tmp_path))
+    for i in range(3):
+        products.create({'id': f'p{i}', 'store_id': 's1', 'stock': i})
+    assert sorted(products.get_many(['p0', 'p2', 'nope'])) == ['p0', 'p2']
+    products.update_many([{'id': 'p0', 'store_id': 's2', 'stock': 9}, {'id': 'p2', 'store_id': 's1', 'stock': 7}])
+    assert [(p['id'], p['stock']) for p in products.find_all('store_id', 's1')] == [('p1', 1), ('p2', 7)]
+    with pytest.raises(ValueError):
+        products.update_many([{'id': 'p1', 'stock': 0}, {'id': 'nope'}])
+    assert products.get('p1')['stock'] == 1
+
+def test_take_stock_is_all_or_nothing(driver, tmp_path):
+    Products = repo_class(driver, 'products.json', ('store_id',))
+    Products.take_stock = importlib.import_module('repositories.products_repo').ProductsRepo.take_stock
+    products = Products(str(tmp_path))
+    products.create({'id': 'p1', 'stock': 3})
+    products.create({'id': 'p2', 'stock': 1})
+    with pytest.raises(ValueError):
+        products.take_stock({'p1': 2, 'p2': 2})
+    assert [products.get(pid)['stock'] for pid in ('p1', 'p2')] == [3, 1]
+    taken = products.take_stock({'p1': 3, 'p2': 1})
+    assert sorted((p['id'], p['stock'], p['sold_count']) for p in taken) == [('p1', 0, 3), ('p2', 0, 1)]
+    assert products.get('p1')['stock'] == 0
+
+def test_concurrent_checkouts_never_oversell(client, app, monkeypatch):
+    products = importlib.import_module('routes.orders').products
+    # widen any gap between reading stock and writing it back
+    monkeypatch.setattr(products, 'get_many', lambda ids, real=products.get_many: (real(ids), time.sleep(0.05))[0])
+    barrier = threading.Barrier(12)
+    statuses = []
+
+    def buy(i):
+        c = app.test_client()
+        barrier.wait()
+        r = c.post('/api/orders/checkout', headers={'Authorization': 'Bearer 2'},
+                   json={'items': [{'product_id': 'store-1-p1', 'qty': 1}], 'idempotency_key': f'race-{i}'})
+        statuses.append(r.status_code)
+    threads = [threading.Thread(target=buy, args=(i,)) for i in range(12)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    product = client.get('/api/catalog', query_string={'store_id': 'store-1', 'limit': 100}).json['items']
+    product = next(p for p in product if p['id'] == 'store-1-p1')
+    assert statuses.count(201) == 6 and product['stock'] == 0 and product['sold_count'] == 6
+    assert all(code in (201, 400, 409) for code in statuses)
+
+def test_checkout_that_loses_the_stock_race_charges_nothing(client, monkeypatch):
+    routes = importlib.import_module('routes.orders')
+    take_stock = routes.products.take_stock
+
+    def rival_first(quantities):
+        take_stock({'store-1-p1': 6})  # another buyer takes the rest meanwhile
+        return take_stock(quantities)
+    monkeypatch.setattr(routes.products, 'take_stock', rival_first)
+    r = client.post('/api/orders/checkout', headers={'Authorization': 'Bearer 2'},
+                    json={'items': [{'product_id': 'store-1-p1', 'qty': 1}]})
+    assert r.status_code == 409 and r.json['error'] == 'race_stock'
+    assert routes.bank.get_balance('2') == 5000 and routes.orders.find_by_buyer('2') == []
+
+def test_failed_payment_gives_the_stock_back(client):
+    routes = importlib.import_module('routes.orders')
+    buyer = routes.bank.users.get('2')
+    routes.bank.users.update('2', dict(buyer, balance=10))
+    r = client.post('/api/orders/checkout', headers={'Authorization': 'Bearer 2'},
+                    json={'items': [{'product_id': 'store-1-p1', 'qty': 2}]})
+    assert r.status_code == 400 and r.json['error'] == 'payment_failed'
+    product = routes.products.get('store-1-p1')
+    assert product['stock'] == 6 and product.get('sold_count', 0) == 0
+    assert routes.catalog_index._items['store-1-p1']['stock'] == 6
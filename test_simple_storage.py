@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Tests for the local storage layer of server_simple.py
+Each test gets its own data directory
+
+Run: python -m pytest test_simple_storage.py
+"""
+
+import json
+import os
+
+import pytest
+
+@pytest.fixture(scope='session')
+def server_simple(tmp_path_factory):
+    # Importing creates server_data/ in the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('import'))
+    try:
+        import server_simple
+    finally:
+        os.chdir(cwd)
+    return server_simple
+
+@pytest.fixture
+def simple(server_simple, tmp_path, monkeypatch):
+    monkeypatch.setattr(server_simple, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(server_simple, 'history', server_simple.HistoryLog(str(tmp_path / 'bank_history'), 3))
+    return server_simple
+
+def _client(simple, user_id=None, username=None):
+    client = simple.app.test_client()
+    if user_id is not None:
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['username'] = username
+    return client
+
+def _entry(i, sender='alice', recipient='bob'):
+    return {'time': f'2024-01-{i + 1:02d}T10:00:00', 'from': sender, 'to': recipient, 'amount': i}
+
+# ==================== HISTORY LOG ====================
+
+def test_history_rotates_segments_and_reads_newest_first(simple, tmp_path):
+    log = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3)
+    for i in range(7):
+        log.append(_entry(i))
+    assert sorted(os.listdir(tmp_path / 'log')) == ['000001.jsonl', '000002.jsonl', '000003.jsonl']
+    assert [e['amount'] for e in log.latest(4)] == [6, 5, 4, 3]
+    assert [e['amount'] for e in log.latest(2, match=lambda e: e['amount'] % 2)] == [5, 3]
+
+def test_history_reopens_where_it_left_off(simple, tmp_path):
+    log = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3)
+    for i in range(4):
+        log.append(_entry(i))
+    reopened = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3)
+    reopened.append(_entry(4))
+    assert [e['amount'] for e in reopened.latest(10)] == [4, 3, 2, 1, 0]
+    assert len(os.listdir(tmp_path / 'log')) == 2
+
+def test_history_drops_a_torn_last_entry(simple, tmp_path):
+    log = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3)
+    for i in range(4):
+        log.append(_entry(i))
+    with open(tmp_path / 'log' / '000002.jsonl', 'ab') as f:
+        f.write(b'{"time": "2024-01-05T10:00:00", "fr')  # crash mid-append
+    reopened = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3)
+    assert [e['amount'] for e in reopened.latest(10)] == [3, 2, 1, 0]
+    reopened.append(_entry(4))
+    again = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3)
+    assert [e['amount'] for e in again.latest(10)] == [4, 3, 2, 1, 0]
+    assert [e['amount'] for _, e in again.page('alice')] == [4, 3, 2, 1, 0]
+
+def _write_legacy(path, n):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([_entry(i) for i in reversed(range(n))], f)  # newest first
+
+def test_history_imports_legacy_file(simple, tmp_path):
+    legacy = tmp_path / 'bank_history.json'
+    _write_legacy(legacy, 8)
+    log = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3, legacy=str(legacy))
+    assert [e['amount'] for e in log.latest(10)] == list(reversed(range(8)))
+    assert len(os.listdir(tmp_path / 'log')) == 3
+    assert not legacy.exists() and (tmp_path / 'bank_history.json.imported').exists()
+    log.append(_entry(8))
+    assert log.latest(1)[0]['amount'] == 8
+
+def test_history_import_interrupted_by_crash_is_redone(simple, tmp_path, monkeypatch):
+    legacy = tmp_path / 'bank_history.json'
+    _write_legacy(legacy, 8)
+    real_dumps = json.dumps
+    written = []
+
+    def crash_after_four(obj, **kwargs):
+        written.append(obj)
+        if len(written) > 4:
+            raise OSError('power cut')
+        return real_dumps(obj, **kwargs)
+    monkeypatch.setattr(simple.json, 'dumps', crash_after_four)
+    with pytest.raises(OSError):
+        simple.HistoryLog(str(tmp_path / 'log'), segment_size=3, legacy=str(legacy))
+    monkeypatch.setattr(simple.json, 'dumps', real_dumps)
+    log = simple.HistoryLog(str(tmp_path / 'log'), segment_size=3, legacy=str(legacy))
+    assert [e['amount'] for e in log.latest(10)] == list(reversed(range(8)))
+    assert not (tmp_path / 'log.import').exists()
+
+# ==================== HISTORY INDEX ====================
+
+def _history(client, **params):
+    return client.get('/api/bank/history', query_string=params).json
+
+def test_history_page_uses_the_per_user_index(simple):
+    for i in range(6):
+        simple.history.append(_entry(i, 'alice', 'bob' if i % 2 else 'carol'))
+    assert [e['amount'] for _, e in simple.history.page('bob')] == [5, 3, 1]
+    assert [e['amount'] for _, e in simple.history.page('alice', limit=2)] == [5, 4]
+    reopened = simple.HistoryLog(simple.history.directory, 3)
+    assert [e['amount'] for _, e in reopened.page('carol')] == [4, 2, 0]
+
+def test_history_pages_with_cursor(simple):
+    for i in range(7):
+        simple.history.append(_entry(i))
+    client = _client(simple, 1, 'bob')
+    first = _history(client, limit=3)
+    assert [e['amount'] for e in first] == [6, 5, 4]
+    second = _history(client, limit=3, before=first[-1]['cursor'])
+    assert [e['amount'] for e in second] == [3, 2, 1]
+    assert [e['amount'] for e in _history(client, limit=3, before=second[-1]['cursor'])] == [0]
+
+def test_history_filters_by_date_and_direction(simple):
+    for i in range(6):
+        simple.history.append(_entry(i, *(('alice', 'bob') if i % 2 else ('bob', 'alice'))))
+    client = _client(simple, 1, 'bob')
+    assert [e['amount'] for e in _history(client, direction='in')] == [5, 3, 1]
+    assert [e['amount'] for e in _history(client, direction='out')] == [4, 2, 0]
+    assert [e['amount'] for e in _history(client, from_date='2024-01-02', to_date='2024-01-04')] == [3, 2, 1]
+
+def test_history_rejects_bad_parameters(simple):
+    client = _client(simple, 1, 'bob')
+    for params in ({'limit': 0}, {'before': 'x'}, {'direction': 'sideways'}):
+        assert client.get('/api/bank/history', query_string=params).status_code == 400
+
+# ==================== CHANGE FEED ====================
+
+@pytest.fixture
+def feed(simple, monkeypatch):
+    feed = simple.ChangeFeed(simple.feed_records, size=50)
+    monkeypatch.setattr(simple, 'change_feed', feed)
+    return feed
+
+def _changes(client, cursor, **params):
+    return client.get('/api/changes', query_string=dict(params, since=cursor)).json
+
+def test_changes_return_only_changed_records(simple, feed):
+    simple.save_data('shop_products.json', [{'id': 1, 'title': 'A'}, {'id': 2, 'title': 'B'}, {'id': 3, 'title': 'C'}])
+    client = _client(simple, 1, 'alice')
+    assert client.get('/api/changes').json['reset']
+    cursor = client.get('/api/changes').json['cursor']
+    simple.save_data('shop_products.json', [{'id': 1, 'title': 'A'}, {'id': 2, 'title': 'B2'}])
+    response = _changes(client, cursor, collections='shop_products')
+    assert [(c['id'], c['op']) for c in response['changes']] == [(2, 'put'), (3, 'delete')]
+    assert response['changes'][0]['data'] == {'id': 2, 'title': 'B2'}
+    assert _changes(client, response['cursor']) == {'changes': [], 'cursor': response['cursor'], 'more': False}
+
+def test_changes_see_files_edited_on_disk(simple, feed, tmp_path):
+    simple.save_data('shop_products.json', [])
+    client = _client(simple, 1, 'alice')
+    cursor = client.get('/api/changes').json['cursor']
+    path = tmp_path / 'shop_products.json'
+    mtime = path.stat().st_mtime_ns
+    path.write_text(json.dumps([{'id': 7}]), encoding='utf-8')
+    os.utime(path, ns=(mtime + 10 ** 6, mtime + 10 ** 6))
+    assert [(c['id'], c['op']) for c in _changes(client, cursor)['changes']] == [(7, 'put')]
+
+def test_private_changes_go_to_their_owner_only(simple, feed):
+    simple.save_data('myinfo_records.json', {})
+    alice, bob = _client(simple, 1, 'alice'), _client(simple, 2, 'bob')
+    cursors = [c.get('/api/changes').json['cursor'] for c in (alice, bob)]
+    simple.save_data('myinfo_records.json', {'alice': {'note': 'new'}})
+    assert [c['data'] for c in _changes(alice, cursors[0], collections='myinfo_records')['changes']] == [{'note': 'new'}]
+    assert _changes(bob, cursors[1], collections='myinfo_records')['changes'] == []
+
+def test_unchanged_file_is_not_compared_again(simple, feed):
+    simple.save_data('shop_products.json', [{'id': 1}])
+    compared = []
+    records = feed._feed_records
+    feed._feed_records = lambda file_path, content: compared.append(file_path) or records(file_path, content)
+    for _ in range(3):
+        simple.get_data('shop_products.json')
+    assert compared == ['shop_products.json']
+
+def test_products_without_id_are_not_in_the_feed(simple, feed):
+    simple.save_data('shop_products.json', [])
+    simple.save_data('shop_products.json', [{'title': 'Draft'}, {'id': 1}])
+    assert [c['id'] for c in feed.since(f'{feed.epoch}.0', {'shop_products'}, {None}, 10)[0]] == [1]
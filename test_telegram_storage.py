@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Tests for the Telegram storage backend of server.py
+Runs against a small in-memory stand-in for the Bot API
+
+Run: python -m pytest test_telegram_storage.py
+"""
+
+import asyncio
+import base64
+import concurrent.futures
+import json
+import os
+import random
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest
+
+import server
+
+CHAT = '@storage'
+
+# ==================== FAKE BOT ====================
+
+class FakeBot:
+    """Just enough of telegram.Bot for one channel"""
+
+    def __init__(self):
+        self.messages = {}   # message_id -> text
+        self.documents = {}  # message_id -> (file_id, caption)
+        self.files = {}      # file_id -> bytes
+        self.pinned = None
+        self.updates = []
+        self.calls = []
+        self._next_id = 1
+
+    def _message(self, message_id):
+        file_id, caption = self.documents.get(message_id, (None, None))
+        return SimpleNamespace(message_id=message_id, text=self.messages.get(message_id), caption=caption,
+                               document=SimpleNamespace(file_id=file_id) if file_id else None)
+
+    def sent_chars(self):
+        return sum(len(text or '') for text in self.messages.values())
+
+    def post(self, text):
+        """A channel post made outside the store (e.g. by the old backend)"""
+        message_id = self._next_id
+        self._next_id += 1
+        self.messages[message_id] = text
+        self.updates.append(SimpleNamespace(channel_post=self._message(message_id)))
+        return message_id
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append('send_message')
+        return self._message(self.post(text))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls.append('edit_message_text')
+        if message_id not in self.messages:
+            raise BadRequest('Message to edit not found')
+        if self.messages[message_id] == text:
+            raise BadRequest('Message is not modified: specified new message content is the same')
+        self.messages[message_id] = text
+        return self._message(message_id)
+
+    async def send_document(self, chat_id, document, filename=None, caption=None, **kwargs):
+        self.calls.append('send_document')
+        message_id = self.post(None)
+        self.files[f'file-{message_id}'] = bytes(document)
+        self.documents[message_id] = (f'file-{message_id}', caption)
+        return self._message(message_id)
+
+    async def get_file(self, file_id, **kwargs):
+        self.calls.append('get_file')
+        async def download_as_bytearray():
+            return bytearray(self.files[file_id])
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    async def forward_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.calls.append('forward_message')
+        if message_id not in self.messages:
+            raise BadRequest('Message to forward not found')
+        copy = self.post(self.messages[message_id])
+        if message_id in self.documents:
+            self.documents[copy] = self.documents[message_id]
+        return self._message(copy)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.calls.append('delete_message')
+        if self.messages.pop(message_id, 0) == 0:
+            raise BadRequest('Message to delete not found')
+        self.documents.pop(message_id, None)
+        return True
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        self.calls.append('pin_chat_message')
+        self.pinned = message_id
+        return True
+
+    async def get_chat(self, chat_id, **kwargs):
+        self.calls.append('get_chat')
+        return SimpleNamespace(pinned_message=self._message(self.pinned) if self.pinned else None)
+
+    async def get_updates(self, limit=100, **kwargs):
+        self.calls.append('get_updates')
+        return self.updates[-limit:]
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+@pytest.fixture
+def store(bot, tmp_path):
+    return server.TelegramStore(bot, CHAT, str(tmp_path / 'index.json'))
+
+def run(coro):
+    return asyncio.run(coro)
+
+# ==================== INDEX ====================
+
+def test_writes_edit_one_message_per_key(bot, store):
+    run(store.set('A', [1]))
+    run(store.set('A', [1, 2]))
+    run(store.set('B', {}))
+    run(store.set('A', [1, 2, 3]))
+    # index message + one message per key, whatever the number of writes
+    assert len(bot.messages) == 3
+    assert bot.calls.count('send_message') == 3
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold').get('A')) == [1, 2, 3]
+
+def test_reads_are_served_locally(bot, store):
+    run(store.set('A', [1]))
+    bot.calls.clear()
+    assert run(store.get('A')) == [1]
+    assert bot.calls == []
+
+def test_cold_start_uses_pinned_index(bot, store, tmp_path):
+    run(store.set('A', [1]))
+    for i in range(150):
+        run(store.set(f'K{i}', i))
+
+    fresh = server.TelegramStore(bot, CHAT, str(tmp_path / 'other.json'))
+    bot.calls.clear()
+    assert run(fresh.get('A')) == [1]
+    assert 'get_updates' not in bot.calls
+    assert bot.calls.count('forward_message') == 1
+    # the forwarded copy is cleaned up
+    assert len(bot.messages) == 152
+
+def test_mirror_survives_restart(bot, store):
+    run(store.set('A', [1]))
+    restarted = server.TelegramStore(bot, CHAT, store.mirror_path)
+    bot.calls.clear()
+    assert run(restarted.get('A')) == [1]
+    run(restarted.set('A', [2]))
+    assert bot.calls == ['edit_message_text']
+
+def test_legacy_key_is_found_once_and_indexed(bot, store):
+    message_id = bot.post('#OLD\n[7]')
+    assert run(store.get('OLD')) == [7]
+    assert store._index['OLD'] == [message_id]
+    assert f'"OLD":[{message_id}]' in bot.messages[bot.pinned]
+    run(store.set('OLD', [8]))
+    assert bot.messages[message_id].startswith('#OLD\nZ1 ')
+
+def test_deleted_message_is_written_again(bot, store):
+    run(store.set('A', [1]))
+    del bot.messages[store._index['A'][0]]
+    run(store.set('A', [2]))
+    assert bot.messages[store._index['A'][0]].startswith('#A\nZ1 ')
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold').get('A')) == [2]
+
+def test_unchanged_write_is_not_an_error(bot, store):
+    run(store.set('A', [1]))
+    run(store.set('A', [1]))
+    assert bot.calls.count('send_message') == 2
+    assert run(store.get('A')) == [1]
+
+def test_stale_value_is_read_again_from_channel(bot, store, tmp_path):
+    other = server.TelegramStore(bot, CHAT, str(tmp_path / 'other.json'), ttl=0)
+    run(store.set('A', [1]))
+    assert run(other.get('A')) == [1]
+    run(other.set('A', [2]))
+    assert run(store.get('A')) == [1]  # still within ttl
+    store.ttl = 0
+    assert run(store.get_versioned('A')) == ([2], 2)
+
+def test_write_conflicts_with_another_instance(bot, store, tmp_path):
+    store.ttl = 0
+    other = server.TelegramStore(bot, CHAT, str(tmp_path / 'other.json'), ttl=0)
+    run(store.set('A', [1]))
+    _, version = run(other.get_versioned('A'))
+    run(store.set('A', [2], expected_version=version))
+    with pytest.raises(server.VersionConflict):
+        run(other.set('A', [3], expected_version=version))
+    with pytest.raises(server.VersionConflict):
+        run(other.patch('A', version, [{'op': 'add', 'path': '/-', 'value': 3}]))
+    run(other.patch('A', version + 1, [{'op': 'add', 'path': '/-', 'value': 3}]))
+    assert run(store.get('A')) == [2, 3]
+
+def test_edit_made_in_channel_is_picked_up(bot, store):
+    store.ttl = 0
+    run(store.set('A', [1]))
+    bot.messages[store._index['A'][0]] = '#A\n[5]'
+    assert run(store.get('A')) == [5]
+    run(store.set('A', [6]))
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold').get('A')) == [6]
+
+def test_mirror_appends_to_journal_between_snapshots(bot, store, monkeypatch):
+    monkeypatch.setattr(server.TelegramStore, 'JOURNAL_LIMIT', 5)
+    run(store.set('A', [1]))
+    run(store.set('B', [1]))
+    with open(store.mirror_path + '.log', encoding='utf-8') as f:
+        assert len(f.readlines()) == 3  # index + two keys
+    assert not os.path.exists(store.mirror_path)
+    for i in range(2):
+        run(store.set('A', [i + 1]))
+    assert os.path.exists(store.mirror_path)
+    assert os.path.getsize(store.mirror_path + '.log') == 0
+    run(store.set('B', [2]))
+    restarted = server.TelegramStore(bot, CHAT, store.mirror_path)
+    bot.calls.clear()
+    assert run(restarted.get('A')) == [2] and run(restarted.get('B')) == [2]
+    assert bot.calls == []
+
+def test_torn_journal_line_is_dropped(bot, store):
+    run(store.set('A', [1]))
+    with open(store.mirror_path + '.log', 'a', encoding='utf-8') as f:
+        f.write('{"key": "A", "val')
+    restarted = server.TelegramStore(bot, CHAT, store.mirror_path)
+    run(restarted.set('B', [2]))
+    again = server.TelegramStore(bot, CHAT, store.mirror_path)
+    bot.calls.clear()
+    assert run(again.get('A')) == [1] and run(again.get('B')) == [2]
+    assert bot.calls == []
+
+# ==================== CODEC ====================
+
+def _history(n):
+    rng = random.Random(n)
+    return [{'time': f'2024-01-{1 + i % 28:02d}T10:{i % 60:02d}:00', 'from': f'user{rng.randrange(40)}',
+             'to': f'user{rng.randrange(40)}', 'amount': rng.randrange(1, 500), 'comment': ''} for i in range(n)]
+
+def test_large_value_is_split_into_chunks(bot, store, monkeypatch):
+    monkeypatch.setattr(server, 'DOCUMENT_THRESHOLD', 10 ** 9)
+    history = _history(3000)
+    run(store.set('H', history))
+    ids = store._index['H']
+    assert len(ids) > 1
+    assert all(len(bot.messages[i]) <= server.MESSAGE_LIMIT for i in ids)
+    # an order of magnitude below the old indent=2 text
+    assert sum(len(bot.messages[i]) for i in ids) * 10 < len(json.dumps(history, ensure_ascii=False, indent=2))
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold').get('H')) == history
+
+def test_shrinking_value_deletes_surplus_chunks(bot, store, monkeypatch):
+    monkeypatch.setattr(server, 'DOCUMENT_THRESHOLD', 10 ** 9)
+    run(store.set('H', _history(3000)))
+    first = store._index['H']
+    run(store.set('H', []))
+    assert len(store._index['H']) == 1
+    assert not any(i in bot.messages for i in first)
+
+def test_very_large_value_becomes_a_document(bot, store, monkeypatch):
+    monkeypatch.setattr(server, 'DOCUMENT_THRESHOLD', 1024)
+    run(store.set('H', [1]))
+    chunk = store._index['H'][0]
+    history = _history(3000)
+    run(store.set('H', history))
+    assert 'doc' in store._index['H'] and chunk not in bot.messages
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold').get('H')) == history
+
+def test_corrupted_chunk_is_rejected(bot, store, monkeypatch):
+    run(store.set('A', {'k': 'v' * 100}))
+    message_id = store._index['A'][0]
+    header, body = bot.messages[message_id].rsplit('\n', 1)
+    bot.messages[message_id] = header + '\n' + body[:-5] + '00000'
+    cold = server.TelegramStore(bot, CHAT, store.mirror_path + '.cold')
+    with pytest.raises(ValueError):
+        run(cold.get('A'))
+
+# ==================== EVENT LOOP ====================
+
+@pytest.fixture
+def app_store(bot, tmp_path, monkeypatch):
+    store = server.TelegramStore(bot, CHAT, str(tmp_path / 'index.json'))
+    monkeypatch.setattr(server, 'store', store)
+    return store
+
+def test_routes_share_one_event_loop(bot, app_store):
+    loops = set()
+    send_message = bot.send_message
+    async def recording_send_message(*args, **kwargs):
+        loops.add(asyncio.get_running_loop())
+        return await send_message(*args, **kwargs)
+    bot.send_message = recording_send_message
+
+    client = server.app.test_client()
+    for key in ('users', 'products', 'stores'):
+        assert client.post(f'/api/shop/{key}', json=[{'id': key}]).json == {'success': True}
+    assert client.get('/api/shop/products').json == [{'id': 'products'}]
+    assert loops == {server.loop_thread.loop}
+
+def test_concurrent_requests_on_the_shared_loop(bot, app_store):
+    client = server.app.test_client()
+    assert client.post('/api/bank/users', json=[]).json['success']
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda n: server.app.test_client().post('/api/bank/users', json=[{'n': n}]).json,
+                                range(32)))
+    assert all(r == {'success': True} for r in results)
+    assert len(client.get('/api/bank/users').json) == 1
+
+def test_coroutine_errors_reach_the_caller():
+    async def boom():
+        raise KeyError('x')
+    with pytest.raises(KeyError):
+        server.loop_thread.run(boom())
+
+# ==================== PATCH ====================
+
+def test_apply_patch_operations():
+    data = {'users': [{'name': 'a', 'balance': 1}], 'notes': {}}
+    patched = server.apply_patch(data, [
+        {'op': 'replace', 'path': '/users/0/balance', 'value': 5},
+        {'op': 'add', 'path': '/users/-', 'value': {'name': 'b/c', 'balance': 0}},
+        {'op': 'copy', 'from': '/users/1', 'path': '/notes/b~1c'},
+        {'op': 'move', 'from': '/users/0', 'path': '/users/1'},
+        {'op': 'remove', 'path': '/notes/b~1c/balance'},
+        {'op': 'test', 'path': '/users/1/name', 'value': 'a'},
+    ])
+    assert patched == {'users': [{'name': 'b/c', 'balance': 0}, {'name': 'a', 'balance': 5}],
+                       'notes': {'b/c': {'name': 'b/c'}}}
+    assert data == {'users': [{'name': 'a', 'balance': 1}], 'notes': {}}
+
+@pytest.mark.parametrize('ops', [
+    [{'op': 'remove', 'path': '/users/3'}],
+    [{'op': 'replace', 'path': '/missing', 'value': 1}],
+    [{'op': 'add', 'path': '/users/01', 'value': 1}],
+    [{'op': 'test', 'path': '/users', 'value': []}],
+    [{'op': 'move', 'from': '/users', 'path': '/users/0'}],
+    [{'op': 'frobnicate', 'path': ''}],
+    {'op': 'add', 'path': '', 'value': 1},
+])
+def test_invalid_patch_is_rejected(ops):
+    with pytest.raises(server.PatchError):
+        server.apply_patch({'users': [1]}, ops)
+
+def test_versions_grow_and_survive_restart(bot, store):
+    assert run(store.get_versioned('A')) == (None, 0)
+    assert run(store.set('A', [1])) == 1
+    assert run(store.patch('A', 1, [{'op': 'add', 'path': '/-', 'value': 2}])) == 2
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path).get_versioned('A')) == ([1, 2], 2)
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold').get_versioned('A')) == ([1, 2], 2)
+
+def test_stale_version_is_a_conflict(bot, store):
+    run(store.set('A', [1]))
+    run(store.set('A', [2]))
+    with pytest.raises(server.VersionConflict) as conflict:
+        run(store.patch('A', 1, [{'op': 'add', 'path': '/-', 'value': 3}]))
+    assert conflict.value.version == 2
+    with pytest.raises(server.VersionConflict):
+        run(store.set('A', [3], expected_version=1))
+    assert run(store.get('A')) == [2]
+
+def test_same_version_patches_on_separate_loops_conflict(bot, store):
+    # ASYNC_MODE=per-request: every request runs asyncio.run on its own loop
+    run(store.set('A', []))
+    edit = bot.edit_message_text
+    async def slow_edit(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return await edit(*args, **kwargs)
+    bot.edit_message_text = slow_edit
+
+    def patch(n):
+        try:
+            return run(store.patch('A', 1, [{'op': 'add', 'path': '/-', 'value': n}]))
+        except server.VersionConflict:
+            return 'conflict'
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(patch, range(4)))
+    assert sorted(results, key=str) == [2, 'conflict', 'conflict', 'conflict']
+    assert len(run(store.get('A'))) == 1
+
+def test_key_lock_does_not_block_the_shared_loop(store):
+    async def main():
+        order = []
+        async def writer(n):
+            async with store._key_lock('A'):
+                order.append(n)
+                await asyncio.sleep(0.01)
+        await asyncio.gather(*(writer(n) for n in range(3)))
+        return order
+    assert sorted(server.loop_thread.run(main())) == [0, 1, 2]
+
+def test_unchanged_chunks_are_not_edited(bot, store, monkeypatch):
+    monkeypatch.setattr(server, 'DOCUMENT_THRESHOLD', 10 ** 9)
+    monkeypatch.setattr(server, 'encode_payload', lambda data: (json.dumps(data), b'x' * 10000, 'sum'))
+    run(store.set('H', [1]))
+    bot.calls.clear()
+    run(store.set('H', [2]))
+    # only the first chunk carries the version, the rest are byte-for-byte the same:
+    # a new first chunk, the index switched to it, the old first chunk deleted
+    assert bot.calls == ['send_message', 'edit_message_text', 'delete_message']
+
+@pytest.mark.parametrize('fail_at', [2, 3])
+def test_write_failing_partway_leaves_the_old_value(bot, store, monkeypatch, fail_at):
+    monkeypatch.setattr(server, 'DOCUMENT_THRESHOLD', 10 ** 9)
+    run(store.set('H', _history(3000)))
+    store.ttl = 0
+    send_message = bot.send_message
+    sent = []
+    async def flaky_send_message(*args, **kwargs):
+        sent.append(1)
+        if len(sent) == fail_at:
+            raise server.TelegramError('Flood control exceeded. Retry in 5 seconds')
+        return await send_message(*args, **kwargs)
+    bot.send_message = flaky_send_message
+    messages = dict(bot.messages)
+    with pytest.raises(server.TelegramError):
+        run(store.set('H', _history(3500)))
+    assert bot.messages == messages  # the parts already sent are taken back
+    cold = server.TelegramStore(bot, CHAT, store.mirror_path + '.cold')
+    assert run(cold.get('H')) == _history(3000)
+    bot.send_message = send_message
+    run(store.set('H', _history(3500)))
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold2').get('H')) == _history(3500)
+
+def test_broken_chunks_fall_back_to_the_mirror(bot, store, monkeypatch):
+    monkeypatch.setattr(server, 'DOCUMENT_THRESHOLD', 10 ** 9)
+    run(store.set('H', _history(3000)))
+    store.ttl = 0
+    ids = store._index['H']
+    bot.messages[ids[1]] = bot.messages[ids[2]]  # a torn write from an older version
+    assert run(store.get('H')) == _history(3000)
+    changed = _history(3000)
+    changed[-1]['amount'] = 1  # only the first and last parts differ from the write before the damage
+    run(store.set('H', changed))
+    assert run(server.TelegramStore(bot, CHAT, store.mirror_path + '.cold').get('H')) == changed
+
+def test_unversioned_chunks_still_decode(bot, store):
+    text, raw, checksum = server.encode_payload(_history(300))
+    encoded = base64.b85encode(raw).decode('ascii')
+    half = len(encoded) // 2
+    ids = [bot.post(f'#H\nZ1 {checksum} 1/2\n{encoded[:half]}'), bot.post(f'#H\nZ1 {checksum} 2/2\n{encoded[half:]}')]
+    store._index['H'] = ids
+    assert run(store.get_versioned('H')) == (_history(300), 0)
+
+def test_patch_endpoint(bot, app_store):
+    client = server.app.test_client()
+    client.post('/api/bank/users', json=[{'username': 'a', 'balance': 1}, {'username': 'b', 'balance': 2}])
+    response = client.get('/api/bank/users')
+    version = int(response.headers['X-Collection-Version'])
+    ops = [{'op': 'replace', 'path': '/1/balance', 'value': 7}]
+    assert client.patch('/api/bank/users', json={'version': version, 'ops': ops}).json == \
+        {'success': True, 'version': version + 1}
+    assert client.get('/api/bank/users').json[1]['balance'] == 7
+
+    stale = client.patch('/api/bank/users', json={'version': version, 'ops': ops})
+    assert stale.status_code == 409 and stale.json['version'] == version + 1
+    assert client.patch('/api/bank/users', json={'version': version + 1, 'ops': [{'op': 'remove', 'path': '/9'}]}).status_code == 400
+    assert client.patch('/api/bank/users', json={'ops': ops}).status_code == 400
+    assert client.patch('/api/bank/coins', json={'version': 0, 'ops': []}).status_code == 404
+
+def test_patch_creates_missing_collection(bot, app_store):
+    client = server.app.test_client()
+    ops = [{'op': 'add', 'path': '/alice', 'value': ['shift']}]
+    assert client.patch('/api/mywork/shifts', json={'version': 0, 'ops': ops}).json['success']
+    assert client.get('/api/mywork/shifts').json == {'alice': ['shift']}